@@ -791,6 +791,77 @@ def find_overlaps(correct_overlaps, reprocess_qnrs):
                 patient.id, patient.external_study_id, b4)
 
 
+@app.cli.command()
+@click.option(
+    '--cluster', default=False, is_flag=True,
+    help="Rewrite qb_timeline in covering index order, reclaiming bloat."
+         " Holds an exclusive lock on the table for the duration")
+def qb_timeline_bloat(cluster):
+    """Report on qb_timeline table and index bloat
+
+    Timelines are deleted and regenerated on every invalidation, so the
+    table and its indexes accumulate dead space between vacuums.
+
+    """
+    from portal.models.qb_timeline import qbt_bloat_report
+
+    if cluster:
+        db.session.execute(
+            "CLUSTER qb_timeline USING ix_qb_timeline_user_rs_status_at")
+        db.session.execute("ANALYZE qb_timeline")
+        db.session.commit()
+
+    report = qbt_bloat_report()
+    print("qb_timeline")
+    for key, value in report['table'].items():
+        print("  {}: {}".format(key, value))
+    for index in report['indexes']:
+        print(index.pop('name'))
+        for key, value in index.items():
+            print("  {}: {}".format(key, value))
+
+
+@app.cli.command()
+@click.option(
+    '--locale', '-l', multiple=True,
+    help="Locale code to fetch content in, may be repeated.  Defaults to"
+         " all locales in use by users, and the unlocalized content")
+def warm_content_cache(locale):
+    """Fetch remote mail templates and app text content into the cache
+
+    Includes the templates of every active communication request, and all
+    app text values naming a URL, so the first sends of a reminder run
+    needn't wait on the content server.
+
+    """
+    from portal.models.app_text import AppText
+    from portal.models.app_text import warm_content_cache as warm
+    from portal.models.codeable_concept import CodeableConceptCoding
+    from portal.models.coding import Coding
+    from portal.models.communication_request import CommunicationRequest
+
+    urls = [
+        cr.content_url for cr in CommunicationRequest.query.filter(
+            CommunicationRequest.status == 'active')]
+    urls.extend(
+        at.custom_text for at in AppText.query.filter(
+            AppText.custom_text.like('http%')))
+
+    locale_codes = list(locale)
+    if not locale_codes:
+        in_use = db.session.query(Coding.code).join(
+            CodeableConceptCoding,
+            CodeableConceptCoding.coding_id == Coding.id).join(
+            User, User.locale_id ==
+            CodeableConceptCoding.codeable_concept_id).distinct()
+        locale_codes = [None] + [code for code, in in_use]
+
+    warmed, failed = warm(sorted(set(urls)), locale_codes)
+    print("warmed {} content cache entries".format(warmed))
+    for url in failed:
+        print("  failed: {}".format(url))
+
+
 @click.option('--org_id', help="Organization (site) ID", required=True)
 @click.option(
     '--retired',
@@ -7,6 +7,7 @@ cache = Cache()
 # Human readable constants, values in seconds, for cache timeouts
 TWO_HOURS = 2*60*60
 FIVE_MINS = 5*60
+ONE_MIN = 60
 
 
 def request_args_in_key():
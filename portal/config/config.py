@@ -62,7 +62,20 @@ class BaseConfig(object):
         else 'redis://localhost:6379/0',
     )
 
+    ADHERENCE_CACHE_BATCH_SIZE = int(
+        os.environ.get('ADHERENCE_CACHE_BATCH_SIZE', 100)
+    )
+    # Rows fetched per server side cursor round trip, and processes
+    # serializing them, when aggregating questionnaire responses for the
+    # research report task, see `aggregate_responses()`
+    AGGREGATE_FETCH_SIZE = int(os.environ.get('AGGREGATE_FETCH_SIZE', 500))
+    AGGREGATE_WORKERS = int(
+        os.environ.get('AGGREGATE_WORKERS', min(os.cpu_count() or 1, 4))
+    )
     ANONYMOUS_USER_ACCOUNT = True
+    # Queue post submit processing of QuestionnaireResponses, see post_submit
+    ASYNC_QNR_SUBMIT = (
+        os.environ.get('ASYNC_QNR_SUBMIT', 'false').lower() == 'true')
     BROKER_URL = os.environ.get(
         'BROKER_URL',
         REDIS_URL
@@ -86,6 +99,11 @@ class BaseConfig(object):
     MAIL_SUPPRESS_SEND = os.environ.get(
         'MAIL_SUPPRESS_SEND',
         str(TESTING)).lower() == 'true'
+    # Prepared communications sent per task, sharing an SMTP connection, and
+    # the limit on messages sent per second across all workers (0 for none)
+    COMMUNICATION_BATCH_SIZE = int(
+        os.environ.get('COMMUNICATION_BATCH_SIZE', 100))
+    MAIL_RATE_LIMIT = int(os.environ.get('MAIL_RATE_LIMIT', 0))
     CONTACT_SENDTO_EMAIL = os.environ.get('CONTACT_SENDTO_EMAIL')
     FLUSH_CACHE_ON_SYNC = (
             os.environ.get('FLUSH_CACHE_ON_SYNC', 'true').lower() == 'true')
@@ -133,9 +151,18 @@ class BaseConfig(object):
     PRE_REGISTERED_ROLES = [
         'access_on_verify', 'write_only', 'promote_without_identity_challenge']
     PROJECT = "portal"
+    # qb_timeline writes beyond this many rows use COPY over INSERT
+    QBT_COPY_THRESHOLD = int(os.environ.get('QBT_COPY_THRESHOLD', 1000))
     RCT_INTERVENTIONS = [
         'care_plan', 'community_of_wellness', 'sexual_recovery']
     REPORTING_IDENTIFIER_SYSTEMS = []
+    # Parallel tasks and insert batch size for research_data cache backfill
+    RESEARCH_DATA_BACKFILL_WORKERS = int(
+        os.environ.get('RESEARCH_DATA_BACKFILL_WORKERS', 4)
+    )
+    RESEARCH_DATA_INSERT_BATCH_SIZE = int(
+        os.environ.get('RESEARCH_DATA_INSERT_BATCH_SIZE', 500)
+    )
     SHOW_EXPLORE = True
     SHOW_PROFILE_MACROS = ['ethnicity', 'race']
     SHOW_PUBLIC_TERMS = True
@@ -181,13 +208,24 @@ class BaseConfig(object):
 
     DEFAULT_LOCALE = 'en_US'
     TMP_REPORT_DIR = os.environ.get('TMP_REPORT_DIR', '/var/lib/portal/exports')
+    # Compression of report artifacts in TMP_REPORT_DIR: 'gzip', 'zstd' or
+    # None, and seconds an artifact may be reused for a repeated request
+    REPORT_COMPRESSION = os.environ.get('REPORT_COMPRESSION') or None
+    REPORT_ARTIFACT_TTL = int(
+        os.environ.get('REPORT_ARTIFACT_TTL', 60 * 60 * 24))
     FILE_UPLOAD_DIR = os.environ.get('FILE_UPLOAD_DIR', 'uploads')
 
     LR_ORIGIN = os.environ.get('LR_ORIGIN', 'https://cms-stage.us.truenth.org')
     LR_GROUP = os.environ.get('LR_GROUP', 20129)
     LR_FOLDER_ST = os.environ.get('LR_FOLDER_ST', 34666)
+    # Seconds remote content (i.e. mail templates) is used before
+    # revalidating with the content server, 0 to disable
+    CONTENT_CACHE_TTL = int(os.environ.get('CONTENT_CACHE_TTL', 5 * 60))
 
     SDC_BASE_URL = os.environ.get('SDC_BASE_URL', 'http://sdc:5000/v/r2/fhir')
+    # EMPRO observation extraction: 'local' (in process) or 'http' (via the
+    # SDC service at SDC_BASE_URL)
+    SDC_EXTRACT_BACKEND = os.environ.get('SDC_EXTRACT_BACKEND', 'local')
 
     SYSTEM_TYPE = os.environ.get('SYSTEM_TYPE', 'development')
 
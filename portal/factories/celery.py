@@ -3,6 +3,7 @@ import logging
 import sys
 
 from ..extensions import db
+from ..scoped_cache import close_scope, open_scope
 
 __celery = None
 
@@ -45,9 +46,14 @@ def create_celery(app):
         def __call__(self, *args, **kwargs):
             with app.app_context():
                 db.session = db.create_scoped_session()
+                open_scope()
                 try:
                     response = TaskBase.__call__(self, *args, **kwargs)
                 finally:
+                    avoided = close_scope()
+                    if avoided:
+                        app.logger.debug("{} avoided rebuilds: {}".format(
+                            self.name, dict(avoided)))
                     db.session.remove()
                 return response
 
@@ -0,0 +1,76 @@
+"""add typed questionnaire_response columns derived from document
+
+Revision ID: 5e3b9a0c7d41
+Revises: f19953767941
+Create Date: 2026-10-18 03:02:47.119342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e3b9a0c7d41'
+down_revision = 'f19953767941'
+
+
+def upgrade():
+    op.add_column(
+        'questionnaire_responses',
+        sa.Column('authored', sa.DateTime(), nullable=True))
+    op.add_column(
+        'questionnaire_responses',
+        sa.Column('instrument_id', sa.Text(), nullable=True))
+    op.add_column(
+        'questionnaire_responses',
+        sa.Column('identifier_system', sa.Text(), nullable=True))
+    op.add_column(
+        'questionnaire_responses',
+        sa.Column('identifier_value', sa.Text(), nullable=True))
+
+    # populate from document, matching
+    # portal.models.questionnaire_response.QuestionnaireResponse.document_columns
+    # authored values without an offset are UTC, all are stored as naive UTC
+    op.execute("SET TIME ZONE 'UTC'")
+    op.execute("""
+        UPDATE questionnaire_responses SET
+          authored = (document->>'authored')::timestamptz AT TIME ZONE 'UTC',
+          instrument_id = regexp_replace(
+            document->'questionnaire'->>'reference', '^.*/', ''),
+          identifier_system = document->'identifier'->>'system',
+          identifier_value = document->'identifier'->>'value'
+    """)
+
+    op.create_index(
+        op.f('ix_questionnaire_responses_instrument_id'),
+        'questionnaire_responses', ['instrument_id'], unique=False)
+    op.create_index(
+        'ix_qnr_subject_authored', 'questionnaire_responses',
+        ['subject_id', 'authored'], unique=False)
+    op.create_index(
+        'ix_qnr_subject_qb_iteration', 'questionnaire_responses',
+        ['subject_id', 'questionnaire_bank_id', 'qb_iteration'], unique=False)
+    op.create_index(
+        'ix_qnr_identifier', 'questionnaire_responses',
+        ['identifier_system', 'identifier_value'], unique=False)
+
+    # lookups now use the typed columns, drop the JSON expression indexes
+    op.execute("DROP INDEX IF EXISTS idx_qnr_identifier_val2")
+    op.execute("DROP INDEX IF EXISTS idx_qnr_identifier_sys2")
+    op.execute("DROP INDEX IF EXISTS idx_qnr_authored")
+
+
+def downgrade():
+    op.execute("CREATE INDEX IF NOT EXISTS idx_qnr_identifier_val2 ON questionnaire_responses(((document->'identifier')->'value'))")
+    op.execute("CREATE INDEX IF NOT EXISTS idx_qnr_identifier_sys2 ON questionnaire_responses(((document->'identifier')->'system'))")
+    op.execute("CREATE INDEX IF NOT EXISTS idx_qnr_authored ON questionnaire_responses((document->'authored'))")
+    op.drop_index('ix_qnr_identifier', table_name='questionnaire_responses')
+    op.drop_index('ix_qnr_subject_qb_iteration', table_name='questionnaire_responses')
+    op.drop_index('ix_qnr_subject_authored', table_name='questionnaire_responses')
+    op.drop_index(
+        op.f('ix_questionnaire_responses_instrument_id'),
+        table_name='questionnaire_responses')
+    op.drop_column('questionnaire_responses', 'identifier_value')
+    op.drop_column('questionnaire_responses', 'identifier_system')
+    op.drop_column('questionnaire_responses', 'instrument_id')
+    op.drop_column('questionnaire_responses', 'authored')
@@ -0,0 +1,48 @@
+"""add adherence_data.sort_key
+
+Revision ID: 82ab1f3b56a4
+Revises: 8eb3e2e6076a
+Create Date: 2026-10-18 02:10:31.184722
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '82ab1f3b56a4'
+down_revision = '8eb3e2e6076a'
+
+
+def upgrade():
+    op.add_column(
+        'adherence_data', sa.Column('sort_key', sa.Integer(), nullable=True))
+
+    # populate existing rows with values matching
+    # portal.models.adherence_data.visit_sort_key(), including its
+    # UNKNOWN_VISIT_SORT_KEY for unrecognized visit names
+    op.execute("""
+        UPDATE adherence_data SET sort_key = COALESCE(CASE visit
+            WHEN 'Baseline' THEN 0
+            WHEN 'Baseline post-withdrawn' THEN 1
+            WHEN 'Indefinite' THEN 2000
+            WHEN 'Indefinite post-withdrawn' THEN 2001
+            ELSE 1000 + substring(visit from '^Month ([0-9]+)')::integer +
+                CASE WHEN visit LIKE '% post-withdrawn' THEN 100 ELSE 0 END
+            END, 3000)
+        FROM (
+            SELECT id AS visit_id, split_part(rs_id_visit, ':', 2) AS visit
+            FROM adherence_data) AS visits
+        WHERE adherence_data.id = visits.visit_id
+    """)
+
+    op.alter_column('adherence_data', 'sort_key', nullable=False)
+    op.create_index(
+        'ix_adherence_data_patient_sort', 'adherence_data',
+        ['patient_id', 'sort_key'], unique=False)
+
+
+def downgrade():
+    op.drop_index(
+        'ix_adherence_data_patient_sort', table_name='adherence_data')
+    op.drop_column('adherence_data', 'sort_key')
@@ -0,0 +1,57 @@
+"""move qb_timeline resume points from redis to qb_timeline_resume_points
+
+Revision ID: a4f2c81d9e3b
+Revises: 7c1e4f2a9b36
+Create Date: 2026-10-18 09:14:52.630417
+
+"""
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+from portal.date_tools import FHIR_datetime
+from portal.factories.redis import create_redis
+
+# revision identifiers, used by Alembic.
+revision = 'a4f2c81d9e3b'
+down_revision = '7c1e4f2a9b36'
+
+REDIS_KEY_PATTERN = "qb_timeline_resume_from:*"
+
+
+def upgrade():
+    op.create_table(
+        'qb_timeline_resume_points',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('research_study_id', sa.Integer(), nullable=False),
+        sa.Column('resume_from', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ['user_id'], ['users.id'], ondelete='cascade'),
+        sa.ForeignKeyConstraint(
+            ['research_study_id'], ['research_studies.id'],
+            ondelete='cascade'),
+        sa.PrimaryKeyConstraint('user_id', 'research_study_id'))
+
+    # carry over resume points held in redis, lest their truncated
+    # timelines be taken as current
+    rs = create_redis(current_app.config['REDIS_URL'])
+    conn = op.get_bind()
+    for key in rs.scan_iter(match=REDIS_KEY_PATTERN):
+        value = rs.get(key)
+        if not value:
+            continue
+        key = key.decode() if isinstance(key, bytes) else key
+        value = value.decode() if isinstance(value, bytes) else value
+        _, user_id, research_study_id = key.split(':')
+        conn.execute(sa.text(
+            "INSERT INTO qb_timeline_resume_points "
+            "(user_id, research_study_id, resume_from) "
+            "SELECT :user_id, :research_study_id, :resume_from "
+            "WHERE EXISTS (SELECT 1 FROM users WHERE id = :user_id)"),
+            user_id=int(user_id), research_study_id=int(research_study_id),
+            resume_from=FHIR_datetime.parse(value))
+        rs.delete(key)
+
+
+def downgrade():
+    op.drop_table('qb_timeline_resume_points')
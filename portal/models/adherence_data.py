@@ -1,11 +1,13 @@
 """ model data for adherence reports """
+from collections import defaultdict
 from datetime import datetime, timedelta
 from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import Index, UniqueConstraint
 import re
 
 from ..database import db
 withdrawn = " post-withdrawn"
+UNKNOWN_VISIT_SORT_KEY = 3000
 
 class AdherenceData(db.Model):
     """ Cached adherence report data
@@ -15,6 +17,8 @@ class AdherenceData(db.Model):
     and invalidation timestamps.
 
     rs_id_visit: the numeric rs_id and visit month string joined with a colon
+    sort_key: visit order for reporting, derived from the visit month and
+        post-withdrawn flag of rs_id_visit.  see ``visit_sort_key()``
     valid_till: old history data never changes, unless an external event such
         as a user's consent date or organization research protocol undergoes
         change.  active visits require more frequent updates but are considered
@@ -31,10 +35,17 @@ class AdherenceData(db.Model):
     valid_till = db.Column(
         db.DateTime, nullable=False, index=True,
         doc="cached values good till time passed")
+    sort_key = db.Column(
+        db.Integer, nullable=False,
+        doc="visit order, as generated by visit_sort_key()")
     data = db.Column(JSONB)
 
-    __table_args__ = (UniqueConstraint(
-        'patient_id', 'rs_id_visit', name='_adherence_unique_patient_visit'),)
+    __table_args__ = (
+        UniqueConstraint(
+            'patient_id', 'rs_id_visit',
+            name='_adherence_unique_patient_visit'),
+        Index('ix_adherence_data_patient_sort', 'patient_id', 'sort_key'),
+    )
 
     @staticmethod
     def rs_visit_string(rs_id, visit_string, post_withdrawn=False):
@@ -89,6 +100,7 @@ class AdherenceData(db.Model):
             record = AdherenceData(
                 patient_id=patient_id,
                 rs_id_visit=rs_id_visit,
+                sort_key=visit_sort_key(rs_id_visit.split(':')[1]),
                 valid_till=valid_till,
                 data=data)
             db.session.add(record)
@@ -96,45 +108,68 @@ class AdherenceData(db.Model):
         return db.session.merge(record)
 
 
-def sort_by_visit_key(d):
-    """Given dict returns ordered list of values sorted by key
+def visit_sort_key(visit_string):
+    """Returns integer sort key for the visit portion of rs_id_visit
 
     Sort by key using the following rules:
     "Baseline" comes first
     "Indefinite" comes last
     "Month <n>" in the middle, sorted by integer value
+    "<visit> post-withdrawn" follows the respective non withdrawn visits
+    any other visit name comes after all of the above
+
+    """
+    if visit_string == 'Baseline':
+        return 0
+    elif visit_string == f"Baseline{withdrawn}":
+        return 1
+    elif visit_string == 'Indefinite':
+        return 2000
+    elif visit_string == f'Indefinite{withdrawn}':
+        return 2001
+
+    match = re.match(f"Month ([0-9]+)({withdrawn})?", visit_string)
+    if not match:
+        return UNKNOWN_VISIT_SORT_KEY
+    month_num = int(match.groups()[0])
+    if match.groups()[1]:
+        month_num += 100
+    return 1000 + month_num
+
+
+def sort_by_visit_key(d):
+    """Given dict returns ordered list of values sorted by key
+
+    Keys are sorted as defined by ``visit_sort_key()``
 
     :returns: list of values sorted by keys
     """
-    pattern = re.compile(f"Month ([0-9]+)({withdrawn})?")
-    def sort_key(key):
-        if key == 'Baseline':
-            return 0, 0
-        elif key == f"Baseline{withdrawn}":
-            return 0, 1
-        elif key == 'Indefinite':
-            return 2, 0
-        elif key == f'Indefinite{withdrawn}':
-            return 2, 1
-        else:
-            match = pattern.match(key)
-            if not match.groups():
-                raise ValueError(f"couldn't parse key {key}")
-            month_num = int(match.groups()[0])
-            if match.groups()[1]:
-                month_num += 100
-            return 1, month_num
-
-    sorted_keys = sorted(d.keys(), key=sort_key)
+    sorted_keys = sorted(d.keys(), key=visit_sort_key)
     sorted_values = [d[key] for key in sorted_keys]
     return sorted_values
 
 
 def sorted_adherence_data(patient_id, research_study_id):
     """Shortcut to obtain ordered list for given patient:research_study"""
+    return bulk_sorted_adherence_data(
+        (patient_id,), research_study_id).get(patient_id, [])
+
+
+def bulk_sorted_adherence_data(patient_ids, research_study_id):
+    """Obtain ordered lists for a number of patients in a single query
+
+    :param patient_ids: iterable of patient ids, or query returning them
+    :param research_study_id: research study to restrict results to
+    :returns: dictionary keyed by patient_id with the ordered list of
+      adherence data for each patient found
+
+    """
     rows = AdherenceData.query.filter(
-        AdherenceData.patient_id == patient_id).filter(
-        AdherenceData.rs_id_visit.like(f"{research_study_id}%"))
-    # Sort locally, given complicated sort function
-    presorted = {row.rs_id_visit.split(':')[1]: row.data for row in rows}
-    return sort_by_visit_key(presorted)
+        AdherenceData.patient_id.in_(patient_ids)).filter(
+        AdherenceData.rs_id_visit.like(f"{research_study_id}:%")).order_by(
+        AdherenceData.patient_id, AdherenceData.sort_key).with_entities(
+        AdherenceData.patient_id, AdherenceData.data)
+    results = defaultdict(list)
+    for patient_id, data in rows:
+        results[patient_id].append(data)
+    return results
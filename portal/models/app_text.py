@@ -11,22 +11,31 @@ SitePersistence mechanism, and looked up in a template using the
 
 from abc import ABCMeta, abstractmethod
 from builtins import str
+import json
 from string import Formatter
+from time import time
 import timeit
 from urllib.parse import parse_qsl, urlencode, urlparse
 
 from flask import current_app
 from flask_babel import gettext
 import requests
+import requests_cache
 from requests.exceptions import ConnectionError, InvalidURL, MissingSchema
 
+from ..cache import cache
 from ..database import db
 
+CONTENT_CACHE_KEY = "content_cache:{}"
+# Entries outlive CONTENT_CACHE_TTL, for revalidation and to serve
+# should the content server be unavailable
+CONTENT_CACHE_EXPIRATION = 24 * 60 * 60  # one day, in seconds
 
-def time_request(url, params=None):
+
+def time_request(url, params=None, headers=None):
     """Wrap the requests.get(url) and log the timing"""
     start = timeit.default_timer()
-    response = requests.get(url, params)
+    response = requests.get(url, params, headers=headers)
     duration = timeit.default_timer() - start
     message = ('TIME {duration:.4f} seconds to GET {url}'.format(
         url=url, duration=duration))
@@ -39,6 +48,107 @@ def time_request(url, params=None):
     return response
 
 
+class CachedResponse(object):
+    """Minimal response interface over content held in the cache"""
+
+    def __init__(self, entry):
+        self.status_code = entry['status_code']
+        self.reason = entry['reason']
+        self.text = entry['text']
+
+    def json(self):
+        """Returns parsed content; raises ValueError if not JSON"""
+        return json.loads(self.text)
+
+
+def cached_request(url, revalidate=False):
+    """GET url via content cache shared by all workers
+
+    Successful responses are held for `CONTENT_CACHE_TTL` seconds, keyed
+    by the (localized) url.  Once stale, the content server is asked
+    to revalidate via `If-None-Match` and `If-Modified-Since`, refreshing
+    the entry on `304 Not Modified`.  Should the server be unreachable or
+    fail, any stale entry is used in its place.
+
+    Variables are substituted by the resource classes, so a single entry
+    serves every recipient.
+
+    :param url: content url, including any version and language parameters
+    :param revalidate: set to skip the TTL check, revalidating any entry
+    :returns: the requests response, or a ``CachedResponse``
+
+    """
+    ttl = current_app.config['CONTENT_CACHE_TTL']
+    if not ttl:
+        return time_request(url)
+
+    key = CONTENT_CACHE_KEY.format(url)
+    entry = cache.get(key)
+    now = time()
+    if entry and not revalidate and now - entry['validated'] < ttl:
+        return CachedResponse(entry)
+
+    headers = {}
+    if entry and entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        # bypass the short lived requests cache, to reach the server
+        with requests_cache.disabled():
+            response = time_request(url, headers=headers)
+    except ConnectionError:
+        if not entry:
+            raise
+        current_app.logger.warning(f"serving stale content for {url}")
+        return CachedResponse(entry)
+
+    if entry and response.status_code == 304:
+        entry['validated'] = now
+    elif response.status_code == 200:
+        entry = {
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'text': response.text,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'validated': now}
+    elif entry:
+        current_app.logger.warning(
+            f"serving stale content for {url}; {response.status_code}")
+        return CachedResponse(entry)
+    else:
+        return response
+
+    cache.set(key, entry, timeout=CONTENT_CACHE_EXPIRATION)
+    return CachedResponse(entry)
+
+
+def warm_content_cache(urls, locale_codes):
+    """Fetch or revalidate content cache entries ahead of use
+
+    :param urls: content urls, as stored (prior to localization)
+    :param locale_codes: locales to fetch each url in; include None for
+      the unlocalized url
+    :returns: (number of entries warmed, list of urls that failed)
+
+    """
+    warmed, failed = 0, []
+    for url in urls:
+        for locale_code in locale_codes:
+            localized = localize_url(url, locale_code)
+            try:
+                response = cached_request(localized, revalidate=True)
+            except (ConnectionError, InvalidURL, MissingSchema):
+                failed.append(localized)
+                continue
+            if response.status_code != 200:
+                failed.append(localized)
+                continue
+            warmed += 1
+    return warmed, failed
+
+
 def get_terms(locale_code, org=None, role=None, research_study_id=0):
     """Shortcut to lookup correct terms given org and role"""
     if org:
@@ -419,7 +529,7 @@ class UnversionedResource(object):
             self._asset = str(asset)
         else:
             try:
-                response = time_request(url)
+                response = cached_request(url)
                 self._asset = response.text
             except (MissingSchema, InvalidURL):
                 if current_app.config.get('TESTING'):
@@ -474,7 +584,7 @@ class VersionedResource(object):
         self.url = localize_url(url, locale_code)
         self.variables = variables or {}
         try:
-            response = time_request(self.url)
+            response = cached_request(self.url)
             self._asset = response.json().get('asset')
             self.url = self._permanent_url(
                 generic_url=self.url, version=response.json().get('version'))
@@ -569,7 +679,7 @@ class MailResource(object):
         self.url = localize_url(url, locale_code)
         self.variables = variables or {}
         try:
-            response = time_request(self.url)
+            response = cached_request(self.url)
             self._subject = response.json().get('subject')
             self._body = response.json().get('body')
             if current_app.config.get("DEBUG_EMAIL", False):
@@ -327,8 +327,13 @@ class Communication(db.Model):
 
         return msg
 
-    def generate_and_send(self):
-        """Collate message details and send"""
+    def generate_and_send(self, mailer=None):
+        """Collate message details and send
+
+        :param mailer: optional ``PooledMailer`` to send through, sharing
+          its SMTP connection
+
+        """
         from .qb_timeline import qb_status_visit_name
 
         if current_app.config.get('DEBUG_EMAIL', False):
@@ -362,7 +367,7 @@ class Communication(db.Model):
 
         self.message = self.generate_message()
         try:
-            self.message.send_message()
+            self.message.send_message(mailer=mailer)
             self.status = 'completed'
         except SMTPRecipientsRefused as exc:
             msg = ("Error sending Communication {} to {}: "
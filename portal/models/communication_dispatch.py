@@ -0,0 +1,187 @@
+"""Batched dispatch of prepared Communications
+
+Prepared communications are split into batches of
+`COMMUNICATION_BATCH_SIZE`, each sent by a single task so a wave of
+reminders spreads across the available workers.  Within a batch, every
+message shares one SMTP connection via ``PooledMailer``, in place of a
+connection per message.
+
+Sends from all workers are held to `MAIL_RATE_LIMIT` messages per second,
+tallied in redis.  Each batch adds its per status counts to a redis hash
+shared by the run; the final batch to complete logs the totals.
+
+A failure on any one communication is logged and counted, leaving it in
+`preparation` for the next run, and the remainder of the batch continues.
+
+"""
+from collections import Counter
+from smtplib import SMTPException, SMTPServerDisconnected
+from time import sleep, time
+from uuid import uuid4
+
+from flask import current_app
+
+from ..database import db
+from ..extensions import mail
+from ..factories.redis import create_redis
+from .communication import Communication
+
+DISPATCH_RUN_KEY = "communication_dispatch:{}"
+DISPATCH_RUN_EXPIRATION = 24 * 60 * 60  # one day, in seconds
+SEND_WINDOW_KEY = "communication_send_window:{}"
+
+
+def throttle(rate_limit):
+    """Block till a send fits within rate_limit messages per second
+
+    Sends are counted across all workers in one second windows.  Once a
+    window is full, wait for the next.
+
+    :param rate_limit: messages per second, zero or None for no limit
+
+    """
+    if not rate_limit:
+        return
+    rs = create_redis(current_app.config['REDIS_URL'])
+    while True:
+        now = time()
+        window = int(now)
+        key = SEND_WINDOW_KEY.format(window)
+        pipe = rs.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, 2)
+        sent, _ = pipe.execute()
+        if sent <= rate_limit:
+            return
+        sleep(window + 1 - now)
+
+
+class PooledMailer(object):
+    """Mail sender sharing a single SMTP connection for its lifetime
+
+    Use as a context manager, the connection is opened on first send and
+    closed on exit.  Should the server drop the connection, it is reopened
+    and the send retried once.
+
+    """
+
+    def __init__(self, rate_limit=None):
+        self.rate_limit = (
+            rate_limit if rate_limit is not None
+            else current_app.config['MAIL_RATE_LIMIT'])
+        self._connection = None
+        self.sent = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = mail.connect().__enter__()
+        return self._connection
+
+    def close(self):
+        """Close the connection, if open; the next send opens another"""
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        try:
+            connection.__exit__(None, None, None)
+        except SMTPException:
+            # already dropped by the server
+            pass
+
+    def send(self, message):
+        """Send flask_mail message via the shared connection"""
+        throttle(self.rate_limit)
+        try:
+            self._connect().send(message)
+        except SMTPServerDisconnected:
+            self.close()
+            self._connect().send(message)
+        self.sent += 1
+
+
+def queue_dispatch(communication_ids):
+    """Queue batches of communications for sending by available workers
+
+    :returns: number of batches queued
+
+    """
+    from ..tasks import send_communications_task
+
+    batch_size = current_app.config['COMMUNICATION_BATCH_SIZE']
+    batches = [
+        communication_ids[i:i + batch_size]
+        for i in range(0, len(communication_ids), batch_size)]
+    run_key = DISPATCH_RUN_KEY.format(uuid4().hex)
+    for batch in batches:
+        send_communications_task.apply_async(priority=9, kwargs={
+            'communication_ids': batch,
+            'run_key': run_key,
+            'batch_count': len(batches)})
+    return len(batches)
+
+
+def dispatch_communications(communication_ids, run_key=None, batch_count=None):
+    """Send the given communications, sharing one SMTP connection
+
+    Communications no longer in `preparation`, such as those sent by an
+    overlapping run, are skipped.
+
+    :param communication_ids: communications to send
+    :param run_key: redis key shared by all batches of the same run, used
+      to tally counts
+    :param batch_count: total number of batches in the run
+    :returns: Counter of resulting communication status, including
+      'error' for failures and 'skipped'
+
+    """
+    counts = Counter()
+    with PooledMailer() as mailer:
+        for communication_id in communication_ids:
+            communication = Communication.query.get(communication_id)
+            if not (communication and communication.status == 'preparation'):
+                counts['skipped'] += 1
+                continue
+            try:
+                communication.generate_and_send(mailer=mailer)
+                db.session.commit()
+                counts[communication.status] += 1
+            except Exception as e:
+                db.session.rollback()
+                counts['error'] += 1
+                current_app.logger.error(
+                    "failed to send communication %d: %s",
+                    communication_id, e)
+                if isinstance(e, SMTPException):
+                    # connection state unknown, start fresh
+                    mailer.close()
+
+    if run_key:
+        tally(run_key, counts, batch_count)
+    return counts
+
+
+def tally(run_key, counts, batch_count):
+    """Add batch counts to the run, logging totals once all have reported"""
+    rs = create_redis(current_app.config['REDIS_URL'])
+    pipe = rs.pipeline()
+    pipe.hincrby(run_key, 'batches', 1)
+    for status, count in counts.items():
+        pipe.hincrby(run_key, status, count)
+    pipe.expire(run_key, DISPATCH_RUN_EXPIRATION)
+    batches_done = pipe.execute()[0]
+
+    if batches_done == batch_count:
+        totals = {
+            k.decode() if isinstance(k, bytes) else k: int(v)
+            for k, v in rs.hgetall(run_key).items()}
+        totals.pop('batches', None)
+        current_app.logger.info(
+            "communication dispatch completed %d batches: %s",
+            batch_count, totals)
+        rs.delete(run_key)
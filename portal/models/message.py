@@ -149,10 +149,12 @@ class EmailMessage(db.Model):
         return '{header}{body}{footer}'.format(
             header=EMAIL_HEADER, body=body, footer=EMAIL_FOOTER)
 
-    def send_message(self, cc_address=None):
+    def send_message(self, cc_address=None, mailer=None):
         """Send the message
 
         :param cc_address: include valid email address to send a carbon copy
+        :param mailer: optional ``PooledMailer`` to send through, otherwise
+          a connection is opened for this message alone
 
         NB the cc isn't persisted with the rest of the record.
 
@@ -172,7 +174,7 @@ class EmailMessage(db.Model):
             body, width=280, break_long_words=False, break_on_hyphens=False)
         exc = None
         try:
-            mail.send(message)
+            (mailer or mail).send(message)
         except Exception as e:
             exc = e
 
@@ -3,8 +3,10 @@
 Designed around FHIR guidelines for representation of organizations, locations
 and healthcare services which are used to describe hospitals and clinics.
 """
+from uuid import uuid4
+
 from flask import current_app, url_for
-from sqlalchemy import UniqueConstraint, and_
+from sqlalchemy import UniqueConstraint
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import backref
@@ -16,7 +18,6 @@ from ..database import db
 from ..date_tools import FHIR_datetime
 from ..dict_tools import strip_empties
 from ..system_uri import IETF_LANGUAGE_TAG, SHORTNAME_ID, TRUENTH_RP_EXTENSION
-from ..timeout_lock import LockTimeout, TimeoutLock
 from .app_text import (
     ConsentByOrg_ATMA,
     UndefinedAppText,
@@ -812,7 +813,7 @@ class OrgNode(object):
         return self.parent.top_level()
 
 
-ORG_TREE_LOCK_KEY = 'OrgTree-LOCK'
+ORG_TREE_VERSION_KEY = 'OrgTree-VERSION'
 
 
 class OrgTree(object):
@@ -826,7 +827,8 @@ class OrgTree(object):
     below a level for permission issues. etc.
 
     This singleton class will build up the tree when it's first needed (i.e.
-    lazy load).
+    lazy load).  A version stamp kept in the shared cache is bumped on
+    invalidation, so every process rebuilds after organization edits.
 
     Note, the root of the tree is a dummy object, so the first tier can be
     multiple `top-level` organizations.
@@ -834,52 +836,73 @@ class OrgTree(object):
     """
     root = None
     lookup_table = None
+    ancestors = None
+    descendants = None
+    version = None
 
     def __init__(self):
         # Maintain a singleton root object and lookup_table
-        try:
-            with TimeoutLock(key=ORG_TREE_LOCK_KEY, expires=300, timeout=300):
-                if not OrgTree.root:
-                    self.__reset_cache()
-        except LockTimeout:
-            current_app.logger.error(
-                f"couldn't acquire {ORG_TREE_LOCK_KEY}")
+        current = cache.get(ORG_TREE_VERSION_KEY)
+        if current is None:
+            current = uuid4().hex
+            cache.set(ORG_TREE_VERSION_KEY, current, timeout=0)
+        if not OrgTree.root or OrgTree.version != current:
+            self.__reset_cache()
+            OrgTree.version = current
 
     def __reset_cache(self):
         # Internal method to manage cached org data
         OrgTree.root = OrgNode(id=None)
         OrgTree.lookup_table = {}
+        OrgTree.ancestors = {}
+        OrgTree.descendants = {}
         self.populate_tree()
 
     @classmethod
     def invalidate_cache(cls):
-        """Invalidate cache on org changes"""
+        """Invalidate cache on org changes, in this and all other processes"""
         cls.root = None
+        cache.set(ORG_TREE_VERSION_KEY, uuid4().hex, timeout=0)
 
     def populate_tree(self):
-        """Recursively build tree from top down"""
+        """Build tree from a single query of the organization hierarchy
+
+        Also precomputes the ancestor and descendant sets for every node,
+        so hierarchy lookups don't require walking the tree.
+
+        """
         if self.root.children:  # Done if already populated
             return
 
-        def add_descendents(node):
-            partOf_id = node.id
-            for org in Organization.query.filter(and_(
-                Organization.id != 0,  # none of the above doesn't apply
-                Organization.partOf_id == partOf_id)
-            ):
-                new_node = node.insert(id=org.id, partOf_id=partOf_id)
-                if org.id in self.lookup_table:
+        children = {}
+        for org_id, partOf_id in Organization.query.filter(
+                Organization.id != 0  # none of the above doesn't apply
+        ).with_entities(Organization.id, Organization.partOf_id):
+            children.setdefault(partOf_id, []).append(org_id)
+
+        # Add top level orgs first, breadth first on down
+        ordered = []
+        pending = [self.root]
+        while pending:
+            node = pending.pop(0)
+            for org_id in sorted(children.get(node.id, [])):
+                new_node = node.insert(id=org_id, partOf_id=node.id)
+                if org_id in self.lookup_table:
                     raise ValueError(
                         "Found cycle in org graph - can't add {} to table: {}"
-                        "".format(org.id, self.lookup_table.keys()))
-                self.lookup_table[org.id] = new_node
-                if Organization.query.filter(
-                    Organization.partOf_id == new_node.id
-                ).count():
-                    add_descendents(new_node)
-
-        # Add top level orgs first, recurse on down
-        add_descendents(self.root)
+                        "".format(org_id, self.lookup_table.keys()))
+                self.lookup_table[org_id] = new_node
+                self.ancestors[org_id] = (org_id,) + self.ancestors.get(
+                    node.id, ())
+                ordered.append(new_node)
+                pending.append(new_node)
+
+        # Bottom up, each node's descendants include those of its children
+        for node in reversed(ordered):
+            below = {node.id}
+            for child_id in node.children:
+                below.update(self.descendants[child_id])
+            self.descendants[node.id] = frozenset(below)
 
     def find(self, organization_id):
         """Locates and returns node in OrgTree for given organization_id
@@ -950,16 +973,7 @@ class OrgTree(object):
             arb = self.find(organization_id)
         except ValueError:
             return []
-
-        def fetch_nodes(node):
-            stack = [node]
-            while stack:
-                node = stack.pop()
-                yield node.id
-                for id, child_node in node.children.items():
-                    stack.append(child_node)
-
-        return list(fetch_nodes(arb))
+        return list(self.descendants[arb.id])
 
     def at_or_below_ids(self, organization_id, other_organizations):
         """Check if the other_organizations are at or below given organization
@@ -972,13 +986,17 @@ class OrgTree(object):
             given organization_id, or a child of it.
 
         """
+        try:
+            below = self.descendants[self.find(organization_id).id]
+        except ValueError:
+            below = frozenset()
+
         # work through list - short circuit out if a qualified node is found
         for other_organization_id in other_organizations:
-            if organization_id == other_organization_id:
-                return True
-            children = self.here_and_below_id(organization_id)
-            if other_organization_id in children:
+            if (organization_id == other_organization_id or
+                    other_organization_id in below):
                 return True
+        return False
 
     def at_and_above_ids(self, organization_id):
         """Returns list of ids from any point in tree and up the parent stack
@@ -988,17 +1006,8 @@ class OrgTree(object):
             every parent found in chain
 
         """
-        ids = []
         node = self.find(organization_id)
-        if node is None:
-            raise ValueError(f"can't find {organization_id}")
-        while node is not self.root:
-            ids.append(node.id)
-            if node.parent is None:
-                raise ValueError(
-                    f"invalid OrgTree state - {node.id} lost parent!")
-            node = node.parent
-        return ids
+        return list(self.ancestors[node.id])
 
     def find_top_level_orgs(self, organizations, first=False):
         """Returns top level organization(s) from those provided
@@ -1052,7 +1061,7 @@ def org_restriction_by_role(user, requested_orgs):
                 if orgId == 0:  # None of the above doesn't count
                     continue
                 for org in user.organizations:
-                    if orgId in ot.here_and_below_id(org.id):
+                    if ot.at_or_below_ids(org.id, (orgId,)):
                         org_list.add(orgId)
                         break
         else:
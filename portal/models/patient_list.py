@@ -1,5 +1,8 @@
 """Module for PatientList, used specifically to populate and page patients"""
 from datetime import datetime, timedelta
+from sqlalchemy import and_
+
+from ..cache import TWO_HOURS, cache
 from ..database import db
 from .research_study import BASE_RS_ID, EMPRO_RS_ID
 
@@ -32,10 +35,153 @@ class PatientList(db.Model):
     org_name = db.Column(db.Text, index=True)
     deleted = db.Column(db.Boolean, default=False)
     test_role = db.Column(db.Boolean)
-    org_id = db.Column(db.ForeignKey('organizations.id'))  # used for access control
+    org_id = db.Column(db.ForeignKey('organizations.id'), index=True)  # used for access control
     last_updated = db.Column(db.DateTime)
 
 
+class StaffOrgVisibility(db.Model):
+    """Materialized set of organizations a staff user may view in a list
+
+    Maintained by `viewable_org_ids()`, with a row for every organization
+    at or below the user's organizations, reduced by the user's org filter
+    preference for the research study's patient list.  Patient list queries
+    join on this table rather than passing a large literal list of org ids.
+    """
+    __tablename__ = 'staff_org_visibility'
+    user_id = db.Column(
+        db.ForeignKey('users.id', ondelete='cascade'), primary_key=True)
+    research_study_id = db.Column(db.Integer, primary_key=True)
+    org_id = db.Column(
+        db.ForeignKey('organizations.id', ondelete='cascade'),
+        primary_key=True)
+
+
+VIEWABLE_ORGS_KEY = "viewable_orgs:{user_id}:{research_study_id}"
+
+
+def viewable_org_ids(user, research_study_id):
+    """Returns set of org ids the user may view in the given patient list
+
+    Cached per user and research study, valid for the current org tree
+    version.  On a miss, the user's `StaffOrgVisibility` rows are rebuilt
+    to match.  Use `invalidate_viewable_orgs()` on any change to the user's
+    organizations or table preferences.
+    """
+    return _viewable_orgs(user, research_study_id)[0]
+
+
+def filter_viewable_orgs(query, user, research_study_id):
+    """Limit a PatientList query to patients of orgs the user may view
+
+    Joins on the user's `StaffOrgVisibility` rows, unless those couldn't be
+    brought up to date, in which case the org ids are filtered directly.
+
+    :returns: (filtered query, set of viewable org ids)
+    """
+    orgs, materialized = _viewable_orgs(user, research_study_id)
+    if materialized:
+        query = query.join(StaffOrgVisibility, and_(
+            StaffOrgVisibility.org_id == PatientList.org_id,
+            StaffOrgVisibility.user_id == user.id,
+            StaffOrgVisibility.research_study_id == research_study_id))
+    else:
+        query = query.filter(PatientList.org_id.in_(orgs))
+    return query, orgs
+
+
+def _viewable_orgs(user, research_study_id):
+    """Returns (viewable org ids, True if StaffOrgVisibility is current)"""
+    from .organization import OrgTree
+    from .table_preference import TablePreference
+    from ..timeout_lock import LockTimeout, TimeoutLock
+
+    tree = OrgTree()
+    key = VIEWABLE_ORGS_KEY.format(
+        user_id=user.id, research_study_id=research_study_id)
+    cached = cache.get(key)
+    if cached and cached['version'] == tree.version:
+        return cached['orgs'], True
+
+    # start with set of org ids the user has permission to view
+    viewable_orgs = set()
+    for org in user.organizations:
+        viewable_orgs.update(tree.here_and_below_id(org.id))
+
+    # reduce viewable orgs by filter preferences
+    table_name = (
+        'substudyPatientList' if research_study_id == EMPRO_RS_ID
+        else 'patientList')
+    pref = TablePreference.query.filter_by(
+        table_name=table_name, user_id=user.id).first()
+    if pref and pref.filters and pref.filters.get('orgs_filter_control'):
+        viewable_orgs = viewable_orgs.intersection(
+            pref.filters['orgs_filter_control'])
+
+    orgs = frozenset(viewable_orgs)
+    stored = False
+    try:
+        with TimeoutLock(key, expires=60, timeout=0):
+            StaffOrgVisibility.query.filter(
+                StaffOrgVisibility.user_id == user.id).filter(
+                StaffOrgVisibility.research_study_id == research_study_id
+            ).delete()
+            db.session.bulk_insert_mappings(StaffOrgVisibility, [
+                {'user_id': user.id, 'research_study_id': research_study_id,
+                 'org_id': org_id} for org_id in viewable_orgs])
+            db.session.commit()
+            stored = True
+    except LockTimeout:
+        # another request is rebuilding the same rows; don't wait on it
+        return orgs, False
+
+    if not stored:
+        # TimeoutLock traps and logs exceptions; leave uncached to retry
+        db.session.rollback()
+        return orgs, False
+    cache.set(
+        key, {'version': tree.version, 'orgs': orgs}, timeout=TWO_HOURS)
+    return orgs, True
+
+
+def invalidate_viewable_orgs(user_id):
+    """Invalidate cached viewable orgs, on change to user orgs or prefs"""
+    for research_study_id in (BASE_RS_ID, EMPRO_RS_ID):
+        cache.delete(VIEWABLE_ORGS_KEY.format(
+            user_id=user_id, research_study_id=research_study_id))
+
+
+# Columns offered as filter options in the patient lists, by research study
+OPTION_COLUMNS = {
+    BASE_RS_ID: ('questionnaire_status', 'visit'),
+    EMPRO_RS_ID: ('empro_status', 'action_state', 'empro_visit'),
+}
+
+
+@cache.memoize(timeout=TWO_HOURS)
+def patient_list_options(research_study_id):
+    """Returns distinct (untranslated) values for each filter option column
+
+    Cached, as the option lists span all patients, not just a page.
+    Invalidated by `patient_list_update_patient()` on any change to one
+    of the option columns.
+
+    :returns: dict keyed by column name, of distinct values with visits
+      ordered by month
+    """
+    options = {}
+    for column in OPTION_COLUMNS.get(research_study_id, OPTION_COLUMNS[BASE_RS_ID]):
+        attr = getattr(PatientList, column)
+        values = [
+            v for v, in PatientList.query.distinct(attr).with_entities(attr)]
+        if column.endswith('visit'):
+            values = sorted(
+                [v for v in values if v],
+                key=lambda x: (
+                    0 if not x.split()[-1].isdigit() else int(x.split()[-1])))
+        options[column] = values
+    return options
+
+
 def patient_list_update_patient(patient_id, research_study_id=None):
     """Update given patient
 
@@ -82,6 +228,9 @@ def patient_list_update_patient(patient_id, research_study_id=None):
             return
 
         patient.last_updated = now
+        prior_options = {
+            column: getattr(patient, column)
+            for columns in OPTION_COLUMNS.values() for column in columns}
         if research_study_id == BASE_RS_ID or research_study_id is None:
             rs_id = BASE_RS_ID
             qb_status = qb_status_visit_name(
@@ -103,3 +252,7 @@ def patient_list_update_patient(patient_id, research_study_id=None):
             patient.empro_consentdate, _ = consent_withdrawal_dates(
                 user=user, research_study_id=rs_id)
         db.session.commit()
+
+        if any(getattr(patient, column) != value
+               for column, value in prior_options.items()):
+            cache.delete_memoized(patient_list_options)
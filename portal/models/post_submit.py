@@ -0,0 +1,183 @@
+"""Post submit processing of QuestionnaireResponses
+
+Following the persistence of a new QuestionnaireResponse, a series of
+stages bring the patient's derived data in line: the QNR is associated with
+its questionnaire bank (visit), the patient's timeline is invalidated and
+the research data cache updated.
+
+With `ASYNC_QNR_SUBMIT` configured, `assessment_add` returns as soon as the
+QNR is persisted, queuing the stages as an ordered celery chain.  Until the
+chain completes, a pending recompute marker is held for the patient, so
+views requiring a consistent state, i.e. `/api/present-needed`, may run any
+outstanding stages inline via `complete_pending_recompute()`.
+
+Every stage is idempotent, safe to repeat should the chain and an inline
+recompute overlap.
+
+"""
+from time import perf_counter
+
+from flask import current_app
+
+from ..database import db
+from ..date_tools import FHIR_datetime
+from ..factories.redis import create_redis
+
+PENDING_RECOMPUTE_KEY = "qnr_pending_recompute:{patient_id}"
+PENDING_RECOMPUTE_EXPIRATION = 60 * 60  # one hour, in seconds
+
+
+def assign_qb_stage(context):
+    """Associate the QNR with its questionnaire bank and iteration"""
+    from .questionnaire_response import QuestionnaireResponse
+
+    qnr = QuestionnaireResponse.query.get(context['questionnaire_response_id'])
+    context['research_study_id'] = qnr.assign_qb_relationship(
+        acting_user_id=context['acting_user_id'])
+    db.session.commit()
+
+
+def invalidate_timeline_stage(context):
+    """Invalidate the patient's timeline from the QNR's authored date"""
+    from .qb_timeline import invalidate_users_QBT
+
+    if context.get('research_study_id') is None:
+        return
+    invalidate_users_QBT(
+        context['patient_id'],
+        research_study_id=context['research_study_id'],
+        since=FHIR_datetime.parse(context['authored']))
+
+
+def research_data_stage(context):
+    """Add the QNR to the research data cache, unless already present"""
+    from .questionnaire_response import QuestionnaireResponse
+    from .research_data import ResearchData, add_questionnaire_response
+
+    qnr_id = context['questionnaire_response_id']
+    if ResearchData.query.filter(
+            ResearchData.questionnaire_response_id == qnr_id).count():
+        return
+    add_questionnaire_response(
+        QuestionnaireResponse.query.get(qnr_id),
+        context.get('research_study_id'))
+
+
+# Ordered stages, by name for serialization within celery signatures
+POST_SUBMIT_STAGES = (
+    ('assign_qb', assign_qb_stage),
+    ('invalidate_timeline', invalidate_timeline_stage),
+    ('research_data', research_data_stage),
+)
+
+
+def post_submit_context(questionnaire_response, acting_user_id):
+    """Generate serializable context, shared and extended by each stage"""
+    return {
+        'questionnaire_response_id': questionnaire_response.id,
+        'patient_id': questionnaire_response.subject_id,
+        'acting_user_id': acting_user_id,
+        'authored': questionnaire_response.document['authored'],
+        'timings': {},
+    }
+
+
+def run_stage(context, stage):
+    """Run named stage, recording its duration in the context
+
+    On completion of the final stage, the QNR's pending recompute marker
+    is cleared and the stage timings logged.
+
+    :returns: the updated context, for the next stage in a chain
+    """
+    stage_fn = dict(POST_SUBMIT_STAGES)[stage]
+    start = perf_counter()
+    stage_fn(context)
+    context['timings'][stage] = round(perf_counter() - start, 3)
+
+    if stage == POST_SUBMIT_STAGES[-1][0]:
+        clear_pending(
+            context['patient_id'], context['questionnaire_response_id'])
+        current_app.logger.debug(
+            "post submit of QNR %d complete; stage timings %s",
+            context['questionnaire_response_id'], context['timings'])
+    return context
+
+
+def run_post_submit(questionnaire_response, acting_user_id):
+    """Run all post submit stages inline
+
+    :returns: the research study id assigned to the QNR, or None
+    """
+    context = post_submit_context(questionnaire_response, acting_user_id)
+    for stage, _ in POST_SUBMIT_STAGES:
+        run_stage(context, stage)
+    return context.get('research_study_id')
+
+
+def queue_post_submit(
+        questionnaire_response, acting_user_id, extract_observations=False):
+    """Mark patient pending recompute and queue the post submit chain
+
+    :param extract_observations: set to append observation extraction as
+      the final link, so it follows the QNR's assignment to a visit
+    """
+    from celery import chain
+    from ..tasks import extract_observations_task, post_submit_stage_task
+
+    context = post_submit_context(questionnaire_response, acting_user_id)
+    mark_pending(context['patient_id'], context['questionnaire_response_id'])
+    stages = [stage for stage, _ in POST_SUBMIT_STAGES]
+    links = [
+        post_submit_stage_task.s(context, stage=stages[0]),
+        *(post_submit_stage_task.s(stage=stage) for stage in stages[1:])]
+    if extract_observations:
+        links.append(extract_observations_task.si(
+            questionnaire_response_id=context['questionnaire_response_id']))
+    chain(*links).apply_async()
+
+
+def mark_pending(patient_id, questionnaire_response_id):
+    """Record the QNR as awaiting post submit processing"""
+    rs = create_redis(current_app.config['REDIS_URL'])
+    key = PENDING_RECOMPUTE_KEY.format(patient_id=patient_id)
+    pipe = rs.pipeline()
+    pipe.sadd(key, questionnaire_response_id)
+    pipe.expire(key, PENDING_RECOMPUTE_EXPIRATION)
+    pipe.execute()
+
+
+def clear_pending(patient_id, questionnaire_response_id):
+    """Remove the QNR from the patient's pending recompute marker"""
+    rs = create_redis(current_app.config['REDIS_URL'])
+    rs.srem(
+        PENDING_RECOMPUTE_KEY.format(patient_id=patient_id),
+        questionnaire_response_id)
+
+
+def pending_qnr_ids(patient_id):
+    """Returns ids of the patient's QNRs awaiting post submit processing"""
+    rs = create_redis(current_app.config['REDIS_URL'])
+    return sorted(int(i) for i in rs.smembers(
+        PENDING_RECOMPUTE_KEY.format(patient_id=patient_id)))
+
+
+def complete_pending_recompute(patient_id, acting_user_id):
+    """Run any outstanding post submit stages for the patient inline
+
+    Used where a consistent state is required before the queued chain
+    may have completed.  Stages are idempotent, so overlap with a running
+    chain is safe.
+
+    :returns: number of QNRs processed
+    """
+    from .questionnaire_response import QuestionnaireResponse
+
+    qnr_ids = pending_qnr_ids(patient_id)
+    for qnr_id in qnr_ids:
+        qnr = QuestionnaireResponse.query.get(qnr_id)
+        if not qnr:
+            clear_pending(patient_id, qnr_id)
+            continue
+        run_post_submit(qnr, acting_user_id)
+    return len(qnr_ids)
@@ -0,0 +1,235 @@
+"""Protocol Schedule module
+
+Every patient on a given research protocol shares the same sequence of
+questionnaire bank visits, differing only by the patient's trigger date.
+A ``ProtocolSchedule`` captures that sequence once, per (research protocol,
+classification), as parallel tuples of relative offsets, which are then
+shifted by each patient's trigger date.
+
+"""
+from datetime import datetime
+from uuid import uuid4
+
+from dateutil.relativedelta import relativedelta
+
+from ..cache import cache
+from ..database import db
+from ..date_tools import RelativeDelta
+from .qbd import QBD
+from .questionnaire_bank import QuestionnaireBank, qbs_by_id, qbs_by_rp
+
+# Arbitrary trigger used to bound recurrences when compiling; precise
+# termination is re-evaluated against each patient's trigger date
+REFERENCE_TRIGGER = datetime(year=2000, month=1, day=1)
+
+# Compiled recurrences include any iteration starting within this buffer
+# of the reference termination, as month lengths vary by trigger date
+TERMINATION_BUFFER = relativedelta(months=1)
+
+VERSION_KEY = 'protocol_schedule_version'
+
+
+def shared_version():
+    """Returns version shared by all processes, for process wide caches
+
+    A change to the shared version, see ``ProtocolSchedule.invalidate_cache``,
+    signals every process to discard compiled schedules and registered QBs.
+
+    """
+    current = cache.get(VERSION_KEY)
+    if current is None:
+        # first use, or the shared cache was cleared
+        current = uuid4().hex
+        cache.set(VERSION_KEY, current, timeout=0)
+    return current
+
+
+class ProtocolSchedule(object):
+    """Immutable, trigger date independent QB schedule for a protocol
+
+    Use ``ProtocolSchedule.lookup()`` to obtain the process wide cached
+    instance; shift by a patient's trigger date via ``qbds()``.
+
+    Rather than the date math performed in ``QuestionnaireBank`` on each
+    call, entries hold the parsed ``RelativeDelta`` offsets, applied in
+    order to the trigger date to obtain the start.  Entries are in
+    definition order, i.e. QB then iteration.
+
+    """
+    # process wide cache, keyed by (rp_id, classification)
+    _schedules = {}
+    _version = None
+    VERSION_KEY = VERSION_KEY
+
+    __slots__ = (
+        'rp_id', 'classification', 'qbs', 'qb_index', 'iterations',
+        'recur_ids', 'offsets', 'terminations')
+
+    def __init__(self, rp_id, classification):
+        """Compile schedule from the protocol's questionnaire banks"""
+        qbs, qb_index, iterations, recur_ids = [], [], [], []
+        offsets, terminations = [], []
+
+        for qb in qbs_by_rp(rp_id, classification):
+            qbs.append(qb)
+            start = RelativeDelta(qb.start)
+            if classification != 'recurring':
+                qb_index.append(len(qbs) - 1)
+                iterations.append(None)
+                recur_ids.append(None)
+                offsets.append((start,))
+                terminations.append(None)
+                continue
+
+            for recur in qb.recurs:
+                recur_start = RelativeDelta(recur.start)
+                cycle_length = RelativeDelta(recur.cycle_length)
+                termination = RelativeDelta(recur.termination)
+                term_date = REFERENCE_TRIGGER + termination
+                ic = 0
+                while True:
+                    offset = (start, recur_start, ic * cycle_length)
+                    ref_start = REFERENCE_TRIGGER
+                    for delta in offset:
+                        ref_start = ref_start + delta
+                    if ref_start > term_date + TERMINATION_BUFFER:
+                        break
+                    qb_index.append(len(qbs) - 1)
+                    iterations.append(ic)
+                    recur_ids.append(recur.id)
+                    offsets.append(offset)
+                    terminations.append(termination)
+                    ic += 1
+
+        self.rp_id = rp_id
+        self.classification = classification
+        self.qbs = tuple(qbs)
+        self.qb_index = tuple(qb_index)
+        self.iterations = tuple(iterations)
+        self.recur_ids = tuple(recur_ids)
+        self.offsets = tuple(offsets)
+        self.terminations = tuple(terminations)
+
+    def __len__(self):
+        return len(self.qb_index)
+
+    def __repr__(self):
+        return "ProtocolSchedule rp {} {}: {} entries".format(
+            self.rp_id, self.classification, len(self))
+
+    @classmethod
+    def lookup(cls, rp_id, classification):
+        """Return the cached schedule, compiling if necessary"""
+        current = shared_version()
+        if current != cls._version:
+            # another process invalidated, or the shared cache was cleared
+            cls._schedules = {}
+            cls._version = current
+
+        key = (rp_id, classification)
+        if key not in cls._schedules:
+            cls._schedules[key] = cls(rp_id, classification)
+        return cls._schedules[key]
+
+    @classmethod
+    def invalidate_cache(cls):
+        """Invalidate cache in this and all other processes
+
+        Required on any change to questionnaire banks, their recurrences
+        or research protocols.
+
+        """
+        cache.delete_memoized(qbs_by_rp)
+        cache.delete_memoized(qbs_by_id)
+        cache.set(cls.VERSION_KEY, uuid4().hex, timeout=0)
+        cls._schedules = {}
+        cls._version = None
+        QBRegistry._qbs = {}
+        QBRegistry._version = None
+
+    def session_qbs(self):
+        """Return the schedule's QBs, merged into the current session
+
+        NB - cached QBs outlive the session they were loaded in
+
+        """
+        return [
+            qb if qb in db.session else db.session.merge(qb, load=False)
+            for qb in self.qbs]
+
+    def qbds(self, trigger_date):
+        """Returns list of QBDs for schedule shifted by trigger_date
+
+        :param trigger_date: initial trigger utc time value
+        :returns: QBD for each entry in definition order, excluding any
+          recurrences terminated by the given trigger date
+
+        """
+        qbs = self.session_qbs()
+        results = []
+        for i, offset in enumerate(self.offsets):
+            start = trigger_date
+            for delta in offset:
+                start = start + delta
+            termination = self.terminations[i]
+            if termination is not None and start > trigger_date + termination:
+                continue
+            results.append(QBD(
+                relative_start=start,
+                iteration=self.iterations[i],
+                recur_id=self.recur_ids[i],
+                questionnaire_bank=qbs[self.qb_index[i]]))
+        return results
+
+
+class QBRegistry(object):
+    """Process wide registry of questionnaire banks by id
+
+    Timeline rows reference questionnaire banks and recurrences by id.
+    Resolving those through the registry, rather than the lazy load on each
+    ``QBD``, avoids a query per row.  Shares invalidation with
+    ``ProtocolSchedule``.
+
+    """
+    _qbs = {}
+    _version = None
+
+    @classmethod
+    def questionnaire_bank(cls, qb_id):
+        """Return the QB with given id, in the current session, or None"""
+        current = shared_version()
+        if current != cls._version:
+            cls._qbs = {}
+            cls._version = current
+        if not cls._qbs:
+            cls._qbs = qbs_by_id()
+        if qb_id not in cls._qbs:
+            # an unknown QB implies the memoized set predates it
+            cache.delete_memoized(qbs_by_id)
+            cls._qbs = qbs_by_id()
+        qb = cls._qbs.get(qb_id)
+        if qb is None:
+            return None
+
+        # prefer any instance already in the session, potentially modified
+        present = db.session.identity_map.get(
+            db.session.identity_key(QuestionnaireBank, qb_id))
+        if present is not None:
+            return present
+        return db.session.merge(qb, load=False)
+
+    @classmethod
+    def qbd(cls, relative_start, qb_id, iteration, recur_id):
+        """Return QBD with QB and recurrence resolved from the registry"""
+        qb = cls.questionnaire_bank(qb_id)
+        if qb is None:
+            return QBD(
+                relative_start=relative_start, iteration=iteration,
+                recur_id=recur_id, qb_id=qb_id)
+        recur = next((r for r in qb.recurs if r.id == recur_id), None)
+        return QBD(
+            relative_start=relative_start,
+            iteration=iteration,
+            recur=recur,
+            recur_id=None if recur else recur_id,
+            questionnaire_bank=qb)
@@ -4,9 +4,11 @@ API to lookup user's status with respect to assigned questionnaire banks.
 
 """
 from flask import current_app
+
+from ..scoped_cache import scoped_get, scoped_set
 from ..trace import trace
 from .overall_status import OverallStatus
-from .qb_timeline import QBT, ordered_qbs, update_users_QBT
+from .qb_timeline import TimelineSnapshot, ordered_qbs, update_users_QBT
 from .questionnaire_response import (
     QNR_indef_results,
     QNR_results,
@@ -22,6 +24,13 @@ class NoCurrentQB(Exception):
 class QB_Status(object):
 
     def __init__(self, user, research_study_id, as_of_date):
+        cached = scoped_get(
+            'QB_Status', user.id, research_study_id, as_of_date)
+        if cached is not None:
+            self.__dict__.update(cached.__dict__)
+            self.user = user
+            return
+
         self.user = user
         self.as_of_date = as_of_date
         self.at_least_one_completed = False
@@ -34,6 +43,7 @@ class QB_Status(object):
         self._current = None
         self._sync_timeline()
         self._indef_init()
+        scoped_set('QB_Status', user.id, research_study_id, as_of_date, self)
 
     def _sync_timeline(self):
         """Sync QB timeline and obtain status"""
@@ -42,27 +52,19 @@ class QB_Status(object):
         # Update QB_Timeline for user, if necessary
         update_users_QBT(self.user.id, self.research_study_id)
 
-        # Every QB should have "due" - filter by to get one per QB
-        users_qbs = QBT.query.filter(QBT.user_id == self.user.id).filter(
-            QBT.research_study_id == self.research_study_id).filter(
-            QBT.status == OverallStatus.due).order_by(QBT.at.asc())
-
-        completed = QBT.query.filter(QBT.user_id == self.user.id).filter(
-            QBT.research_study_id == self.research_study_id).filter(
-            QBT.status == OverallStatus.completed).with_entities(QBT.id).first()
-        self.at_least_one_completed = completed is not None
+        # All further timeline lookups use the snapshot, a single query
+        self._timeline = TimelineSnapshot(
+            self.user.id, self.research_study_id)
+        self.at_least_one_completed = self._timeline.at_least_one_completed
 
         # Obtain withdrawal date if applicable
-        withdrawn = QBT.query.filter(QBT.user_id == self.user.id).filter(
-            QBT.research_study_id == self.research_study_id).filter(
-            QBT.status == OverallStatus.withdrawn).first()
-        self._withdrawal_date = withdrawn.at if withdrawn else None
+        self._withdrawal_date = self._timeline.withdrawal_date
         if self.withdrawn_by(self.as_of_date):
             self._overall_status = OverallStatus.withdrawn
             trace("found user withdrawn")
 
-        # convert query to list of tuples for easier manipulation
-        self.__ordered_qbs = [qbt.qbd() for qbt in users_qbs]
+        # Every QB should have "due" - one QBD per QB, in order
+        self.__ordered_qbs = self._timeline.ordered_qbds()
         if not self.__ordered_qbs:
             # May have withdrawn prior to first qb
             if self._withdrawal_date:
@@ -115,14 +117,9 @@ class QB_Status(object):
 
     def _status_from_current(self, cur_qbd):
         """Obtain status from QB timeline given current QBD"""
-        # We order by at (to get the latest status for a given QB) and
-        # secondly by id, as on rare occasions, the time (`at`) of
-        #  `due` == `completed`, but the row insertion defines priority
-        cur_rows = QBT.query.filter(QBT.user_id == self.user.id).filter(
-            QBT.qb_id == cur_qbd.qb_id).filter(
-            QBT.qb_recur_id == cur_qbd.recur_id).filter(
-            QBT.qb_iteration == cur_qbd.iteration).order_by(
-            QBT.at, QBT.id)
+        # Snapshot rows are ordered by at (to get the latest status for a
+        # given QB) and secondly by id, see ``TimelineSnapshot``
+        cur_rows = self._timeline.visit_rows(cur_qbd)
 
         # If the user has withdrawn, don't update status beyond the user's
         # withdrawal date.
@@ -191,23 +188,13 @@ class QB_Status(object):
         while index > 0:
             index -= 1
             cur_qbd = self.__ordered_qbs[index]
-            # We order by at (to get the latest status for a given QB) and
-            # secondly by id, as on rare occasions, the time (`at`) of
-            #  `due` == `completed`, but the row insertion defines priority
-            status = QBT.query.filter(QBT.user_id == self.user.id).filter(
-                QBT.qb_id == cur_qbd.qb_id).filter(
-                QBT.qb_recur_id == cur_qbd.recur_id).filter(
-                QBT.qb_iteration == cur_qbd.iteration).order_by(
-                QBT.at.desc(), QBT.id.desc()).with_entities(
-                QBT.status).first()
-            # production errors seen, where qb_timeline loses data.  likely
-            # a race condition where adherence cache is using timeline rows
-            # when another thread purges the user's timeline.  log and exit
-            if status is None:
+            # Latest status for the visit is that of its last ordered row
+            rows = self._timeline.visit_rows(cur_qbd)
+            if not rows:
                 current_app.logger.info(
-                    f"timeline data disappeared mid loop {self.user.id}: {QBT}")
+                    f"timeline data missing for {self.user.id}: {cur_qbd}")
                 return
-            yield self.__ordered_qbs[index], str(status[0])
+            yield self.__ordered_qbs[index], str(rows[-1].status)
 
     def _indef_init(self):
         """Lookup stats for indefinite case - requires special handling"""
@@ -511,9 +498,7 @@ class QB_Status(object):
         query = QuestionnaireResponse.query.filter(
             QuestionnaireResponse.subject_id == self.user.id).filter(
             QuestionnaireResponse.status == 'completed').filter(
-            QuestionnaireResponse.document[
-                ('questionnaire', 'reference')].astext.endswith(
-                requested_indef)).count()
+            QuestionnaireResponse.instrument_id == requested_indef).count()
         if query != 0:
             current_app.logger.error(
                 f"Caught TN-2747 in action!  User {self.user.id} completed"
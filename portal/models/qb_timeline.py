@@ -1,10 +1,16 @@
+from bisect import bisect_right
 from collections import namedtuple
+from contextlib import ExitStack
+import csv
 from datetime import MAXYEAR, datetime
+from io import StringIO
 from time import sleep
 
 from dateutil.relativedelta import relativedelta
 from flask import current_app
 from redis.exceptions import ConnectionError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import selectinload
 from sqlalchemy.types import Enum as SQLA_Enum
 from werkzeug.exceptions import BadRequest
 
@@ -13,15 +19,22 @@ from ..cache import cache, TWO_HOURS
 from ..database import db
 from ..date_tools import FHIR_datetime, RelativeDelta
 from ..factories.redis import create_redis
+from ..patient_generation import bump_generation, generation
+from ..scoped_cache import invalidate_scoped
 from ..set_tools import left_center_right
-from ..timeout_lock import ADHERENCE_DATA_KEY, CacheModeration, TimeoutLock
+from ..timeout_lock import (
+    ADHERENCE_DATA_KEY,
+    CacheModeration,
+    LockTimeout,
+    TimeoutLock,
+)
 from ..trace import trace
 from .adherence_data import AdherenceData
 from .overall_status import OverallStatus
+from .protocol_schedule import ProtocolSchedule, QBRegistry
 from .qbd import QBD
 from .questionnaire_bank import (
     qbs_by_intervention,
-    qbs_by_rp,
     trigger_date,
     visit_name,
 )
@@ -47,9 +60,15 @@ class QBT(db.Model):
 
     """
     __tablename__ = 'qb_timeline'
+    # Covers the (user, study[, status]) lookups, ordered by `at`.  See
+    # migration, which extends with INCLUDE (qb_id, qb_iteration,
+    # qb_recur_id) for index only scans
+    __table_args__ = (db.Index(
+        'ix_qb_timeline_user_rs_status_at',
+        'user_id', 'research_study_id', 'status', 'at'),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.ForeignKey(
-        'users.id', ondelete='cascade'), nullable=False, index=True)
+        'users.id', ondelete='cascade'), nullable=False)
     at = db.Column(
         db.DateTime, nullable=False, index=True,
         doc="initial date time for state of row")
@@ -104,6 +123,141 @@ class QBT(db.Model):
         return results
 
 
+QBT_COLUMNS = (
+    'user_id', 'at', 'qb_id', 'qb_recur_id', 'qb_iteration', 'status',
+    'research_study_id')
+
+
+def insert_qbt_rows(rows):
+    """Bulk write new QBT rows within the session's transaction
+
+    As ties on `at` are broken by `id`, rows are written in the order given.
+    Up to `QBT_COPY_THRESHOLD` rows are written with a single multi-row
+    INSERT, larger sets are streamed with COPY.  Either is a single round
+    trip, unlike the per object INSERT of ``session.add_all()``.
+
+    :param rows: new (transient) QBT instances, not added to the session
+    :returns: number of rows written
+
+    """
+    if not rows:
+        return 0
+
+    def value(qbt, column):
+        v = getattr(qbt, column)
+        return v.name if isinstance(v, OverallStatus) else v
+
+    if len(rows) <= current_app.config['QBT_COPY_THRESHOLD']:
+        db.session.execute(QBT.__table__.insert().values([
+            {c: value(qbt, c) for c in QBT_COLUMNS} for qbt in rows]))
+        return len(rows)
+
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    for qbt in rows:
+        # csv format treats unquoted empty values as NULL
+        writer.writerow(['' if v is None else v for v in (
+            value(qbt, c) for c in QBT_COLUMNS)])
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        "COPY qb_timeline ({}) FROM STDIN WITH (FORMAT csv)".format(
+            ', '.join(QBT_COLUMNS)), buffer)
+    return len(rows)
+
+
+def qbt_bloat_report():
+    """Report on dead tuples and size of qb_timeline and its indexes
+
+    Timelines are deleted and rebuilt on every invalidation, leaving dead
+    tuples for vacuum.  Statistics are from the cumulative statistics
+    views; with the pgstattuple extension installed, measured free space
+    and leaf density are included.
+
+    :returns: dictionary with 'table' and 'indexes' details
+
+    """
+    table = dict(db.session.execute("""
+        SELECT n_live_tup AS live_tuples, n_dead_tup AS dead_tuples,
+          round(100.0 * n_dead_tup / greatest(n_live_tup + n_dead_tup, 1), 1)
+            AS dead_percent,
+          pg_size_pretty(pg_table_size(relid)) AS table_size,
+          pg_size_pretty(pg_indexes_size(relid)) AS indexes_size,
+          last_vacuum, last_autovacuum, last_analyze, last_autoanalyze
+        FROM pg_stat_user_tables WHERE relname = 'qb_timeline'
+        """).first() or {})
+    indexes = [dict(row) for row in db.session.execute("""
+        SELECT indexrelname AS name, idx_scan AS scans,
+          pg_size_pretty(pg_relation_size(indexrelid)) AS size
+        FROM pg_stat_user_indexes WHERE relname = 'qb_timeline'
+        ORDER BY indexrelname
+        """)]
+
+    pgstattuple = db.session.execute(
+        "SELECT 1 FROM pg_extension WHERE extname = 'pgstattuple'").first()
+    if pgstattuple:
+        table.update(dict(db.session.execute("""
+            SELECT round(free_percent::numeric, 1) AS free_percent
+            FROM pgstattuple_approx('qb_timeline')""").first()))
+        for index in indexes:
+            index.update(dict(db.session.execute("""
+                SELECT round(avg_leaf_density::numeric, 1)
+                  AS avg_leaf_density,
+                round(leaf_fragmentation::numeric, 1) AS leaf_fragmentation
+                FROM pgstatindex(:name)""", {'name': index['name']}).first()))
+    return {'table': table, 'indexes': indexes}
+
+
+TimelineRow = namedtuple(
+    'TimelineRow', ('at', 'status', 'qb_id', 'iteration', 'recur_id'))
+
+
+class TimelineSnapshot(object):
+    """Compact, ordered view of a user's QBT rows for a research study
+
+    Loaded with a single query, ordered by ``at`` and secondly by ``id``,
+    as on rare occasions the time (`at`) of `due` == `completed`, but the
+    row insertion defines priority.  Questionnaire banks are resolved via
+    the process wide ``QBRegistry``, so lookups against the snapshot
+    require no further round trips.
+
+    """
+
+    def __init__(self, user_id, research_study_id):
+        self.user_id = user_id
+        self.research_study_id = research_study_id
+        self.rows = tuple(TimelineRow(*row) for row in QBT.query.filter(
+            QBT.user_id == user_id).filter(
+            QBT.research_study_id == research_study_id).with_entities(
+            QBT.at, QBT.status, QBT.qb_id, QBT.qb_iteration,
+            QBT.qb_recur_id).order_by(QBT.at, QBT.id))
+
+    @property
+    def at_least_one_completed(self):
+        return any(r.status == OverallStatus.completed for r in self.rows)
+
+    @property
+    def withdrawal_date(self):
+        """Returns time of withdrawal, or None if not withdrawn"""
+        return next((
+            r.at for r in self.rows if r.status == OverallStatus.withdrawn),
+            None)
+
+    def ordered_qbds(self):
+        """Returns list of QBDs, one per visit (`due` row), in order"""
+        return [
+            QBRegistry.qbd(
+                relative_start=r.at, qb_id=r.qb_id, iteration=r.iteration,
+                recur_id=r.recur_id)
+            for r in self.rows if r.status == OverallStatus.due]
+
+    def visit_rows(self, qbd):
+        """Returns ordered rows for the visit defined by given QBD"""
+        return [r for r in self.rows if (
+            r.qb_id == qbd.qb_id and r.recur_id == qbd.recur_id and
+            r.iteration == qbd.iteration)]
+
+
 class AtOrderedList(list):
     """Specialize ``list`` to maintain insertion order and ``at`` attribute
 
@@ -152,27 +306,19 @@ class AtOrderedList(list):
 
 def ordered_rp_qbs(rp_id, trigger_date):
     """Generator to yield ordered qbs by research protocol alone"""
-    baselines = qbs_by_rp(rp_id, 'baseline')
-    if len(baselines) > 1:
+    baseline = ProtocolSchedule.lookup(rp_id, 'baseline')
+    if len(baseline) > 1:
         raise RuntimeError(
             "Expect exactly one QB for baseline by rp {}".format(rp_id))
-    if len(baselines) == 0:
+    if len(baseline) == 0:
         # typically only test scenarios - easy catch otherwise
         return
-    baseline = baselines[0]
-    if baseline not in db.session:
-        baseline = db.session.merge(baseline, load=False)
-    start = baseline.calculated_start(trigger_date=trigger_date)
-    yield start
+    yield baseline.qbds(trigger_date)[0]
 
     qbs_by_start = {}
-    recurring = qbs_by_rp(rp_id, 'recurring')
-    for qb in recurring:
-        if qb not in db.session:
-            qb = db.session.merge(qb, load=False)
-
-        for qbd in qb.recurring_starts(trigger_date):
-            qbs_by_start[qbd.relative_start] = qbd
+    recurring = ProtocolSchedule.lookup(rp_id, 'recurring')
+    for qbd in recurring.qbds(trigger_date):
+        qbs_by_start[qbd.relative_start] = qbd
 
     # continue to yield in order
     trace("found {} total recurring QBs".format(len(qbs_by_start)))
@@ -216,12 +362,9 @@ def indef_qbs_by_rp(rp_id, trigger_date):
     pattern to facilitate polymorphic code.
 
     """
-    indefinites = qbs_by_rp(rp_id, 'indefinite')
-    for indefinite in indefinites:
-        if indefinite not in db.session:
-            indefinite = db.session.merge(indefinite, load=False)
-        start = indefinite.calculated_start(trigger_date=trigger_date)
-        yield start
+    indefinite = ProtocolSchedule.lookup(rp_id, 'indefinite')
+    for qbd in indefinite.qbds(trigger_date):
+        yield qbd
 
 
 def indef_intervention_qbs(user, trigger_date):
@@ -327,7 +470,9 @@ def second_null_safe_datetime(x):
 RPD = namedtuple("RPD", ['rp', 'retired', 'qbds'])
 
 
-def cur_next_rp_gen(user, research_study_id, classification, trigger_date):
+def cur_next_rp_gen(
+        user, research_study_id, classification, trigger_date,
+        assigned_rps=None):
     """Generator to manage transitions through research protocols
 
     Returns a *pair* of research protocol data (RPD) namedtuples,
@@ -337,11 +482,15 @@ def cur_next_rp_gen(user, research_study_id, classification, trigger_date):
     :param research_study_id: study being processed
     :param classification: None or 'indefinite' for special handling
     :param trigger_date: patient's initial trigger date
+    :param assigned_rps: optional preloaded result from
+      ``ResearchProtocol.assigned_to()``, looked up if not provided
 
     :yields: cur_RPD, next_RPD
 
     """
-    rps = ResearchProtocol.assigned_to(user, research_study_id)
+    rps = assigned_rps
+    if rps is None:
+        rps = ResearchProtocol.assigned_to(user, research_study_id)
     sorted_rps = sorted(
         list(rps), key=second_null_safe_datetime, reverse=True)
 
@@ -392,12 +541,15 @@ class RP_flyweight(object):
 
     """
 
-    def __init__(self, user, trigger_date, research_study_id, classification):
+    def __init__(
+            self, user, trigger_date, research_study_id, classification,
+            assigned_rps=None):
         """Initialize flyweight state
         :param user: the patient
         :param trigger_date: the patient's initial trigger date
         :param research_study_id: the study being processed
         :param classification: `indefinite` or None
+        :param assigned_rps: optional preloaded research protocols
         """
         self.user = user
         self.td = trigger_date
@@ -407,7 +559,8 @@ class RP_flyweight(object):
             user=self.user,
             research_study_id=self.research_study_id,
             trigger_date=self.td,
-            classification=self.classification)
+            classification=self.classification,
+            assigned_rps=assigned_rps)
         self.cur_rpd, self.nxt_rpd = next(self.rp_walker, (None, None))
         self.skipped_nxt_start = None
 
@@ -580,7 +733,9 @@ class RP_flyweight(object):
         self.skipped_nxt_start = None
 
 
-def ordered_qbs(user, research_study_id, classification=None):
+def ordered_qbs(
+        user, research_study_id, classification=None, user_qnrs=None,
+        assigned_rps=None):
     """Generator to yield ordered qbs for a user, research_study
 
     This does NOT include the indefinite classification unless requested,
@@ -589,6 +744,9 @@ def ordered_qbs(user, research_study_id, classification=None):
     :param user: the user to look up
     :param research_study_id: the research study being processed
     :param classification: set to ``indefinite`` for that special handling
+    :param user_qnrs: optional ``QNR_results`` to share with the caller
+    :param assigned_rps: optional preloaded result from
+      ``ResearchProtocol.assigned_to()``
     :returns: QBD for each (QB, iteration, recur)
 
     """
@@ -617,10 +775,12 @@ def ordered_qbs(user, research_study_id, classification=None):
         user=user,
         trigger_date=td,
         research_study_id=research_study_id,
-        classification=classification)
+        classification=classification,
+        assigned_rps=assigned_rps)
 
     if rp_flyweight.cur_rpd:
-        user_qnrs = QNR_results(user, research_study_id=research_study_id)
+        if user_qnrs is None:
+            user_qnrs = QNR_results(user, research_study_id=research_study_id)
         rp_flyweight.next_qbd()
 
         if not rp_flyweight.cur_qbd:
@@ -741,35 +901,203 @@ def ordered_qbs(user, research_study_id, classification=None):
             yield qbd
 
 
-def invalidate_users_QBT(user_id, research_study_id):
+class TimelineResumePoint(db.Model):
+    """Row marking a user's timeline as valid only prior to a point in time
+
+    Written in the same transaction as the deletion of the timeline suffix,
+    so a truncated timeline is never mistaken for a current one.  See
+    ``QBT_ResumePoint``.
+
+    """
+    __tablename__ = 'qb_timeline_resume_points'
+    user_id = db.Column(
+        db.ForeignKey('users.id', ondelete='cascade'), primary_key=True)
+    research_study_id = db.Column(
+        db.ForeignKey('research_studies.id', ondelete='cascade'),
+        primary_key=True)
+    resume_from = db.Column(db.DateTime, nullable=False)
+
+
+class QBT_ResumePoint(object):
+    """Marks a user's timeline as valid only prior to a point
+
+    An incremental invalidation (see ``invalidate_users_QBT(since=...)``)
+    retains the QBT rows preceding the first point in time affected by a
+    change.  A ``TimelineResumePoint`` row holds that point, so the next
+    ``update_users_QBT`` knows to regenerate only the remaining suffix,
+    rather than treat the truncated timeline as current.
+
+    Changes are made within the active session, committed along with the
+    respective QBT rows.
+
+    """
+
+    def __init__(self, user_id, research_study_id):
+        self.user_id = user_id
+        self.research_study_id = research_study_id
+
+    def _query(self):
+        return TimelineResumePoint.query.filter(
+            TimelineResumePoint.user_id == self.user_id).filter(
+            TimelineResumePoint.research_study_id == self.research_study_id)
+
+    def value(self):
+        """Returns datetime from which the timeline requires rebuild or None"""
+        row = self._query().with_entities(
+            TimelineResumePoint.resume_from).first()
+        if row:
+            return row.resume_from
+
+    def update(self, value):
+        """Record value, unless an earlier resume point is already held"""
+        statement = insert(TimelineResumePoint.__table__).values(
+            user_id=self.user_id, research_study_id=self.research_study_id,
+            resume_from=value)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['user_id', 'research_study_id'],
+            set_={'resume_from': db.func.least(
+                TimelineResumePoint.__table__.c.resume_from,
+                statement.excluded.resume_from)}))
+        return self.value()
+
+    def reset(self):
+        self._query().delete(synchronize_session=False)
+
+    @classmethod
+    def pending(cls, user_ids, research_study_id):
+        """Returns the subset of user_ids holding a resume point"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        return {row.user_id for row in TimelineResumePoint.query.filter(
+            TimelineResumePoint.user_id.in_(user_ids)).filter(
+            TimelineResumePoint.research_study_id == research_study_id
+        ).with_entities(TimelineResumePoint.user_id)}
+
+
+def timeline_cutoff(user_id, research_study_id, since):
+    """Locate earliest point of user's timeline affected by a change at `since`
+
+    A change, such as a QuestionnaireResponse authored at `since`, alters the
+    rows of the visit(s) whose window contains `since` and potentially all
+    subsequent rows.  As overlapping visits interleave rows, the cutoff is
+    moved back until no visit starting before the cutoff has rows at or
+    after it, i.e. the rows prior to the cutoff are exactly those of visits
+    unaffected by the change.
+
+    :param user_id: subject of the timeline
+    :param research_study_id: research study of the timeline
+    :param since: datetime of the earliest change
+    :returns: datetime from which rows must be regenerated, or None if the
+      change can't be placed after the start of the existing timeline,
+      implying a full rebuild
+
+    """
+    from .questionnaire_bank import QuestionnaireBank
+
+    rows = QBT.query.filter(QBT.user_id == user_id).filter(
+        QBT.research_study_id == research_study_id).filter(
+        QBT.status != OverallStatus.withdrawn).with_entities(
+        QBT.at, QBT.qb_id, QBT.qb_iteration).order_by(QBT.at, QBT.id)
+
+    # visits keyed by (qb_id, iteration) -> [first at, last at]
+    visits = {}
+    for at, qb_id, iteration in rows:
+        key = (qb_id, iteration)
+        if key in visits:
+            visits[key][1] = at
+        else:
+            visits[key] = [at, at]
+    if not visits:
+        return None
+
+    expired = dict(QuestionnaireBank.query.filter(
+        QuestionnaireBank.id.in_({key[0] for key in visits})).with_entities(
+        QuestionnaireBank.id, QuestionnaireBank.expired))
+
+    # start of any visit with a defined window containing `since`
+    cutoff = None
+    for (qb_id, _), (start, _) in visits.items():
+        if start <= since < start + RelativeDelta(expired[qb_id]):
+            cutoff = start if cutoff is None else min(cutoff, start)
+    if cutoff is None:
+        # late change, outside all windows; use last visit started prior
+        started = [start for start, _ in visits.values() if start <= since]
+        if not started:
+            return None
+        cutoff = max(started)
+
+    while True:
+        earliest = min(
+            start for start, last in visits.values() if last >= cutoff)
+        if earliest >= cutoff:
+            break
+        cutoff = earliest
+
+    if cutoff <= min(start for start, _ in visits.values()):
+        return None
+    return cutoff
+
+
+def invalidate_users_QBT(user_id, research_study_id, since=None):
     """invalidate the given user's QBT rows and related cached data, by deletion
 
     This also clears a users cached adherence and research data rows from their
-    respective caches.
+    respective caches, and any results memoized for the user within the
+    active request or task scope.
 
     :param user_id: user for whom to purge all QBT rows
     :param research_study_id: set to limit invalidation to research study or
       use string 'all' to invalidate all QBT rows for a user
+    :param since: optional datetime of the earliest change, such as a
+      QuestionnaireResponse authored date or a research protocol retirement.
+      When given, only the rows from the first visit affected by the change
+      are purged, and the subsequent ``update_users_QBT`` regenerates just
+      that suffix.  Falls back to full invalidation if the change predates
+      the existing timeline.  Not applicable with research_study_id 'all'.
 
     """
     if research_study_id is None:
         raise ValueError('research_study_id must be defined or use "all"')
+
+    invalidate_scoped(user_id, research_study_id=research_study_id)
+    cutoff = None
+    if since is not None and research_study_id != 'all':
+        cutoff = timeline_cutoff(user_id, research_study_id, since)
+
     if research_study_id == 'all':
         QBT.query.filter(QBT.user_id == user_id).delete()
+        TimelineResumePoint.query.filter(
+            TimelineResumePoint.user_id == user_id).delete()
         AdherenceData.query.filter(
             AdherenceData.patient_id == user_id).delete()
         ResearchData.query.filter(ResearchData.subject_id == user_id).delete()
     else:
-        QBT.query.filter(QBT.user_id == user_id).filter(
-            QBT.research_study_id == research_study_id).delete()
+        qbts = QBT.query.filter(QBT.user_id == user_id).filter(
+            QBT.research_study_id == research_study_id)
+        research_data = ResearchData.query.filter(
+            ResearchData.subject_id == user_id).filter(
+            ResearchData.research_study_id == research_study_id)
+        if cutoff:
+            # retain rows prior to cutoff; withdrawn is always regenerated
+            trace("invalidating {}:{} timeline from {}".format(
+                user_id, research_study_id, cutoff))
+            QBT_ResumePoint(user_id, research_study_id).update(cutoff)
+            qbts = qbts.filter(db.or_(
+                QBT.at >= cutoff, QBT.status == OverallStatus.withdrawn))
+            # visit names of results prior to the cutoff remain valid
+            research_data = research_data.filter(
+                ResearchData.authored >= cutoff)
+        else:
+            QBT_ResumePoint(user_id, research_study_id).reset()
+        qbts.delete(synchronize_session=False)
         adh_data = AdherenceData.query.filter(
             AdherenceData.patient_id == user_id).filter(
             AdherenceData.rs_id_visit.like(f"{research_study_id}:%"))
         # SQL alchemy can't combine `like` expression with delete op.
         for ad in adh_data:
             db.session.delete(ad)
-        ResearchData.query.filter(ResearchData.subject_id == user_id).filter(
-            ResearchData.research_study_id == research_study_id).delete()
+        research_data.delete(synchronize_session=False)
 
         if not current_app.config.get("TESTING", False):
             # clear the timeout lock as well, since we need a refresh
@@ -782,21 +1110,11 @@ def invalidate_users_QBT(user_id, research_study_id):
             cache_moderation.reset()
 
 
-    # clear cached qb_status_visit_name() using current as_of value
-    # args have to match order and values - no wild carding avail
-    as_of = QB_StatusCacheKey().current()
-    if research_study_id != 'all':
-        cache.delete_memoized(
-            qb_status_visit_name, user_id, research_study_id, as_of)
-    else:
-        # quicker to just clear both than look up what user belongs to
-        cache.delete_memoized(
-            qb_status_visit_name, user_id, 0, as_of)
-        cache.delete_memoized(
-            qb_status_visit_name, user_id, 1, as_of)
-
     db.session.commit()
 
+    # orphan all cached qb_status_visit_name() values for the user
+    bump_generation(user_id)
+
 
 def check_for_overlaps(qbt_rows, cli_presentation=False):
     """Sanity function to confirm users timeline doesn't contain overlaps"""
@@ -873,6 +1191,289 @@ def check_for_overlaps(qbt_rows, cli_presentation=False):
         return True
 
 
+def generate_QBT_rows(
+        user, research_study_id, user_qnrs, resume_from=None, retained=(),
+        assigned_rps=None):
+    """Generate the ordered QBT rows defining a user's timeline
+
+    Walks the user's ordered QBs, capturing the state at each time point.
+    No rows are persisted; callers are responsible for storage.
+
+    :param user: the patient
+    :param research_study_id: the research study being processed
+    :param user_qnrs: ``QNR_results`` for the user and research study
+    :param resume_from: when set, visits starting prior are skipped, as
+      their rows are given in ``retained``
+    :param retained: ordered QBT rows preceding ``resume_from``
+    :param assigned_rps: optional preloaded result from
+      ``ResearchProtocol.assigned_to()`` for the user
+    :returns: ordered list of QBT rows, including any retained
+
+    """
+    # As we move forward, capture state at each time point
+    kwargs = {
+        "user_id": user.id,
+        "research_study_id": research_study_id,
+    }
+
+    qb_generator = ordered_qbs(
+        user, research_study_id, user_qnrs=user_qnrs,
+        assigned_rps=assigned_rps)
+    pending_qbts = AtOrderedList(retained)
+    for qbd in qb_generator:
+        if resume_from and qbd.relative_start < resume_from:
+            # visit unaffected, rows already in retained
+            continue
+        qb_recur_id = qbd.recur.id if qbd.recur else None
+        kwargs = {
+            "user_id": user.id,
+            "research_study_id": research_study_id,
+            "qb_id": qbd.questionnaire_bank.id,
+            "qb_iteration": qbd.iteration,
+            "qb_recur_id": qb_recur_id}
+        start = qbd.relative_start
+        if (
+                pending_qbts and pending_qbts[-1].at > start and
+                pending_qbts[-1].status == 'expired'):
+            # Found overlapping visits.  Move the expired date of
+            # previous just before start if possible
+            # (no additional rows with at dates > start)
+            other_status_after_next_start = False
+            for i in range(len(pending_qbts)-2, -1, -1):
+                # as we modify len of pending_qbts in special case below
+                # make sure next iteration is within new bounds
+                if i > len(pending_qbts)-1:
+                    continue
+
+                unwanted_count = 0
+                if pending_qbts[i].at > start:
+                    # Yet another special case to look for when the
+                    # transition to new RP included an additional
+                    # time-point (say month 33) that doesn't exist in
+                    # the old RP.  This will appear as TWO overlapping
+                    # QBs - one needing to be removed (say the old
+                    # month 36) in favor of the skipped new (say
+                    # month 33), and the last legit old one (say
+                    # month 30) needing its endpoint adjusted
+                    # further below.
+                    remove_qb_id = pending_qbts[i].qb_id
+                    remove_iteration = pending_qbts[i].qb_iteration
+                    for j in range(i-1, -1, -1):
+                        # keep looking back till we find the prev
+                        if (
+                                pending_qbts[j].qb_id != remove_qb_id or
+                                pending_qbts[j].qb_iteration != remove_iteration):
+                            # unwanted_count represents all rows from
+                            # overlapped, unwanted visit
+                            unwanted_count = len(pending_qbts)-j-1
+                            break
+
+                        # keep a lookout for work done in old RP
+                        if pending_qbts[j].status in (
+                                'in_progress',
+                                'partially_completed',
+                                'completed'):
+                            other_status_after_next_start = True
+                            break
+
+                    if other_status_after_next_start:
+                        break  # from outer loop if set
+
+                    # Remove unwanted from end of pending_qbts
+                    if unwanted_count:
+                        trace(
+                            "removing overlapping QBs: "
+                            f"{pending_qbts[-unwanted_count:]}")
+                        del pending_qbts[-unwanted_count:]
+                        continue
+
+                if pending_qbts[i].at < start:
+                    break
+
+            if other_status_after_next_start:
+                current_app.logger.error(
+                    "Overlap can't adjust previous as another event"
+                    " occurred since subsequent (%s:%s) qb start for"
+                    " user %d", qbd.qb_id, qbd.iteration, user.id)
+            else:
+                trace(f"moving overlapping date of {pending_qbts[-1]}")
+                pending_qbts[-1].at = start - relativedelta(seconds=1)
+                trace(f"  to {pending_qbts[-1]}")
+
+        if (
+                pending_qbts and pending_qbts[-1].at > start and
+                pending_qbts[-1].status != 'expired'):
+            # This large & unfortunate HACK is necessary w/
+            # overlapping QBs due to protocol change as there's
+            # inadequate state available w/i the generator.
+
+            # Unique edge case that only happens when user filled
+            # out results from the previous QB that belongs to the
+            # previous RP, AND the new RP inserted a skipped visit
+            # AND now we find the skipped visit starts BEFORE the
+            # results were committed to the previous QB.  In such a
+            # case we need to ignore the skipped and move on.
+            trace(
+                "Found overlapping dates and results on former;"
+                f" NOT adding {qbd}")
+
+            last_posted_index = len(pending_qbts) - 1
+            if pending_qbts[-1].status == 'partially_completed':
+                # Look back further for status implying last posted
+                last_posted_index -= 1
+                if pending_qbts[last_posted_index].status != 'in_progress':
+                    current_app.logger.warning(
+                        "User %d has invalid QB timeline.  "
+                        "Problematic qbd: %s", user.id, str(qbd))
+                    continue
+
+            # Must double-check overlap; may no longer be true, if
+            # last_posted_index was one before...
+            if pending_qbts[last_posted_index].at > start:
+                # For questionnaires with common instrument names that
+                # happen to fit in both QBs, need to now reassign the
+                # QB associations as the second is getting tossed
+                use_qb_id = pending_qbts[last_posted_index].qb_id
+                use_qb_iter = pending_qbts[last_posted_index].qb_iteration
+                changed = user_qnrs.reassign_qb_association(
+                    existing={
+                        'qb_id': qbd.qb_id,
+                        'iteration': qbd.iteration},
+                    desired={
+                        'qb_id': use_qb_id,
+                        'iteration': use_qb_iter})
+
+                # IF the reassignment caused a change, AND the previous
+                # visit was in a partially_completed state AND the change
+                # now completes that visit, update the status.
+                if (
+                        changed and
+                        pending_qbts[-1].status == 'partially_completed'):
+                    complete_date = user_qnrs.completed_date(
+                        use_qb_id,
+                        use_qb_iter)
+                    if complete_date:
+                        pending_qbts[-1].at = complete_date
+                        pending_qbts[-1].status = 'completed'
+
+                # IF the reassignment caused a change, the persisted
+                # time from the first QB submission may be incorrect
+                # as the questionnaire that uniquely identifies the
+                # RP may have not been the first submission.
+                if changed:
+                    # look back while still on correct visit for
+                    # an in_progress, fix time if necessary
+                    i = len(pending_qbts) - 1
+                    while i > 0:
+                        if not (
+                                pending_qbts[i].qb_id == use_qb_id and
+                                pending_qbts[i].qb_iteration == use_qb_iter):
+                            break
+                        if pending_qbts[i].status == 'in_progress':
+                            pending_qbts[i].at = user_qnrs.earliest_result(
+                                use_qb_id, use_qb_iter)
+                            break
+                        i -= 1
+
+                continue  # effectively removes the unwanted visit
+            else:
+                assert pending_qbts[-1].status == 'partially_completed'
+                assert pending_qbts[-1].at > start
+                # Move the partially completed event just prior to start
+                pending_qbts[-1].at = start - relativedelta(seconds=1)
+
+        # Always add start (due)
+        pending_qbts.append(QBT(at=start, status='due', **kwargs))
+
+        expired_date = start + RelativeDelta(
+            qbd.questionnaire_bank.expired)
+        overdue_date = None
+        if qbd.questionnaire_bank.overdue:  # not all qbs define
+            overdue_date = start + RelativeDelta(
+                qbd.questionnaire_bank.overdue)
+        partial_date = user_qnrs.earliest_result(
+            qbd.questionnaire_bank.id, qbd.iteration)
+        include_overdue, include_expired = True, True
+        complete_date, expired_as_partial = None, False
+
+        # If we have at least one result for this (QB, iteration):
+        if partial_date:
+            complete_date = user_qnrs.completed_date(
+                qbd.questionnaire_bank.id, qbd.iteration)
+
+            if partial_date != complete_date:
+                if overdue_date and partial_date < overdue_date:
+                    include_overdue = False
+                if partial_date < expired_date:
+                    pending_qbts.append(QBT(
+                        at=partial_date, status='in_progress',
+                        **kwargs))
+                    # Without subsequent results, expired == partial
+                    include_expired = False
+                    expired_as_partial = True
+                else:
+                    pending_qbts.append(QBT(
+                        at=partial_date, status='partially_completed',
+                        **kwargs))
+
+            if complete_date:
+                pending_qbts.append(QBT(
+                    at=complete_date, status='completed',
+                    **kwargs))
+                if complete_date <= expired_date:
+                    include_overdue = False
+                    include_expired = False
+                    expired_as_partial = False
+
+        if include_overdue and overdue_date:
+            # Take care to add overdue in the right order wrt
+            # partial and complete rows.
+
+            pending_qbts.append(QBT(
+                at=overdue_date, status='overdue', **kwargs))
+
+        if expired_as_partial:
+            pending_qbts.append(QBT(
+                at=expired_date, status="partially_completed",
+                **kwargs))
+            if include_expired:
+                raise RuntimeError("conflicting state")
+
+        if include_expired:
+            pending_qbts.append(QBT(
+                at=expired_date, status='expired', **kwargs))
+
+    # If user withdrew from study, add a row marking the withdrawal
+    # to the user's timeline, at the proper sequence.
+    _, withdrawal_date = consent_withdrawal_dates(
+        user, research_study_id=research_study_id)
+    if withdrawal_date:
+        trace("withdrawn as of {}".format(withdrawal_date))
+        j = 0
+        for qbt in pending_qbts:
+            if qbt.at > withdrawal_date:
+                break
+            j += 1
+        if j > 0:
+            # include visit in withdrawn for qb_status functionality
+            kwargs['qb_id'] = pending_qbts[j-1].qb_id
+            kwargs['qb_iteration'] = pending_qbts[j-1].qb_iteration
+            kwargs['qb_recur_id'] = pending_qbts[j-1].qb_recur_id
+        store_rows = (
+            pending_qbts[0:j] +
+            [QBT(at=withdrawal_date, status='withdrawn', **kwargs)] +
+            pending_qbts[j:])
+        check_for_overlaps(store_rows)
+        return store_rows
+
+    check_for_overlaps(pending_qbts)
+    return list(pending_qbts)
+
+
+# key used to serialize timeline generation for a (user, research study)
+QBT_LOCK_KEY = "update_users_QBT user:study {user_id}:{research_study_id}"
+
+
 def update_users_QBT(user_id, research_study_id):
     """Populate the QBT rows for given user, research_study
 
@@ -891,17 +1492,22 @@ def update_users_QBT(user_id, research_study_id):
         # acquire a multiprocessing lock to prevent multiple requests
         # from duplicating rows during this slow process
         timeout = int(current_app.config.get("MULTIPROCESS_LOCK_TIMEOUT"))
-        key = "update_users_QBT user:study {}:{}".format(
-            user_id, research_study_id)
+        key = QBT_LOCK_KEY.format(
+            user_id=user_id, research_study_id=research_study_id)
 
         with TimeoutLock(key=key, timeout=timeout):
             # if any rows are found, assume this user/study is current
+            # unless an incremental invalidation left a resume point
+            resume_point = QBT_ResumePoint(user_id, research_study_id)
+            resume_from = None
             if QBT.query.filter(QBT.user_id == user_id).filter(
                     QBT.research_study_id == research_study_id).count():
-                trace(
-                    "found QBT rows, returning cached for {}:{}".format(
-                        user_id, research_study_id))
-                return
+                resume_from = resume_point.value()
+                if not resume_from:
+                    trace(
+                        "found QBT rows, returning cached for {}:{}".format(
+                            user_id, research_study_id))
+                    return
 
             user = User.query.get(user_id)
             if not user.has_role(ROLE.PATIENT.value):
@@ -920,276 +1526,63 @@ def update_users_QBT(user_id, research_study_id):
 
             if not study_eligibility:
                 trace(f"user determined ineligible for {research_study_id}")
+                if resume_from:
+                    # as if fully invalidated; no timeline when ineligible
+                    QBT.query.filter(QBT.user_id == user_id).filter(
+                        QBT.research_study_id == research_study_id).delete()
+                    resume_point.reset()
+                    db.session.commit()
                 return
 
             # Create time-line for user, from initial trigger date
-            qb_generator = ordered_qbs(user, research_study_id)
             user_qnrs = QNR_results(user, research_study_id)
 
             # Force recalculation of QNR->QB association if needed
             if user_qnrs.qnrs_missing_qb_association():
+                if resume_from:
+                    # association may move results into retained visits
+                    trace("missing QNR associations; rebuild full timeline")
+                    resume_from = None
                 user_qnrs.assign_qb_relationships(qb_generator=ordered_qbs)
 
-            # As we move forward, capture state at each time point
-            kwargs = {
-                "user_id": user.id,
-                "research_study_id": research_study_id,
-            }
-
-            pending_qbts = AtOrderedList()
-            for qbd in qb_generator:
-                qb_recur_id = qbd.recur.id if qbd.recur else None
-                kwargs = {
-                    "user_id": user.id,
-                    "research_study_id": research_study_id,
-                    "qb_id": qbd.questionnaire_bank.id,
-                    "qb_iteration": qbd.iteration,
-                    "qb_recur_id": qb_recur_id}
-                start = qbd.relative_start
-                if (
-                        pending_qbts and pending_qbts[-1].at > start and
-                        pending_qbts[-1].status == 'expired'):
-                    # Found overlapping visits.  Move the expired date of
-                    # previous just before start if possible
-                    # (no additional rows with at dates > start)
-                    other_status_after_next_start = False
-                    for i in range(len(pending_qbts)-2, -1, -1):
-                        # as we modify len of pending_qbts in special case below
-                        # make sure next iteration is within new bounds
-                        if i > len(pending_qbts)-1:
-                            continue
-
-                        unwanted_count = 0
-                        if pending_qbts[i].at > start:
-                            # Yet another special case to look for when the
-                            # transition to new RP included an additional
-                            # time-point (say month 33) that doesn't exist in
-                            # the old RP.  This will appear as TWO overlapping
-                            # QBs - one needing to be removed (say the old
-                            # month 36) in favor of the skipped new (say
-                            # month 33), and the last legit old one (say
-                            # month 30) needing its endpoint adjusted
-                            # further below.
-                            remove_qb_id = pending_qbts[i].qb_id
-                            remove_iteration = pending_qbts[i].qb_iteration
-                            for j in range(i-1, -1, -1):
-                                # keep looking back till we find the prev
-                                if (
-                                        pending_qbts[j].qb_id != remove_qb_id or
-                                        pending_qbts[j].qb_iteration != remove_iteration):
-                                    # unwanted_count represents all rows from
-                                    # overlapped, unwanted visit
-                                    unwanted_count = len(pending_qbts)-j-1
-                                    break
-
-                                # keep a lookout for work done in old RP
-                                if pending_qbts[j].status in (
-                                        'in_progress',
-                                        'partially_completed',
-                                        'completed'):
-                                    other_status_after_next_start = True
-                                    break
-
-                            if other_status_after_next_start:
-                                break  # from outer loop if set
-
-                            # Remove unwanted from end of pending_qbts
-                            if unwanted_count:
-                                trace(
-                                    "removing overlapping QBs: "
-                                    f"{pending_qbts[-unwanted_count:]}")
-                                del pending_qbts[-unwanted_count:]
-                                continue
-
-                        if pending_qbts[i].at < start:
-                            break
-
-                    if other_status_after_next_start:
-                        current_app.logger.error(
-                            "Overlap can't adjust previous as another event"
-                            " occurred since subsequent (%s:%s) qb start for"
-                            " user %d", qbd.qb_id, qbd.iteration, user_id)
-                    else:
-                        trace(f"moving overlapping date of {pending_qbts[-1]}")
-                        pending_qbts[-1].at = start - relativedelta(seconds=1)
-                        trace(f"  to {pending_qbts[-1]}")
-
-                if (
-                        pending_qbts and pending_qbts[-1].at > start and
-                        pending_qbts[-1].status != 'expired'):
-                    # This large & unfortunate HACK is necessary w/
-                    # overlapping QBs due to protocol change as there's
-                    # inadequate state available w/i the generator.
-
-                    # Unique edge case that only happens when user filled
-                    # out results from the previous QB that belongs to the
-                    # previous RP, AND the new RP inserted a skipped visit
-                    # AND now we find the skipped visit starts BEFORE the
-                    # results were committed to the previous QB.  In such a
-                    # case we need to ignore the skipped and move on.
-                    trace(
-                        "Found overlapping dates and results on former;"
-                        f" NOT adding {qbd}")
-
-                    last_posted_index = len(pending_qbts) - 1
-                    if pending_qbts[-1].status == 'partially_completed':
-                        # Look back further for status implying last posted
-                        last_posted_index -= 1
-                        if pending_qbts[last_posted_index].status != 'in_progress':
-                            current_app.logger.warning(
-                                "User %d has invalid QB timeline.  "
-                                "Problematic qbd: %s", user_id, str(qbd))
-                            continue
-
-                    # Must double-check overlap; may no longer be true, if
-                    # last_posted_index was one before...
-                    if pending_qbts[last_posted_index].at > start:
-                        # For questionnaires with common instrument names that
-                        # happen to fit in both QBs, need to now reassign the
-                        # QB associations as the second is getting tossed
-                        use_qb_id = pending_qbts[last_posted_index].qb_id
-                        use_qb_iter = pending_qbts[last_posted_index].qb_iteration
-                        changed = user_qnrs.reassign_qb_association(
-                            existing={
-                                'qb_id': qbd.qb_id,
-                                'iteration': qbd.iteration},
-                            desired={
-                                'qb_id': use_qb_id,
-                                'iteration': use_qb_iter})
-
-                        # IF the reassignment caused a change, AND the previous
-                        # visit was in a partially_completed state AND the change
-                        # now completes that visit, update the status.
-                        if (
-                                changed and
-                                pending_qbts[-1].status == 'partially_completed'):
-                            complete_date = user_qnrs.completed_date(
-                                use_qb_id,
-                                use_qb_iter)
-                            if complete_date:
-                                pending_qbts[-1].at = complete_date
-                                pending_qbts[-1].status = 'completed'
-
-                        # IF the reassignment caused a change, the persisted
-                        # time from the first QB submission may be incorrect
-                        # as the questionnaire that uniquely identifies the
-                        # RP may have not been the first submission.
-                        if changed:
-                            # look back while still on correct visit for
-                            # an in_progress, fix time if necessary
-                            i = len(pending_qbts) - 1
-                            while i > 0:
-                                if not (
-                                        pending_qbts[i].qb_id == use_qb_id and
-                                        pending_qbts[i].qb_iteration == use_qb_iter):
-                                    break
-                                if pending_qbts[i].status == 'in_progress':
-                                    pending_qbts[i].at = user_qnrs.earliest_result(
-                                        use_qb_id, use_qb_iter)
-                                    break
-                                i -= 1
-
-                        continue  # effectively removes the unwanted visit
-                    else:
-                        assert pending_qbts[-1].status == 'partially_completed'
-                        assert pending_qbts[-1].at > start
-                        # Move the partially completed event just prior to start
-                        pending_qbts[-1].at = start - relativedelta(seconds=1)
-
-                # Always add start (due)
-                pending_qbts.append(QBT(at=start, status='due', **kwargs))
-
-                expired_date = start + RelativeDelta(
-                    qbd.questionnaire_bank.expired)
-                overdue_date = None
-                if qbd.questionnaire_bank.overdue:  # not all qbs define
-                    overdue_date = start + RelativeDelta(
-                        qbd.questionnaire_bank.overdue)
-                partial_date = user_qnrs.earliest_result(
-                    qbd.questionnaire_bank.id, qbd.iteration)
-                include_overdue, include_expired = True, True
-                complete_date, expired_as_partial = None, False
-
-                # If we have at least one result for this (QB, iteration):
-                if partial_date:
-                    complete_date = user_qnrs.completed_date(
-                        qbd.questionnaire_bank.id, qbd.iteration)
-
-                    if partial_date != complete_date:
-                        if overdue_date and partial_date < overdue_date:
-                            include_overdue = False
-                        if partial_date < expired_date:
-                            pending_qbts.append(QBT(
-                                at=partial_date, status='in_progress',
-                                **kwargs))
-                            # Without subsequent results, expired == partial
-                            include_expired = False
-                            expired_as_partial = True
-                        else:
-                            pending_qbts.append(QBT(
-                                at=partial_date, status='partially_completed',
-                                **kwargs))
-
-                    if complete_date:
-                        pending_qbts.append(QBT(
-                            at=complete_date, status='completed',
-                            **kwargs))
-                        if complete_date <= expired_date:
-                            include_overdue = False
-                            include_expired = False
-                            expired_as_partial = False
-
-                if include_overdue and overdue_date:
-                    # Take care to add overdue in the right order wrt
-                    # partial and complete rows.
-
-                    pending_qbts.append(QBT(
-                        at=overdue_date, status='overdue', **kwargs))
-
-                if expired_as_partial:
-                    pending_qbts.append(QBT(
-                        at=expired_date, status="partially_completed",
-                        **kwargs))
-                    if include_expired:
-                        raise RuntimeError("conflicting state")
-
-                if include_expired:
-                    pending_qbts.append(QBT(
-                        at=expired_date, status='expired', **kwargs))
-
-            # If user withdrew from study, add a row marking the withdrawal
-            # to the user's timeline, at the proper sequence.
-            num_stored = 0
-            _, withdrawal_date = consent_withdrawal_dates(
-                user, research_study_id=research_study_id)
-            if withdrawal_date:
-                trace("withdrawn as of {}".format(withdrawal_date))
-                j = 0
-                for qbt in pending_qbts:
-                    if qbt.at > withdrawal_date:
-                        break
-                    j += 1
-                if j > 0:
-                    # include visit in withdrawn for qb_status functionality
-                    kwargs['qb_id'] = pending_qbts[j-1].qb_id
-                    kwargs['qb_iteration'] = pending_qbts[j-1].qb_iteration
-                    kwargs['qb_recur_id'] = pending_qbts[j-1].qb_recur_id
-                store_rows = (
-                    pending_qbts[0:j] +
-                    [QBT(at=withdrawal_date, status='withdrawn', **kwargs)] +
-                    pending_qbts[j:])
-                check_for_overlaps(store_rows)
-                db.session.add_all(store_rows)
-                num_stored = len(store_rows)
+            # Seed with the retained rows (ordered) when resuming, clearing
+            # any regenerated rows from an interrupted prior attempt
+            retained = []
+            qbts = QBT.query.filter(QBT.user_id == user_id).filter(
+                QBT.research_study_id == research_study_id)
+            if resume_from:
+                qbts.filter(db.or_(
+                    QBT.at >= resume_from,
+                    QBT.status == OverallStatus.withdrawn)).delete(
+                    synchronize_session=False)
+                retained = qbts.order_by(QBT.at, QBT.id).all()
+                trace("resuming timeline from {}; retained {} rows".format(
+                    resume_from, len(retained)))
             else:
-                check_for_overlaps(pending_qbts)
-                db.session.add_all(pending_qbts)
-                num_stored = len(pending_qbts)
-
+                qbts.delete(synchronize_session=False)
+
+            store_rows = generate_QBT_rows(
+                user, research_study_id, user_qnrs=user_qnrs,
+                resume_from=resume_from, retained=retained)
+            # retained rows are persistent; only the new are written
+            retained_ids = {id(qbt) for qbt in retained}
+            num_stored = insert_qbt_rows(
+                [qbt for qbt in store_rows if id(qbt) not in retained_ids])
+
+            # overlap handling may have dropped a retained row
+            kept = {id(qbt) for qbt in store_rows}
+            for qbt in retained:
+                if id(qbt) not in kept:
+                    db.session.delete(qbt)
             if num_stored:
+                message = "qb_timeline updated; {} rows".format(num_stored)
+                if resume_from:
+                    message = "qb_timeline updated from {}; {} rows".format(
+                        FHIR_datetime.as_fhir(resume_from), num_stored)
                 auditable_event(
-                    message="qb_timeline updated; {} rows".format(num_stored),
+                    message=message,
                     user_id=user_id, subject_id=user_id, context="assessment")
+            resume_point.reset()
             db.session.commit()
 
             # With fresh calculation of a user's timeline, queue update of
@@ -1218,6 +1611,133 @@ def update_users_QBT(user_id, research_study_id):
             "qb_timeline for {}".format(user_id))
 
 
+def update_users_QBT_batch(user_ids, research_study_id):
+    """Populate the QBT rows for a batch of users, research_study
+
+    Bulk form of ``update_users_QBT()`` used by the ``update_patients``
+    job.  Users with current timelines are filtered out in a single query.
+    The consents, organizations and roles, the research protocol
+    assignments and the questionnaire responses of the remaining users are
+    preloaded with a few queries, and all generated rows are written with
+    a single bulk insert, so database round trips scale with the batch
+    rather than each patient.
+
+    Users with a pending incremental resume point, or those locked by
+    another process, are handed to ``update_users_QBT()``.
+
+    :param user_ids: the users to add QBT rows for
+    :param research_study_id: the research study being processed
+    :returns: list of user ids for whom timelines were generated
+
+    """
+    from .qb_status import patient_research_study_status
+    from ..tasks import LOW_PRIORITY, cache_single_patient_adherence_data
+
+    user_ids = list(user_ids)
+
+    def with_timelines(ids):
+        return {row.user_id for row in QBT.query.filter(
+            QBT.user_id.in_(ids)).filter(
+            QBT.research_study_id == research_study_id).with_entities(
+            QBT.user_id).distinct()}
+
+    current = with_timelines(user_ids)
+    individually = list(QBT_ResumePoint.pending(current, research_study_id))
+    missing = [user_id for user_id in user_ids if user_id not in current]
+    users = []
+    if missing:
+        users = User.query.filter(User.id.in_(missing)).options(
+            selectinload(User.roles)).all()
+
+    patients = []
+    for user in users:
+        if not user.has_role(ROLE.PATIENT.value):
+            current_app.logger.error(
+                "{} with roles {} doesn't have timeline, only "
+                "patients".format(user, str([r.name for r in user.roles])))
+            continue
+        patients.append(user)
+
+    assigned_rps = ResearchProtocol.assigned_to_users(
+        patients, research_study_id)
+    qnrs = QNR_results.preload(
+        [user.id for user in patients], research_study_id)
+
+    # timelines are generated without holding locks, so a slow batch can't
+    # outlive them; each user's lock is only held around the write
+    generated = []
+    for user in patients:
+        rss = patient_research_study_status(user, ignore_QB_status=True)
+        if not (
+                research_study_id in rss and
+                rss[research_study_id]['eligible']):
+            trace(f"user determined ineligible for {research_study_id}")
+            continue
+
+        try:
+            user_qnrs = QNR_results(
+                user, research_study_id, qnrs=qnrs[user.id])
+            if user_qnrs.qnrs_missing_qb_association():
+                user_qnrs.assign_qb_relationships(qb_generator=ordered_qbs)
+            rows = generate_QBT_rows(
+                user, research_study_id, user_qnrs=user_qnrs,
+                assigned_rps=assigned_rps[user.id])
+        except Exception:
+            # consistent with ``update_users_QBT``, don't let one
+            # problematic timeline halt the rest
+            current_app.logger.exception(
+                "failed to generate qb_timeline for %d", user.id)
+            continue
+        generated.append((user.id, rows))
+
+    built, stored = [], False
+    with ExitStack() as locks:
+        locked = []
+        for user_id, rows in generated:
+            try:
+                locks.enter_context(TimeoutLock(
+                    key=QBT_LOCK_KEY.format(
+                        user_id=user_id,
+                        research_study_id=research_study_id),
+                    timeout=0))
+            except LockTimeout:
+                individually.append(user_id)
+                continue
+            locked.append((user_id, rows))
+
+        # another process may have stored a timeline while generating
+        raced = with_timelines([user_id for user_id, _ in locked])
+        new_rows = []
+        for user_id, rows in locked:
+            if user_id in raced:
+                continue
+            new_rows.extend(rows)
+            built.append((user_id, len(rows)))
+
+        insert_qbt_rows(new_rows)
+        db.session.commit()
+        stored = True
+
+    if not stored:
+        # TimeoutLock traps and logs exceptions; nothing was written
+        db.session.rollback()
+        built = []
+    for user_id, num_stored in built:
+        if num_stored:
+            auditable_event(
+                message="qb_timeline updated; {} rows".format(num_stored),
+                user_id=user_id, subject_id=user_id, context="assessment")
+        cache_single_patient_adherence_data.apply_async(
+            kwargs={
+                'patient_id': user_id,
+                'research_study_id': research_study_id},
+            queue=LOW_PRIORITY, retry=False)
+
+    for user_id in individually:
+        update_users_QBT(user_id, research_study_id)
+    return [user_id for user_id, _ in built]
+
+
 class QB_StatusCacheKey(object):
     """Maintains the recent enough ``as_of_date`` parameter
 
@@ -1303,7 +1823,6 @@ class QB_StatusCacheKey(object):
         return value
 
 
-@cache.memoize(timeout=TWO_HOURS)
 def qb_status_visit_name(user_id, research_study_id, as_of_date):
     """Return details for current QB for user as of given date
 
@@ -1311,6 +1830,10 @@ def qb_status_visit_name(user_id, research_study_id, as_of_date):
     ``QB_StatusCacheKey.current()`` for as_of_date parameter, to avoid
     a new lookup with each passing moment.
 
+    Cached values are keyed by the user's generation, see
+    ``portal.patient_generation``, so any change to the user's timeline
+    is reflected immediately.
+
     If no data is available for the user, `status` of `Not Yet Available` for
     the EMPRO study, `expired` for all others, as part of:
      {'status': 'expired', 'visit_name': None, 'action_state': 'not applicable'}
@@ -1321,6 +1844,13 @@ def qb_status_visit_name(user_id, research_study_id, as_of_date):
       action_state: 'not applicable', or status of follow-up action
 
     """
+    return _qb_status_visit_name(
+        user_id, research_study_id, as_of_date, generation(user_id))
+
+
+@cache.memoize(timeout=TWO_HOURS)
+def _qb_status_visit_name(user_id, research_study_id, as_of_date, generation):
+    """Implementation of ``qb_status_visit_name()``, memoized by generation"""
     from .research_study import EMPRO_RS_ID
 
     assert isinstance(research_study_id, int)
@@ -1377,6 +1907,41 @@ def qb_status_visit_name(user_id, research_study_id, as_of_date):
     return results
 
 
+def qb_visit_names(user_id, research_study_id, as_of_dates):
+    """Bulk equivalent of ``qb_status_visit_name()`` visit names
+
+    Reads the user's timeline once, for any number of as_of_dates, such
+    as the authored dates of a patient's questionnaire responses.
+
+    :returns: dictionary keyed by as_of_date of the visit name, or None
+      where no timeline data precedes the date
+
+    """
+    update_users_QBT(user_id, research_study_id=research_study_id)
+
+    # same (at, id) order applied by ``qb_status_visit_name()``
+    qbts = QBT.query.filter(QBT.user_id == user_id).filter(
+        QBT.research_study_id == research_study_id).order_by(
+        QBT.at, QBT.id).all()
+    ats = [qbt.at for qbt in qbts]
+    withdrawn = next(
+        (qbt for qbt in qbts if qbt.status == OverallStatus.withdrawn), None)
+
+    names, results = {}, {}
+    for as_of_date in as_of_dates:
+        index = bisect_right(ats, as_of_date) - 1
+        if index < 0:
+            results[as_of_date] = None
+            continue
+        qbt = qbts[index]
+        if withdrawn and withdrawn.at <= qbt.at:
+            qbt = withdrawn
+        if qbt.id not in names:
+            names[qbt.id] = visit_name(qbt.qbd())
+        results[as_of_date] = names[qbt.id]
+    return results
+
+
 def expires(user_id, qbd):
     """Accessor to lookup 'expires' date for given user/qbd
 
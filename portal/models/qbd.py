@@ -116,10 +116,9 @@ class QBD(object):
                     QuestionnaireBank.id).filter(
                     QuestionnaireBank.classification ==
                     'indefinite').with_entities(
-                    QuestionnaireResponse.document['authored'].label(
-                        'authored')).first()
+                    QuestionnaireResponse.authored).first()
                 if found:
-                    return FHIR_datetime.parse(found[0])
+                    return found[0]
             return None
         return query.first().at
 
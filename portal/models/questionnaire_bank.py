@@ -8,6 +8,7 @@ from sqlalchemy import CheckConstraint, Enum, UniqueConstraint
 from ..cache import FIVE_MINS, TWO_HOURS, cache
 from ..database import db
 from ..date_tools import RelativeDelta
+from ..scoped_cache import scoped_memoize
 from ..trace import trace
 from ..trigger_states.models import TriggerState
 from .clinical_constants import CC
@@ -176,6 +177,16 @@ class QuestionnaireBank(db.Model):
 
         return self
 
+    def invalidation_hook(self):
+        """Endpoint called during site persistence import on change
+
+        Compiled protocol schedules are derived from questionnaire banks
+        and their recurrences - purge on any change.
+
+        """
+        from .protocol_schedule import ProtocolSchedule
+        ProtocolSchedule.invalidate_cache()
+
     def as_json(self):
         d = {}
         d['resourceType'] = 'QuestionnaireBank'
@@ -311,6 +322,7 @@ class QuestionnaireBank(db.Model):
         return qb_name_map
 
 
+@scoped_memoize('trigger_date')
 @cache.memoize(timeout=FIVE_MINS)
 def trigger_date(user, research_study_id, qb=None):
     """Return trigger date for user, research_study
@@ -590,6 +602,20 @@ def qbs_by_rp(rp_id, classification):
     return results.all()
 
 
+@cache.memoize(timeout=TWO_HOURS)
+def qbs_by_id():
+    """return all QBs, keyed by id
+
+    NB - as the results may be cached and expected to be live db session
+    objects, clients should confirm results are in the session or call
+    db.session.merge(load=False)
+
+    :returns: dictionary of all QuestionnaireBanks keyed by id
+
+    """
+    return {qb.id: qb for qb in QuestionnaireBank.query}
+
+
 def visit_name(qbd):
     """returns string repr of visit, i.e. 'Month 3' or 'Baseline'
 
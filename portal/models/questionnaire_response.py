@@ -1,21 +1,26 @@
 import csv
 import tempfile
-from collections import defaultdict, namedtuple
+from collections import defaultdict, deque, namedtuple
 import copy
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from html.parser import HTMLParser
+from io import StringIO
 import json
 
+from billiard import Pool
 from flask import current_app, has_request_context, url_for
 from flask_swagger import swagger
 import jsonschema
-from sqlalchemy import Enum, or_
+from sqlalchemy import Enum, Index, event, or_
 from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import object_session, validates
 from sqlalchemy.orm.exc import MultipleResultsFound
 
 from ..database import db
 from ..date_tools import FHIR_datetime
+from ..patient_generation import bump_on_commit
+from ..scoped_cache import invalidate_scoped, scoped_get, scoped_set
 from ..system_uri import (
     TRUENTH_EXTERNAL_STUDY_SYSTEM,
     TRUENTH_STATUS_EXTENSION,
@@ -76,6 +81,44 @@ class QuestionnaireResponse(db.Model):
         default=default_status
     )
 
+    # Typed columns maintained from the document on assignment, for
+    # indexed lookups and sorting; see `document_columns()`
+    authored = db.Column(db.DateTime, doc="document.authored, in UTC")
+    instrument_id = db.Column(
+        db.Text, index=True, doc="name from document.questionnaire.reference")
+    identifier_system = db.Column(db.Text)
+    identifier_value = db.Column(db.Text)
+
+    __table_args__ = (
+        Index('ix_qnr_subject_authored', 'subject_id', 'authored'),
+        Index(
+            'ix_qnr_subject_qb_iteration',
+            'subject_id', 'questionnaire_bank_id', 'qb_iteration'),
+        Index('ix_qnr_identifier', 'identifier_system', 'identifier_value'),
+    )
+
+    @validates('document')
+    def document_columns(self, key, document):
+        """Maintain typed columns on any assignment of document
+
+        NB - in place edits of the document must reassign, as is necessary
+        for JSONB change detection regardless.
+
+        """
+        document = document or {}
+        self.authored = FHIR_datetime.parse(
+            document.get('authored'), none_safe=True)
+        reference = (document.get('questionnaire') or {}).get('reference')
+        self.instrument_id = reference.split('/')[-1] if reference else None
+        identifier = document.get('identifier')
+        if isinstance(identifier, dict):
+            value = identifier.get('value')
+            self.identifier_system = identifier.get('system')
+            self.identifier_value = None if value is None else str(value)
+        else:
+            self.identifier_system, self.identifier_value = None, None
+        return document
+
     @property
     def qb_id(self):
         raise ValueError(
@@ -194,10 +237,7 @@ class QuestionnaireResponse(db.Model):
                     QuestionnaireResponse.subject_id == self.subject_id).filter(
                     QuestionnaireResponse.questionnaire_bank_id ==
                     self.questionnaire_bank_id).filter(
-                    QuestionnaireResponse.document[
-                        ("questionnaire", "reference")
-                    ].astext == self.document['questionnaire']['reference']
-                )
+                    QuestionnaireResponse.instrument_id == self.instrument_id)
                 if self.qb_iteration is None:
                     query = query.filter(QuestionnaireResponse.qb_iteration.is_(None))
                 else:
@@ -264,16 +304,13 @@ class QuestionnaireResponse(db.Model):
 
         if identifier.system is None:  # FHIR allows null system
             found = QuestionnaireResponse.query.filter(
-                QuestionnaireResponse.document['identifier']['system'].is_(
-                    None)).filter(
-                QuestionnaireResponse.document['identifier']['value']
-                == json.dumps(identifier.value))
+                QuestionnaireResponse.identifier_system.is_(None)).filter(
+                QuestionnaireResponse.identifier_value == str(identifier.value))
         else:
             found = QuestionnaireResponse.query.filter(
-                QuestionnaireResponse.document['identifier']['system']
-                == json.dumps(identifier.system)).filter(
-                QuestionnaireResponse.document['identifier']['value']
-                == json.dumps(identifier.value))
+                QuestionnaireResponse.identifier_system ==
+                identifier.system).filter(
+                QuestionnaireResponse.identifier_value == str(identifier.value))
         return found.order_by(QuestionnaireResponse.id.desc())
 
     @staticmethod
@@ -310,21 +347,62 @@ class QuestionnaireResponse(db.Model):
         if authored > datetime.utcnow() + relativedelta(seconds=60):
             raise NoFutureDates("future authored dates forbidden")
 
-    @staticmethod
-    def validate_document(document):
-        """Validate given JSON document against our swagger schema"""
-        swag = swagger(current_app)
+    # Process wide validator, compiled on first use; see `validator()`
+    _validator = None
 
-        draft4_schema = {
-            '$schema': 'http://json-schema.org/draft-04/schema#',
-            'type': 'object',
-            'definitions': swag['definitions'],
-        }
+    @classmethod
+    def validator(cls):
+        """Returns the compiled QuestionnaireResponse schema validator
 
-        validation_schema = 'QuestionnaireResponse'
-        # Copy desired schema (to validate against) to outermost dict
-        draft4_schema.update(swag['definitions'][validation_schema])
-        jsonschema.validate(document, draft4_schema)
+        Building the swagger spec parses every view docstring in the app,
+        so the schema is extracted and compiled only once per process.
+
+        """
+        if cls._validator is None:
+            swag = swagger(current_app)
+
+            draft4_schema = {
+                '$schema': 'http://json-schema.org/draft-04/schema#',
+                'type': 'object',
+                'definitions': swag['definitions'],
+            }
+
+            validation_schema = 'QuestionnaireResponse'
+            # Copy desired schema (to validate against) to outermost dict
+            draft4_schema.update(swag['definitions'][validation_schema])
+            jsonschema.Draft4Validator.check_schema(draft4_schema)
+            cls._validator = jsonschema.Draft4Validator(draft4_schema)
+        return cls._validator
+
+    @classmethod
+    def validate_document(cls, document):
+        """Validate given JSON document against our swagger schema
+
+        :raises jsonschema.ValidationError: the most relevant error, as
+          would ``jsonschema.validate()``
+
+        """
+        error = jsonschema.exceptions.best_match(
+            cls.validator().iter_errors(document))
+        if error is not None:
+            raise error
+
+    @classmethod
+    def validate_documents(cls, documents):
+        """Validate a batch of documents, as for bulk imports
+
+        :returns: list of (index, ValidationError) tuples for each invalid
+          document in the batch; empty if all are valid
+
+        """
+        validator = cls.validator()
+        failures = []
+        for i, document in enumerate(documents):
+            error = jsonschema.exceptions.best_match(
+                validator.iter_errors(document))
+            if error is not None:
+                failures.append((i, error))
+        return failures
 
     @property
     def document_answered(self):
@@ -461,6 +539,21 @@ class QuestionnaireResponse(db.Model):
         qnr['contained'] = [qn.as_fhir()]
         return qnr
 
+
+@event.listens_for(QuestionnaireResponse, 'after_insert')
+@event.listens_for(QuestionnaireResponse, 'after_update')
+@event.listens_for(QuestionnaireResponse, 'after_delete')
+def purge_scoped_qnr_data(mapper, connection, target):
+    """Purge any results memoized for the subject in the active scope
+
+    Values cached across requests are orphaned on commit, by bumping the
+    subject's generation.
+
+    """
+    invalidate_scoped(target.subject_id, research_study_id='all')
+    bump_on_commit(object_session(target), target.subject_id)
+
+
 QNR = namedtuple('QNR', [
     'qnr_id', 'qb_id', 'iteration', 'status', 'instrument', 'authored',
     'encounter_id'])
@@ -471,7 +564,7 @@ class QNR_results(object):
 
     def __init__(
             self, user, research_study_id, qb_ids=None, qb_iteration=None,
-            ignore_iteration=False):
+            ignore_iteration=False, qnrs=None):
         """Optionally include qb_id and qb_iteration to limit
 
         :param user: subject in question
@@ -481,6 +574,8 @@ class QNR_results(object):
          is NOT set
         :param ignore_iteration: used in combination with qb_id to filter
          results on the given questionnaire bank, but ignore the iteration.
+        :param qnrs: optional, unrestricted list of the user's QNRs as
+         obtained from ``QNR_results.preload()``
 
         """
         self.user = user
@@ -488,60 +583,93 @@ class QNR_results(object):
         self.qb_ids = qb_ids
         self.qb_iteration = qb_iteration
         self.ignore_iteration = ignore_iteration
-        self._qnrs = None
+        self._qnrs = qnrs
 
-    @property
-    def qnrs(self):
-        """Return cached qnrs or query first time"""
-        if self._qnrs is not None:
-            return self._qnrs
-
-        query = QuestionnaireResponse.query.filter(
-            QuestionnaireResponse.subject_id == self.user.id).with_entities(
+    @staticmethod
+    def query_qnrs():
+        """Returns base query for QNR details, ordered by authored"""
+        return QuestionnaireResponse.query.with_entities(
+            QuestionnaireResponse.subject_id,
             QuestionnaireResponse.id,
             QuestionnaireResponse.questionnaire_bank_id,
             QuestionnaireResponse.qb_iteration,
             QuestionnaireResponse.status,
-            QuestionnaireResponse.document[
-                ('questionnaire', 'reference')].label('instrument_id'),
-            QuestionnaireResponse.document['authored'].label('authored'),
+            QuestionnaireResponse.instrument_id,
+            QuestionnaireResponse.authored,
             QuestionnaireResponse.encounter_id).order_by(
-            QuestionnaireResponse.document['authored'])
-        if self.qb_ids:
-            query = query.filter(
-                QuestionnaireResponse.questionnaire_bank_id.in_(self.qb_ids))
-            if not self.ignore_iteration:
-                query = query.filter(
-                    QuestionnaireResponse.qb_iteration == self.qb_iteration)
-        self._qnrs = []
-        prev_auth = None
-        for qnr in query:
+            QuestionnaireResponse.authored)
+
+    @staticmethod
+    def qnrs_from_rows(rows, user_id, research_study_id):
+        """Returns list of QNR tuples from ``query_qnrs()`` rows for one user
+        """
+        qnrs = []
+        for qnr in rows:
             # Cheaper to toss those from the wrong research study now
-            instrument = qnr.instrument_id.split('/')[-1]
-            research_study_id = research_study_id_from_questionnaire(
-                instrument)
-            if research_study_id != self.research_study_id:
+            qnr_research_study_id = research_study_id_from_questionnaire(
+                qnr.instrument_id)
+            if qnr_research_study_id != research_study_id:
                 continue
 
-            # confirm a timezone extension in authored didn't foil the sort
-            auth_datetime = FHIR_datetime.parse(qnr.authored)
-            if prev_auth and prev_auth > auth_datetime:
-                message = (
-                    "String sort order for"
-                    " `questionnaire_response.document['authored']`"
-                    " differs from datetime sort.  Review authored values"
-                    f" for user {self.user.id}")
-                current_app.logger.error(message)
-            prev_auth = auth_datetime
-
-            self._qnrs.append(QNR(
+            qnrs.append(QNR(
                 qnr_id=qnr.id,
                 qb_id=qnr.questionnaire_bank_id,
                 iteration=qnr.qb_iteration,
                 status=qnr.status,
-                instrument=instrument,
-                authored=auth_datetime,
+                instrument=qnr.instrument_id,
+                authored=qnr.authored,
                 encounter_id=qnr.encounter_id))
+        return qnrs
+
+    @staticmethod
+    def preload(user_ids, research_study_id):
+        """Bulk load QNRs for a batch of users in a single query
+
+        :returns: dictionary keyed by user id, of the list of QNRs the
+          ``qnrs`` property would produce for an unrestricted instance
+
+        """
+        rows_by_user = {user_id: [] for user_id in user_ids}
+        query = QNR_results.query_qnrs().filter(
+            QuestionnaireResponse.subject_id.in_(list(rows_by_user)))
+        for row in query:
+            rows_by_user[row.subject_id].append(row)
+        return {
+            user_id: QNR_results.qnrs_from_rows(
+                rows, user_id, research_study_id)
+            for user_id, rows in rows_by_user.items()}
+
+    @property
+    def qnrs(self):
+        """Return cached qnrs or query first time
+
+        The unrestricted list is also memoized for the active request or
+        task scope, see ``portal.scoped_cache``.
+
+        """
+        if self._qnrs is not None:
+            return self._qnrs
+
+        if not self.qb_ids:
+            self._qnrs = scoped_get(
+                'QNR_results', self.user.id, self.research_study_id)
+            if self._qnrs is not None:
+                return self._qnrs
+
+        query = self.query_qnrs().filter(
+            QuestionnaireResponse.subject_id == self.user.id)
+        if self.qb_ids:
+            query = query.filter(
+                QuestionnaireResponse.questionnaire_bank_id.in_(self.qb_ids))
+            if not self.ignore_iteration:
+                query = query.filter(
+                    QuestionnaireResponse.qb_iteration == self.qb_iteration)
+        self._qnrs = self.qnrs_from_rows(
+            query, self.user.id, self.research_study_id)
+        if not self.qb_ids:
+            scoped_set(
+                'QNR_results', self.user.id, self.research_study_id, None,
+                self._qnrs)
         return self._qnrs
 
     def assign_qb_relationships(self, qb_generator):
@@ -796,11 +924,10 @@ class QNR_indef_results(QNR_results):
             QuestionnaireResponse.questionnaire_bank_id,
             QuestionnaireResponse.qb_iteration,
             QuestionnaireResponse.status,
-            QuestionnaireResponse.document[
-                ('questionnaire', 'reference')].label('instrument_id'),
-            QuestionnaireResponse.document['authored'].label('authored'),
+            QuestionnaireResponse.instrument_id,
+            QuestionnaireResponse.authored,
             QuestionnaireResponse.encounter_id).order_by(
-            QuestionnaireResponse.document['authored'])
+            QuestionnaireResponse.authored)
 
         self._qnrs = []
         for qnr in query:
@@ -809,8 +936,8 @@ class QNR_indef_results(QNR_results):
                 qb_id=qnr.questionnaire_bank_id,
                 iteration=qnr.qb_iteration,
                 status=qnr.status,
-                instrument=qnr.instrument_id.split('/')[-1],
-                authored=FHIR_datetime.parse(qnr.authored),
+                instrument=qnr.instrument_id,
+                authored=qnr.authored,
                 encounter_id=qnr.encounter_id))
 
     def completed_qs(self, qb_id, iteration):
@@ -852,8 +979,28 @@ def row_by_format(data, bundle_format):
         yield from generate_qnr_csv(data)
 
 
+def serialize_chunk(chunk, bundle_format):
+    """Serialize a chunk of research data documents to a single string
+
+    Module level, so it may be dispatched to a worker process.  Output is
+    exactly as would be written row by row to the aggregate file, with
+    bundle entries separated by ", " and csv lacking the header.
+
+    """
+    if bundle_format:
+        return ", ".join(
+            "".join(row_by_format(data, bundle_format)) for data in chunk)
+
+    buffer = StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=qnr_csv_column_headers)
+    for data in chunk:
+        writer.writerows(row_by_format(data, bundle_format))
+    return buffer.getvalue()
+
+
 def aggregate_responses(
-        instrument_ids, current_user, celery_task=None, patient_ids=None, bundle_format=False):
+        instrument_ids, current_user, celery_task=None, patient_ids=None, bundle_format=False,
+        artifact=None, workers=1):
     """Build a bundle of QuestionnaireResponses in a temporary file
 
     :param instrument_ids: list of instrument_ids to restrict results to
@@ -862,7 +1009,17 @@ def aggregate_responses(
     :param celery_task: if defined, send occasional progress updates
     :param patient_ids: if defined, limit result set to given patient list
     :param bundle_format: write results as a FHIR bundle when set, default to csv
+    :param artifact: if defined, the ``ReportArtifact`` to write results to,
+        rather than a temporary file
+    :param workers: number of processes serializing fetched chunks.  Only
+        for use from background tasks, not request handlers.
     :returns: filepath to temporary file containing aggregated results
+
+    Rows are streamed from a server side cursor, `AGGREGATE_FETCH_SIZE` at
+    a time.  With workers > 1, each fetched chunk is serialized in a pool of
+    worker processes, and written in query order.  The pool is from
+    billiard, which unlike multiprocessing allows the daemonic prefork celery
+    workers children, and is started before the cursor is opened.
     """
     if celery_task:
         celery_task.update_state(
@@ -886,9 +1043,10 @@ def aggregate_responses(
         ResearchData.authored.desc(), ResearchData.subject_id).with_entities(
         ResearchData.data)
 
-    total = query.count()
     if instrument_ids:
         query = query.filter(ResearchData.instrument.in_(tuple(instrument_ids)))
+    total = query.count()
+    fetch_size = current_app.config['AGGREGATE_FETCH_SIZE']
 
     suffix = ".csv"
     header = qnr_csv_column_headers
@@ -897,35 +1055,66 @@ def aggregate_responses(
         header, footer = bundle_header_footer()
 
     # avoid exhausting memory by writing directly to a file
-    tf = tempfile.NamedTemporaryFile(
-        dir=current_app.config['TMP_REPORT_DIR'],
-        mode="w",
-        newline="",
-        prefix=f"qnr-data-{datetime.today().strftime('%Y-%m-%d')}-",
-        suffix=suffix,
-        delete=False)
+    if artifact:
+        tf = artifact.open()
+    else:
+        tf = tempfile.NamedTemporaryFile(
+            dir=current_app.config['TMP_REPORT_DIR'],
+            mode="w",
+            newline="",
+            prefix=f"qnr-data-{datetime.today().strftime('%Y-%m-%d')}-",
+            suffix=suffix,
+            delete=False)
     if bundle_format:
-        writerow = tf.write
-        writerow(str(header) + '\n')
+        tf.write(str(header) + '\n')
     else:
-        writer = csv.DictWriter(tf, fieldnames=header)
-        writer.writeheader()
-        writerow = writer.writerow
+        csv.DictWriter(tf, fieldnames=header).writeheader()
+
+    def chunks():
+        chunk = []
+        for row in query.yield_per(fetch_size):
+            chunk.append(row.data)
+            if len(chunk) == fetch_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
     rowcount = 0
-    for row in query:
+
+    def write_chunk(serialized, size):
+        nonlocal rowcount
         if rowcount and bundle_format:
-            writerow(", ")
-        rowcount += 1
-        for item in row_by_format(row.data, bundle_format):
-            writerow(item)
-        if celery_task and rowcount % (total // 10) == 0:
+            tf.write(", ")
+        tf.write(serialized)
+        rowcount += size
+        if celery_task:
             celery_task.update_state(
                 state='PROGRESS',
-                meta={'current': rowcount//total, 'total': 100})
+                meta={'current': 10 + 90 * rowcount // total, 'total': 100})
+
+    if workers > 1 and total > fetch_size:
+        # bound chunks in flight, writing each in order as it completes
+        with Pool(workers) as pool:
+            pending = deque()
+            for chunk in chunks():
+                pending.append((pool.apply_async(
+                    serialize_chunk, (chunk, bundle_format)), len(chunk)))
+                if len(pending) >= 2 * workers:
+                    result, size = pending.popleft()
+                    write_chunk(result.get(), size)
+            while pending:
+                result, size = pending.popleft()
+                write_chunk(result.get(), size)
+    else:
+        for chunk in chunks():
+            write_chunk(serialize_chunk(chunk, bundle_format), len(chunk))
 
     if bundle_format:
-        writerow(footer)
+        tf.write(footer)
+    if artifact:
+        tf.close()
+        return artifact.commit()
     filepath = tf.name
     tf.close()
 
@@ -946,9 +1135,8 @@ def qnr_document_id(
     qnr = QuestionnaireResponse.query.filter(
         QuestionnaireResponse.status == status).filter(
         QuestionnaireResponse.subject_id == subject_id).filter(
-        QuestionnaireResponse.document[
-            ('questionnaire', 'reference')
-        ].astext.endswith(questionnaire_name)).with_entities(
+        QuestionnaireResponse.instrument_id == questionnaire_name
+    ).with_entities(
         QuestionnaireResponse.document[(
             'identifier', 'value')])
     if questionnaire_name != 'irondemog_v3':
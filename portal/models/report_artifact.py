@@ -0,0 +1,192 @@
+"""Report Artifact module
+
+Reports such as the research and adherence exports are written to files in
+`TMP_REPORT_DIR`.  A ``ReportArtifact`` names such a file by a hash of the
+report parameters and the high-water mark of the data it reads, so a
+repeated request, with no new data, reuses the existing file.
+
+Artifacts are optionally compressed as written, per `REPORT_COMPRESSION`,
+and served with the matching `Content-Encoding`.  Reuse is limited to
+`REPORT_ARTIFACT_TTL` seconds, after which ``purge_report_artifacts()``
+removes the files.
+
+"""
+import gzip
+from hashlib import sha256
+import io
+import json
+import os
+from time import time
+from uuid import uuid4
+
+from flask import current_app, request, send_file, send_from_directory
+from sqlalchemy import func
+
+from ..cache import cache
+from ..database import db
+
+ARTIFACT_PREFIX = "artifact-"
+ARTIFACT_META_KEY = "report_artifact:{}"
+
+# compression: (file suffix, Content-Encoding)
+COMPRESSION = {
+    None: ('', None),
+    'gzip': ('.gz', 'gzip'),
+    'zstd': ('.zst', 'zstd'),
+}
+
+
+class ReportArtifact(object):
+    """Content addressed report file within `TMP_REPORT_DIR`
+
+    :param report_type: name of report, included in the filename
+    :param suffix: file suffix for the uncompressed format, i.e. '.csv'
+    :param params: all parameters affecting the report content, including
+      the acting user and data high-water mark.  Must be JSON serializable.
+
+    """
+
+    def __init__(self, report_type, suffix, **params):
+        self.compression = current_app.config['REPORT_COMPRESSION']
+        if self.compression not in COMPRESSION:
+            raise ValueError(
+                f"unsupported REPORT_COMPRESSION {self.compression}")
+        compressed_suffix, self.content_encoding = COMPRESSION[
+            self.compression]
+
+        signature = json.dumps(
+            {'report_type': report_type, 'params': params},
+            sort_keys=True, default=str)
+        self.key = sha256(signature.encode('utf-8')).hexdigest()[:32]
+        self.filepath = os.path.join(
+            current_app.config['TMP_REPORT_DIR'],
+            f"{ARTIFACT_PREFIX}{report_type}-{self.key}{suffix}"
+            f"{compressed_suffix}")
+        self._partial = None
+
+    @property
+    def filename(self):
+        return os.path.basename(self.filepath)
+
+    def fresh(self):
+        """Returns metadata saved with the artifact, if reusable, else None"""
+        if not os.path.exists(self.filepath):
+            return None
+        return cache.get(ARTIFACT_META_KEY.format(self.key))
+
+    def open(self):
+        """Returns text stream for writing, compressed as configured
+
+        Content is written to a partial file, only replacing any existing
+        artifact on ``commit()``.
+
+        """
+        self._partial = f"{self.filepath}.{uuid4().hex}.partial"
+        if self.compression == 'gzip':
+            return gzip.open(
+                self._partial, 'wt', newline='', encoding='utf-8')
+        if self.compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError(
+                    "REPORT_COMPRESSION zstd requires the zstandard package")
+            return io.TextIOWrapper(
+                zstandard.ZstdCompressor().stream_writer(
+                    open(self._partial, 'wb')),
+                newline='', encoding='utf-8')
+        return open(self._partial, 'w', newline='')
+
+    def commit(self, **metadata):
+        """Publish the closed stream as the artifact, for reuse within TTL
+
+        :param metadata: any details to return from ``fresh()`` on reuse
+        :returns: the artifact filepath
+
+        """
+        os.replace(self._partial, self.filepath)
+        cache.set(
+            ARTIFACT_META_KEY.format(self.key),
+            dict(metadata, filepath=self.filepath),
+            timeout=current_app.config['REPORT_ARTIFACT_TTL'])
+        return self.filepath
+
+
+def high_water_mark(model, *criteria, updated=None):
+    """Returns (max id, row count) of model, changing with any new data
+
+    :param model: model class with integer primary key ``id``
+    :param criteria: optional filter criteria, limiting to rows of interest
+    :param updated: optional timestamp column, set on every write.  Its sum
+      is included in the mark, so rows updated in place also change the mark.
+
+    """
+    columns = [func.max(model.id), func.count(model.id)]
+    if updated is not None:
+        columns.append(func.sum(func.extract('epoch', updated)))
+    query = db.session.query(*columns)
+    if criteria:
+        query = query.filter(*criteria)
+    return list(query.one())
+
+
+def purge_report_artifacts(ttl=None):
+    """Remove artifacts and abandoned partial files older than ttl
+
+    :param ttl: age in seconds, defaults to `REPORT_ARTIFACT_TTL`
+    :returns: number of files removed
+
+    """
+    ttl = ttl if ttl is not None else current_app.config['REPORT_ARTIFACT_TTL']
+    report_dir = current_app.config['TMP_REPORT_DIR']
+    cutoff = time() - ttl
+    removed = 0
+    for entry in os.scandir(report_dir):
+        if not entry.name.startswith(ARTIFACT_PREFIX):
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            # removed concurrently
+            continue
+    current_app.logger.info(f"purged {removed} report artifacts")
+    return removed
+
+
+def compression_of(filename):
+    """Returns (suffix, Content-Encoding) implied by the filename"""
+    for suffix, encoding in COMPRESSION.values():
+        if suffix and filename.endswith(suffix):
+            return suffix, encoding
+    return COMPRESSION[None]
+
+
+def send_report_artifact(directory, filename, **kwargs):
+    """Send report file, with Content-Encoding for compressed artifacts
+
+    Clients not accepting the encoding receive the decompressed content.
+    Any `download_name` should name the uncompressed format, and defaults
+    to the filename sans compression suffix.
+
+    """
+    suffix, encoding = compression_of(filename)
+    if not encoding:
+        return send_from_directory(directory, filename, **kwargs)
+
+    kwargs.setdefault('download_name', filename[:-len(suffix)])
+    if encoding in request.accept_encodings:
+        response = send_from_directory(directory, filename, **kwargs)
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+    filepath = os.path.join(directory, filename)
+    if encoding == 'gzip':
+        stream = gzip.open(filepath, 'rb')
+    else:
+        import zstandard
+        stream = zstandard.ZstdDecompressor().stream_reader(
+            open(filepath, 'rb'), closefd=True)
+    return send_file(stream, **kwargs)
@@ -2,29 +2,33 @@
 import functools
 from collections import defaultdict, namedtuple
 from datetime import datetime, timedelta
-from os import path
+import json
 from smtplib import SMTPRecipientsRefused
+from uuid import uuid4
 
 from flask import current_app
 from flask_babel import force_locale
-from werkzeug.exceptions import Unauthorized
 
 from ..audit import auditable_event
 from ..cache import cache
 from ..database import db
 from ..date_tools import report_format
+from ..factories.redis import create_redis
 from ..timeout_lock import ADHERENCE_DATA_KEY, CacheModeration
 from ..trigger_states.models import TriggerStatesReporting
-from .adherence_data import AdherenceData, sorted_adherence_data
+from .adherence_data import AdherenceData, bulk_sorted_adherence_data
 from .app_text import MailResource, SiteSummaryEmail_ATMA, app_text
 from .communication import load_template_args
+from .fhir import bundle_header_footer
 from .message import EmailMessage
 from .organization import Organization, OrgTree
 from .overall_status import OverallStatus
 from .questionnaire_response import aggregate_responses
 from .qb_status import QB_Status
 from .qb_timeline import QBT, qb_status_visit_name
+from .report_artifact import ReportArtifact, high_water_mark
 from .questionnaire_bank import visit_name
+from .research_data import ResearchData
 from .questionnaire_response import (
     QNR_results,
     qnr_csv_column_headers,
@@ -32,9 +36,14 @@ from .questionnaire_response import (
 )
 from .research_study import BASE_RS_ID, EMPRO_RS_ID, ResearchStudy
 from .role import ROLE, Role
+from .scheduled_job import update_job_status
 from .user import User, UserRoles, patients_query
 from .user_consent import consent_withdrawal_dates
 
+# Redis hash tallying progress of a chunked cache_adherence_data run
+ADHERENCE_CACHE_RUN_KEY = "adherence_cache_run:{}"
+ADHERENCE_CACHE_RUN_EXPIRATION = 60 * 60 * 24  # one day, in seconds
+
 
 def debug_msg(patient_id, message):
     """helper to generate common format debug message for challenging issue"""
@@ -54,7 +63,8 @@ def update_patient_adherence_data(patient_id):
         single_patient_adherence_data(patient_id=patient_id, research_study_id=rs_id)
 
 
-def single_patient_adherence_data(patient_id, research_study_id):
+def single_patient_adherence_data(
+        patient_id, research_study_id, ts_reporting=None):
     """Update any missing (from cache) adherence data for patient
 
     NB: all changes are side effects, persisted in adherence_data table.
@@ -65,6 +75,8 @@ def single_patient_adherence_data(patient_id, research_study_id):
     against expiration in a user's adherence record, skipped runs will
     get caught next cycle.
 
+    :param ts_reporting: preloaded ``TriggerStatesReporting`` for the
+      patient, used with EMPRO; loaded as needed if not provided
     :returns: number of added rows
     """
     # ignore non-patient requests
@@ -214,9 +226,10 @@ def single_patient_adherence_data(patient_id, research_study_id):
         if not exp_row or exp_row.at > as_of_date:
             row["status"] = "Not Yet Available"
 
-    ts_reporting = (
-        TriggerStatesReporting(patient_id=patient.id)
-        if research_study_id == EMPRO_RS_ID else None)
+    if research_study_id != EMPRO_RS_ID:
+        ts_reporting = None
+    elif ts_reporting is None:
+        ts_reporting = TriggerStatesReporting(patient_id=patient.id)
     if last_viable:
         general_row_detail(row, patient, last_viable)
         empro_row_detail(row, ts_reporting)
@@ -337,22 +350,30 @@ def cache_adherence_data(
     """Populates the adherence data cache for timely reports
 
     Designed to be executed as a routine job.  Initially removes any rows that
-    have expired (or will do so in a day to avoid race conditions).  Then works
-    through all patients updating any missing rows.
+    have expired (or will do so in a day to avoid race conditions).  Then
+    fans out the requested patients in chunks of `ADHERENCE_CACHE_BATCH_SIZE`
+    to update any missing rows, gathering the per chunk counts in a chord
+    callback which records the overall outcome in the scheduled job status,
+    or a chord errback recording the failure of any chunk.
 
     :param include_test_role: set to include test patients in results
     :param org_id: set to limit to patients belonging to a branch of org tree
     :param research_study_id: research study to report on
-    :param limit: limit run to first 'n' added rows.  effective throttle to
+    :param limit: limit run to first 'n' patients.  effective throttle to
       limit scope and runtime of task; next run will pick up next block
     :param patient_id: use to process only a single patient
-    :param job_id: noise ignored from scheduled job fixture
+    :param job_id: scheduled job to receive progress and final status
     :param manual_run: noise ignored from scheduled job fixture
-    :return: dict including number of rows updated in adherence_data table and
+    :return: dict including number of patients and chunks queued, and
       if limit was hit
 
     """
-    from ..tasks import cache_single_patient_adherence_data
+    from celery import chord
+    from ..tasks import (
+        cache_adherence_data_chunk_task,
+        cache_adherence_data_failed_task,
+        cache_adherence_data_summary_task,
+    )
     # For building cache, use system account; skip privilege checks
     acting_user = User.query.filter_by(email='__system__').one()
     as_of_date = datetime.utcnow()
@@ -362,37 +383,175 @@ def cache_adherence_data(
     AdherenceData.query.filter(AdherenceData.valid_till < valid).delete()
     db.session.commit()
 
-    def patient_generator():
-        """Generator for requested patients, updates job status as needed"""
-        # If limited by org - use org and its children as filter list
-        requested_orgs = (
-            OrgTree().here_and_below_id(organization_id=org_id) if org_id
-            else None)
+    # If limited by org - use org and its children as filter list
+    requested_orgs = (
+        OrgTree().here_and_below_id(organization_id=org_id) if org_id
+        else None)
 
-        id_filter = [patient_id] if patient_id else None
-        patients = patients_query(
-            acting_user=acting_user,
-            include_test_role=include_test_role,
-            research_study_id=research_study_id,
-            requested_orgs=requested_orgs,
-            filter_by_ids=id_filter)
-        for patient in patients:
-            yield patient
+    id_filter = [patient_id] if patient_id else None
+    patients = patients_query(
+        acting_user=acting_user,
+        include_test_role=include_test_role,
+        research_study_id=research_study_id,
+        requested_orgs=requested_orgs,
+        filter_by_ids=id_filter).with_entities(User.id)
+    patient_ids = [pid for pid, in patients]
+    limit_hit = bool(limit and len(patient_ids) > limit)
+    if limit_hit:
+        current_app.logger.info(
+            "pre-mature exit caching adherence data having hit limit")
+        patient_ids = patient_ids[:limit]
+
+    batch_size = current_app.config['ADHERENCE_CACHE_BATCH_SIZE']
+    chunks = [
+        patient_ids[i:i + batch_size]
+        for i in range(0, len(patient_ids), batch_size)]
+    if job_id:
+        # chunks and the chord callback follow with progress and final status
+        update_job_status(job_id, status=(
+            f"cache_adherence_data queued {len(patient_ids)} patients in "
+            f"{len(chunks)} chunks" if chunks else
+            "cache_adherence_data completed, no patients to update"))
+    if chunks:
+        run_key = ADHERENCE_CACHE_RUN_KEY.format(uuid4().hex)
+        chunk_kwargs = {
+            'research_study_id': research_study_id,
+            'run_key': run_key,
+            'chunk_count': len(chunks),
+            'job_id': job_id}
+        chord(
+            cache_adherence_data_chunk_task.s(
+                patient_ids=chunk, **chunk_kwargs)
+            for chunk in chunks)(cache_adherence_data_summary_task.s(
+                started=as_of_date.isoformat(), run_key=run_key,
+                job_id=job_id).on_error(cache_adherence_data_failed_task.s(
+                    run_key=run_key, job_id=job_id)))
+
+    return {
+        'patients': len(patient_ids),
+        'chunks': len(chunks),
+        'limit_hit': limit_hit}
+
+
+def adherence_chunks_failed(exc, run_key, job_id=None):
+    """Record failure of an adherence cache run
+
+    Should any chunk fail, the chord never calls
+    `summarize_adherence_chunks()`; its errback records the failure in
+    place of the final status.
+
+    :param exc: exception raised by the failing chunk
+    :param run_key: redis key used to tally progress, removed on failure
+    :param job_id: scheduled job to receive the final status, if defined
+    :returns: status message
 
-    added_rows = 0
-    for patient in patient_generator():
-        if limit and added_rows > limit:
-            current_app.logger.info(
-                "pre-mature exit caching adherence data having hit limit")
-            break
-        # queue patient's adherence cache refresh as a separate job
-        kwargs = {
-            'patient_id': patient.id,
-            'research_study_id': research_study_id}
-        cache_single_patient_adherence_data.apply_async(
-            kwargs=kwargs, retry=False)
+    """
+    message = f"cache_adherence_data failed: {exc}"
+    current_app.logger.error(message)
 
-    return {'added': added_rows, 'limit_hit': limit and added_rows > limit}
+    create_redis(current_app.config['REDIS_URL']).delete(run_key)
+    if job_id:
+        update_job_status(job_id, status=message)
+    return message
+
+
+def preload_adherence_metadata(research_study_id):
+    """Warm process wide caches shared by every patient in a chunk
+
+    Loads the organization tree and compiled protocol schedules for the
+    research study, so per patient timeline and report work within a
+    chunk need not query for either.
+
+    """
+    from .protocol_schedule import ProtocolSchedule
+    from .research_protocol import ResearchProtocol
+
+    OrgTree()
+    rp_ids = ResearchProtocol.query.filter(
+        ResearchProtocol.research_study_id == research_study_id).with_entities(
+        ResearchProtocol.id)
+    for rp_id, in rp_ids:
+        for classification in ('baseline', 'recurring', 'indefinite'):
+            ProtocolSchedule.lookup(rp_id, classification)
+
+
+def adherence_data_chunk(
+        patient_ids, research_study_id, run_key, chunk_count, job_id=None):
+    """Update adherence data for a chunk of patients
+
+    A failure on any single patient is logged and counted, so the remainder
+    of the chunk (and the chord gathering the chunk results) still complete.
+
+    :param patient_ids: ids of patients in this chunk
+    :param research_study_id: research study to update
+    :param run_key: redis key shared by all chunks of the same run, used to
+      tally progress
+    :param chunk_count: total number of chunks in the run
+    :param job_id: scheduled job to receive progress status, if defined
+    :returns: dict with counts of patients, added rows and errors
+
+    """
+    preload_adherence_metadata(research_study_id)
+    ts_reporting = (
+        TriggerStatesReporting.for_patients(patient_ids)
+        if research_study_id == EMPRO_RS_ID else {})
+
+    added, errors = 0, 0
+    for patient_id in patient_ids:
+        try:
+            added += single_patient_adherence_data(
+                patient_id=patient_id,
+                research_study_id=research_study_id,
+                ts_reporting=ts_reporting.get(patient_id)) or 0
+        except Exception as e:
+            db.session.rollback()
+            errors += 1
+            current_app.logger.error(
+                "failed to cache adherence data for patient %d: %s",
+                patient_id, e)
+
+    rs = create_redis(current_app.config['REDIS_URL'])
+    pipe = rs.pipeline()
+    pipe.hincrby(run_key, 'chunks', 1)
+    pipe.hincrby(run_key, 'patients', len(patient_ids))
+    pipe.hincrby(run_key, 'added', added)
+    pipe.expire(run_key, ADHERENCE_CACHE_RUN_EXPIRATION)
+    chunks_done, patients_done, added_total, _ = pipe.execute()
+
+    if job_id:
+        update_job_status(job_id, status=(
+            f"cache_adherence_data in progress: {chunks_done} of "
+            f"{chunk_count} chunks, {patients_done} patients, "
+            f"{added_total} rows added"))
+    return {'patients': len(patient_ids), 'added': added, 'errors': errors}
+
+
+def summarize_adherence_chunks(chunk_results, started, run_key, job_id=None):
+    """Combine per chunk results on completion of an adherence cache run
+
+    :param chunk_results: list of `adherence_data_chunk()` return values
+    :param started: isoformat string of time the run began
+    :param run_key: redis key used to tally progress, removed on completion
+    :param job_id: scheduled job to receive the final status, if defined
+    :returns: status message
+
+    """
+    totals = defaultdict(int)
+    for result in chunk_results:
+        for k, v in result.items():
+            totals[k] += v
+    duration = datetime.utcnow() - datetime.fromisoformat(started)
+    message = (
+        f"cache_adherence_data completed {totals['patients']} patients in "
+        f"{len(chunk_results)} chunks, {totals['added']} rows added, "
+        f"{totals['errors']} errors in {int(duration.total_seconds())} "
+        f"seconds")
+    current_app.logger.info(message)
+
+    create_redis(current_app.config['REDIS_URL']).delete(run_key)
+    if job_id:
+        update_job_status(job_id, status=message)
+    return message
 
 
 def adherence_report(
@@ -415,8 +574,25 @@ def adherence_report(
     :return: dictionary of results, easily stored as a task output, including
        any details needed to assist the view method
 
+    A repeated request, without changes to the adherence data, reuses the
+    report artifact written by the first.
+
     """
     acting_user = User.query.get(acting_user_id)
+    artifact = ReportArtifact(
+        'adherence',
+        suffix=".csv" if response_format == 'csv' else ".json",
+        acting_user_id=acting_user_id,
+        include_test_role=include_test_role,
+        org_id=org_id,
+        research_study_id=research_study_id,
+        requested_as_of_date=(
+            requested_as_of_date or datetime.utcnow().date().isoformat()),
+        limit=limit,
+        high_water_mark=high_water_mark(
+            AdherenceData,
+            AdherenceData.rs_id_visit.like(f"{research_study_id}:%"),
+            updated=AdherenceData.valid_till))
 
     def patient_generator():
         """Generator for requested patients, updates job status as needed"""
@@ -425,11 +601,13 @@ def adherence_report(
             OrgTree().here_and_below_id(organization_id=org_id) if org_id
             else None)
 
+        # simply exclude any patients the user can't view
         patients = patients_query(
             acting_user=acting_user,
             include_test_role=include_test_role,
             research_study_id=research_study_id,
-            requested_orgs=requested_orgs)
+            requested_orgs=requested_orgs).filter(
+            acting_user.permission_filter('view'))
         current = 0
         total = limit if limit else patients.count()
         for patient in patients:
@@ -443,22 +621,98 @@ def adherence_report(
                 celery_task.update_state(
                     state='PROGRESS',
                     meta={'current': current, 'total': total})
-            try:
-                acting_user.check_role('view', other_id=patient.id)
-            except Unauthorized:
-                # simply exclude any patients the user can't view
-                continue
 
             yield patient
 
 
-    data = []
-    for patient in patient_generator():
-        patient_data = sorted_adherence_data(patient.id, research_study_id)
-        data.extend(patient_data)
-
+    column_headers = [
+        'user_id', 'study_id', 'status', 'visit', 'entry_method',
+        'country', 'site', 'site_code', 'consent', 'completion_date',
+        'oow_completion_date']
+    if research_study_id == EMPRO_RS_ID:
+        column_headers = [
+            'user_id',
+            'study_id',
+            'country',
+            'site',
+            'site_code',
+            'visit',
+            'status',
+            'EMPRO_questionnaire_completion_date',
+            'soft_trigger_domains',
+            'hard_trigger_domains',
+            'opted_out_domains',
+            'content_domains_accessed',
+            'clinician',
+            'clinician_status',
+            'clinician_survey_completion_date',
+            'delayed_by_holiday',
+            ]
+
+    counts = artifact.fresh()
+    if counts:
+        current_app.logger.debug(f"reusing report artifact {artifact.filename}")
+        return adherence_report_results(
+            artifact, counts, lock_key, response_format, acting_user_id,
+            org_id, column_headers)
+
+    # avoid exhausting memory (and the task result backend) by writing
+    # directly to a file, one patient at a time
+    tf = artifact.open()
+    if response_format == 'csv':
+        tf.write(','.join(column_headers) + '\n')
+    else:
+        header, footer = bundle_header_footer()
+        tf.write(header)
+
+    def patient_chunks(chunk_size=500):
+        """Group patient ids to fetch adherence data a chunk at a time"""
+        chunk = []
+        for patient in patient_generator():
+            chunk.append(patient.id)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    patient_count, row_count = 0, 0
+    for chunk in patient_chunks():
+        patient_count += len(chunk)
+        by_patient = bulk_sorted_adherence_data(chunk, research_study_id)
+        for row in (r for pid in chunk for r in by_patient.get(pid, [])):
+            if response_format == 'csv':
+                tf.write(','.join(
+                    ['"{}"'.format(row.get(k, "")) for k in column_headers]
+                ) + '\n')
+            else:
+                if row_count:
+                    tf.write(", ")
+                tf.write(json.dumps(row))
+            row_count += 1
+
+    if response_format != 'csv':
+        # total is only known once all rows are written; add at the end
+        tf.write('], "total": {}{}'.format(row_count, footer.lstrip(']')))
+    tf.close()
+
+    counts = {'patient_count': patient_count, 'row_count': row_count}
+    artifact.commit(**counts)
+    return adherence_report_results(
+        artifact, counts, lock_key, response_format, acting_user_id, org_id,
+        column_headers)
+
+
+def adherence_report_results(
+        artifact, counts, lock_key, response_format, acting_user_id, org_id,
+        column_headers):
+    """Returns the adherence report task results for the given artifact"""
     results = {
-        'data': data,
+        'filepath': artifact.filepath,
+        'filename': artifact.filename,
+        'content_encoding': artifact.content_encoding,
+        'patient_count': counts['patient_count'],
+        'row_count': counts['row_count'],
         'lock_key': lock_key,
         'response_format': response_format,
         'required_user_id': acting_user_id}
@@ -469,29 +723,7 @@ def adherence_report(
                 base_name,
                 Organization.query.get(org_id).name.replace(' ', '-'))
         results['filename_prefix'] = base_name
-        results['column_headers'] = [
-            'user_id', 'study_id', 'status', 'visit', 'entry_method',
-            'country', 'site', 'site_code', 'consent', 'completion_date',
-            'oow_completion_date']
-        if research_study_id == EMPRO_RS_ID:
-            results['column_headers'] = [
-                'user_id',
-                'study_id',
-                'country',
-                'site',
-                'site_code',
-                'visit',
-                'status',
-                'EMPRO_questionnaire_completion_date',
-                'soft_trigger_domains',
-                'hard_trigger_domains',
-                'opted_out_domains',
-                'content_domains_accessed',
-                'clinician',
-                'clinician_status',
-                'clinician_survey_completion_date',
-                'delayed_by_holiday',
-                ]
+        results['column_headers'] = column_headers
 
     return results
 
@@ -515,17 +747,34 @@ def research_report(
     """
     acting_user = User.query.get(acting_user_id)
 
-    # Rather than call current_user.check_role() for every patient
-    # in the bundle, delegate that responsibility to aggregate_responses()
-    filepath = aggregate_responses(
-        instrument_ids=instrument_ids,
-        current_user=acting_user,
-        celery_task=celery_task,
-        bundle_format=response_format=='json')
+    instrument_criteria = (
+        [ResearchData.instrument.in_(tuple(instrument_ids))]
+        if instrument_ids else [])
+    artifact = ReportArtifact(
+        'research',
+        suffix=".json" if response_format == 'json' else ".csv",
+        acting_user_id=acting_user_id,
+        instrument_ids=sorted(instrument_ids or []),
+        high_water_mark=high_water_mark(ResearchData, *instrument_criteria))
+
+    if artifact.fresh():
+        current_app.logger.debug(f"reusing report artifact {artifact.filename}")
+        filepath = artifact.filepath
+    else:
+        # Rather than call current_user.check_role() for every patient
+        # in the bundle, delegate that responsibility to aggregate_responses()
+        filepath = aggregate_responses(
+            instrument_ids=instrument_ids,
+            current_user=acting_user,
+            celery_task=celery_task,
+            bundle_format=response_format=='json',
+            artifact=artifact,
+            workers=current_app.config['AGGREGATE_WORKERS'])
     results = {
         'lock_key': lock_key,
         'filepath': filepath,
-        'filename': path.basename(filepath),
+        'filename': artifact.filename,
+        'content_encoding': artifact.content_encoding,
         'response_format': response_format,
         'required_roles': [ROLE.RESEARCHER.value]}
 
@@ -621,7 +870,13 @@ def empro_overdue_stats():
     # use system user to avoid pruning any patients during cache population
     sys = User.query.filter_by(email='__system__').one()
 
-    for user in patients_query(acting_user=sys, research_study_id=EMPRO_RS_ID):
+    patients = patients_query(
+        acting_user=sys, research_study_id=EMPRO_RS_ID).all()
+    # only the latest trigger states are used, load for all in one query
+    ts_reporting = TriggerStatesReporting.for_patients(
+        [user.id for user in patients], visit_details=False)
+
+    for user in patients:
         qb_stats = QB_Status(
             user=user,
             research_study_id=EMPRO_RS_ID,
@@ -651,9 +906,8 @@ def empro_overdue_stats():
                 visit = visit_name(qbd)
                 visit_month = int(visit.split()[-1]) - 1
 
-                # Initialize trigger states reporting for patient
-                ts_reporting = TriggerStatesReporting(patient_id=user.id)
-                t_status = ts_reporting.latest_action_state(visit_month)
+                t_status = ts_reporting[user.id].latest_action_state(
+                    visit_month)
                 clinician_status = t_status.title() if t_status else ""
                 if not clinician_status:
                     if qb_stats.overall_status in (OverallStatus.withdrawn, OverallStatus.expired):
@@ -677,7 +931,7 @@ def empro_overdue_stats():
                         user.clinicians),
                     clinician_status=clinician_status,
                     clinician_survey_completion_date=report_format(
-                        ts_reporting.resolution_authored_from_visit(
+                        ts_reporting[user.id].resolution_authored_from_visit(
                             visit_month)) or ""
                 )
             overdue_stats[(org.id, org.name)].append(row)
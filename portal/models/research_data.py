@@ -1,18 +1,28 @@
 """ model data for questionnaire response 'research data' reports """
+from collections import defaultdict
+from datetime import datetime
+from time import perf_counter
+from uuid import uuid4
+
 from celery.utils.log import get_task_logger
 from flask import current_app
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import JSONB, insert
+from sqlalchemy.orm import selectinload
 from sqlalchemy import text
 
 from ..database import db
-from ..date_tools import FHIR_datetime
+from ..factories.redis import create_redis
 from .reference import Reference
 from .research_study import research_study_id_from_questionnaire
+from .scheduled_job import update_job_status
 from .user import User, unchecked_get_user
 from .role import ROLE
 
 task_logger = get_task_logger(__name__)
 
+RESEARCH_DATA_RUN_KEY = "research_data_backfill:{}"
+RESEARCH_DATA_RUN_EXPIRATION = 60 * 60 * 24  # one day, in seconds
+
 
 class ResearchData(db.Model):
     """ Cached adherence report data
@@ -50,20 +60,268 @@ def cache_research_data(job_id=None, manual_run=None):
     This routine is called as a scheduled task, to pick up any interrupted
     or overlooked rows.  As questionnaire responses are posted to the system,
     they are added to the cache immediately.
+
+    Missing rows are grouped by subject, and the subjects split across
+    `RESEARCH_DATA_BACKFILL_WORKERS` partitions of similar size.  Each
+    partition is backfilled by its own task, gathered in a chord callback
+    which records the overall outcome in the scheduled job status.
+
+    :returns: status message
     """
+    from celery import chord
+    from ..tasks import (
+        backfill_research_data_task,
+        summarize_research_data_backfill_task,
+    )
     from .questionnaire_response import QuestionnaireResponse
     deleted_subjects = db.session.query(User.id).filter(User.deleted_id.isnot(None)).subquery()
     already_cached = db.session.query(ResearchData.questionnaire_response_id).subquery()
     qnrs = QuestionnaireResponse.query.filter(
         QuestionnaireResponse.questionnaire_bank_id > 0).filter(
         QuestionnaireResponse.subject_id.notin_(deleted_subjects)).filter(
-        QuestionnaireResponse.id.notin_(already_cached))
+        QuestionnaireResponse.id.notin_(already_cached)).with_entities(
+        QuestionnaireResponse.subject_id, QuestionnaireResponse.id)
 
+    missing = defaultdict(list)
+    for subject_id, qnr_id in qnrs:
+        missing[subject_id].append(qnr_id)
+    qnr_count = sum(len(ids) for ids in missing.values())
     current_app.logger.info(
-        f"found {qnrs.count()} questionnaire responses missing from research_data cache")
+        f"found {qnr_count} questionnaire responses missing from research_data cache")
+    if not missing:
+        message = "no questionnaire responses missing from research_data cache"
+        if job_id:
+            update_job_status(job_id, status=message)
+        return message
+
+    partitions = partition_subjects(
+        missing, current_app.config['RESEARCH_DATA_BACKFILL_WORKERS'])
+    started = datetime.utcnow().isoformat()
+    run_key = RESEARCH_DATA_RUN_KEY.format(uuid4().hex)
+    partition_kwargs = {
+        'run_key': run_key,
+        'qnr_count': qnr_count,
+        'started': started,
+        'job_id': job_id}
+    message = (
+        f"queued {qnr_count} questionnaire responses for {len(missing)} "
+        f"subjects across {len(partitions)} workers")
+    if job_id:
+        # partitions and the chord callback follow with progress and status
+        update_job_status(job_id, status=message)
+    chord(
+        backfill_research_data_task.s(
+            missing={str(k): missing[k] for k in partition},
+            **partition_kwargs)
+        for partition in partitions)(summarize_research_data_backfill_task.s(
+            started=started, run_key=run_key, job_id=job_id))
+    return message
+
+
+def partition_subjects(missing, workers):
+    """Split subjects into at most `workers` partitions of similar size
+
+    :param missing: dictionary of missing QNR ids keyed by subject id
+    :param workers: maximum number of partitions
+    :returns: list of subject id lists, balanced by the number of QNRs
+
+    """
+    partitions = [[] for _ in range(max(min(workers, len(missing)), 1))]
+    sizes = [0] * len(partitions)
+    # largest first, each to the least loaded partition
+    for subject_id in sorted(missing, key=lambda k: -len(missing[k])):
+        i = sizes.index(min(sizes))
+        partitions[i].append(subject_id)
+        sizes[i] += len(missing[subject_id])
+    return [p for p in partitions if p]
+
+
+def research_subject(subject):
+    """Returns the subject details included in research data documents
+
+    Limited to the "careProvider" and "identifier" fields from the patient
+    FHIR, with organization references including any PCCTC identifiers.
+
+    """
+    subject_fields = {
+        "identifier": [i.as_fhir() for i in subject.identifiers]}
+    if subject.organizations:
+        providers = []
+        for org in subject.organizations:
+            org_ref = Reference.organization(org.id).as_fhir()
+            identifiers = [
+                i.as_fhir() for i in org.identifiers if i.system == "http://pcctc.org/"]
+            if identifiers:
+                org_ref['identifier'] = identifiers
+            providers.append(org_ref)
+    else:
+        providers = []
+        if subject.practitioner_id:
+            providers.append(
+                Reference.practitioner(subject.practitioner_id).as_fhir())
+        for clinician in subject.clinicians:
+            providers.append(Reference.clinician(clinician.id).as_fhir())
+    subject_fields["careProvider"] = providers
+    return subject_fields
+
+
+def subject_research_rows(subject_id, qnr_ids):
+    """Build research_data rows for the given QNRs of a single subject
+
+    The subject details and visit names are looked up once for all of the
+    subject's QNRs, the latter from a single read of each timeline.
+
+    :returns: list of row dictionaries, ready for insertion
+    """
+    from .qb_timeline import qb_visit_names
+    from .questionnaire_response import QuestionnaireResponse
+
+    subject = User.query.get(subject_id)
+    subject_fields = research_subject(subject)
+    qnrs = QuestionnaireResponse.query.filter(
+        QuestionnaireResponse.id.in_(qnr_ids)).filter(
+        QuestionnaireResponse.questionnaire_bank_id > 0).options(
+        selectinload(QuestionnaireResponse.encounter))
+
+    by_study = defaultdict(list)
     for qnr in qnrs:
-        # research_study_id of None triggers a lookup
-        add_questionnaire_response(qnr, research_study_id=None)
+        by_study[research_study_id_from_questionnaire(qnr.instrument_id)].append(qnr)
+
+    rows = []
+    for research_study_id, study_qnrs in by_study.items():
+        visit_names = qb_visit_names(
+            subject_id, research_study_id, [qnr.authored for qnr in study_qnrs])
+        for qnr in study_qnrs:
+            document = qnr.document_answered
+            document['encounter'] = qnr.encounter.as_fhir()
+            document["subject"] = subject_fields
+            document["timepoint"] = visit_names[qnr.authored]
+            rows.append({
+                'subject_id': subject_id,
+                'questionnaire_response_id': qnr.id,
+                'instrument': qnr.instrument_id,
+                'research_study_id': research_study_id,
+                'authored': qnr.authored,
+                'data': document})
+    return rows
+
+
+def insert_research_rows(rows):
+    """Batch insert research_data rows, skipping any cached concurrently
+
+    :returns: number of rows inserted
+    """
+    if not rows:
+        return 0
+    statement = insert(ResearchData.__table__).on_conflict_do_nothing(
+        index_elements=['questionnaire_response_id'])
+    result = db.session.execute(statement, rows)
+    db.session.commit()
+    return result.rowcount
+
+
+def backfill_research_data(
+        missing, run_key=None, qnr_count=None, started=None, job_id=None):
+    """Add the given missing QNRs to the research_data cache in bulk
+
+    Rows are inserted in batches of `RESEARCH_DATA_INSERT_BATCH_SIZE`, each
+    batch committed in a single statement.  A failure on any one subject,
+    or insert of any one batch, is logged and counted (per subject), so the
+    remainder (and any chord gathering results) still completes.
+
+    :param missing: dictionary of missing QNR ids keyed by subject id
+    :param run_key: redis key shared by all partitions of the same run,
+      used to tally progress
+    :param qnr_count: total number of QNRs missing in the run
+    :param started: isoformat string of time the run began, for rate
+    :param job_id: scheduled job to receive progress status, if defined
+    :returns: dict with counts of subjects, added rows and errors
+
+    """
+    batch_size = current_app.config['RESEARCH_DATA_INSERT_BATCH_SIZE']
+    started = datetime.fromisoformat(started) if started else datetime.utcnow()
+    qnr_count = qnr_count or sum(len(ids) for ids in missing.values())
+    rs = create_redis(current_app.config['REDIS_URL']) if run_key else None
+    added, errors, pending, pending_subjects = 0, 0, [], []
+
+    def flush():
+        nonlocal added, errors
+        start = perf_counter()
+        try:
+            inserted = insert_research_rows(pending)
+        except Exception as e:
+            db.session.rollback()
+            errors += len(pending_subjects)
+            current_app.logger.error(
+                f"failed to insert research data for subjects "
+                f"{pending_subjects}: {e}")
+            return
+        finally:
+            pending.clear()
+            pending_subjects.clear()
+        added += inserted
+
+        total = added
+        if rs:
+            pipe = rs.pipeline()
+            pipe.hincrby(run_key, 'added', inserted)
+            pipe.expire(run_key, RESEARCH_DATA_RUN_EXPIRATION)
+            total, _ = pipe.execute()
+        elapsed = (datetime.utcnow() - started).total_seconds() or 1
+        status = (
+            f"cache_research_data in progress: {total} of {qnr_count} rows, "
+            f"{total / elapsed:.1f} rows/sec")
+        task_logger.info(
+            f"{status}; batch of {inserted} in {perf_counter() - start:.2f}s")
+        if job_id:
+            update_job_status(job_id, status=status)
+
+    for subject_id, qnr_ids in missing.items():
+        try:
+            pending.extend(subject_research_rows(int(subject_id), qnr_ids))
+        except Exception as e:
+            db.session.rollback()
+            errors += 1
+            current_app.logger.error(
+                f"failed to build research data for subject {subject_id}: {e}")
+            continue
+        pending_subjects.append(subject_id)
+        if len(pending) >= batch_size:
+            flush()
+    if pending:
+        flush()
+
+    return {'subjects': len(missing), 'added': added, 'errors': errors}
+
+
+def summarize_research_data_backfill(
+        partition_results, started, run_key, job_id=None):
+    """Combine per partition results on completion of a backfill run
+
+    :param partition_results: list of `backfill_research_data()` return values
+    :param started: isoformat string of time the run began
+    :param run_key: redis key used to tally progress, removed on completion
+    :param job_id: scheduled job to receive the final status, if defined
+    :returns: status message
+
+    """
+    totals = defaultdict(int)
+    for result in partition_results:
+        for k, v in result.items():
+            totals[k] += v
+    elapsed = (
+        datetime.utcnow() - datetime.fromisoformat(started)).total_seconds()
+    message = (
+        f"cache_research_data completed {totals['subjects']} subjects in "
+        f"{len(partition_results)} workers, {totals['added']} rows added, "
+        f"{totals['errors']} errors in {int(elapsed)} seconds "
+        f"({totals['added'] / (elapsed or 1):.1f} rows/sec)")
+    current_app.logger.info(message)
+
+    create_redis(current_app.config['REDIS_URL']).delete(run_key)
+    if job_id:
+        update_job_status(job_id, status=message)
+    return message
 
 
 def invalidate_qnr_research_data(questionnaire_response):
@@ -107,33 +365,19 @@ def add_questionnaire_response(questionnaire_response, research_study_id):
     # Asynchronous requests, look out for threads updating the same subject, QNR
     key = f"add_research_data.{questionnaire_response.subject_id}:{questionnaire_response.id}"
     with TimeoutLock(key, expires=60, timeout=60):
-        instrument = questionnaire_response.document['questionnaire']['reference'].split('/')[-1]
+        instrument = questionnaire_response.instrument_id
         if research_study_id is None:
             research_study_id = research_study_id_from_questionnaire(instrument)
 
-        patient_fields = ("careProvider", "identifier")
         document = questionnaire_response.document_answered.copy()
         subject = questionnaire_response.subject
         document['encounter'] = questionnaire_response.encounter.as_fhir()
-        document["subject"] = {
-            k: v for k, v in subject.as_fhir().items() if k in patient_fields
-        }
-
-        if subject.organizations:
-            providers = []
-            for org in subject.organizations:
-                org_ref = Reference.organization(org.id).as_fhir()
-                identifiers = [
-                    i.as_fhir() for i in org.identifiers if i.system == "http://pcctc.org/"]
-                if identifiers:
-                    org_ref['identifier'] = identifiers
-                providers.append(org_ref)
-            document["subject"]["careProvider"] = providers
+        document["subject"] = research_subject(subject)
 
         qb_status = qb_status_visit_name(
             subject.id,
             research_study_id,
-            FHIR_datetime.parse(questionnaire_response.document['authored']))
+            questionnaire_response.authored)
         document["timepoint"] = qb_status['visit_name']
 
         research_data = ResearchData(
@@ -141,7 +385,7 @@ def add_questionnaire_response(questionnaire_response, research_study_id):
             questionnaire_response_id=questionnaire_response.id,
             instrument=instrument,
             research_study_id=research_study_id,
-            authored=FHIR_datetime.parse(document['authored']),
+            authored=questionnaire_response.authored,
             data=document
         )
         db.session.add(research_data)
@@ -156,10 +400,9 @@ def validate(reprocess=False):
 
     Generate a report for any missing, and if reprocess is set, regenerate those found missing.
     """
-    from .questionnaire_response import QuestionnaireResponse
     query = ("SELECT DISTINCT(subject_id) FROM questionnaire_responses WHERE questionnaire_bank_id > 0 AND"
              " id NOT IN (SELECT questionnaire_response_id FROM research_data) ORDER BY subject_id")
-    missing_qnr_ids = []
+    missing = {}
     for row in db.engine.execute(query):
         pat_id = row.subject_id
         patient = unchecked_get_user(pat_id, allow_deleted=True)
@@ -175,11 +418,10 @@ def validate(reprocess=False):
         patient_missing_qnr_ids = [
             row.id for row in db.engine.execute(missing_research_data, {'subject_id': pat_id})]
         task_logger.debug(f"Missing {len(patient_missing_qnr_ids)} research_data rows for {pat_id}")
-        missing_qnr_ids.extend(patient_missing_qnr_ids)
+        missing[pat_id] = patient_missing_qnr_ids
 
     if reprocess:
         task_logger.info(
-            f"reprocessing {len(missing_qnr_ids)} missing qnrs from research_data table")
-        for qnr_id in missing_qnr_ids:
-            qnr = QuestionnaireResponse.query.get(qnr_id)
-            add_questionnaire_response(qnr, research_study_id=None)
+            f"reprocessing {sum(len(ids) for ids in missing.values())} missing qnrs"
+            " from research_data table")
+        backfill_research_data(missing)
@@ -30,6 +30,15 @@ class ResearchProtocol(db.Model):
             self.created_at = FHIR_datetime.parse(data['created_at'])
         return self
 
+    def invalidation_hook(self):
+        """Endpoint called during site persistence import on change
+
+        Purge compiled protocol schedules, as they're keyed by protocol.
+
+        """
+        from .protocol_schedule import ProtocolSchedule
+        ProtocolSchedule.invalidate_cache()
+
     def as_json(self):
         return {
             'id': self.id,
@@ -56,3 +65,44 @@ class ResearchProtocol(db.Model):
                     research_study_id, consider_parents=True):
                 rps.add(r)
         return rps
+
+    @staticmethod
+    def assigned_to_users(users, research_study_id):
+        """Bulk form of ``assigned_to()`` for a batch of users
+
+        Looks up all organization research protocols and the organization
+        hierarchy in two queries, rather than several per organization.
+
+        :returns: dictionary keyed by user id, of the set of tuples
+          (ResearchProtocol, retired) ``assigned_to()`` would return
+
+        """
+        from .organization import Organization, OrganizationResearchProtocol
+
+        parents = dict(Organization.query.with_entities(
+            Organization.id, Organization.partOf_id))
+        query = OrganizationResearchProtocol.query.join(
+            ResearchProtocol).filter(
+            OrganizationResearchProtocol.research_protocol_id ==
+            ResearchProtocol.id).with_entities(
+            OrganizationResearchProtocol.organization_id,
+            ResearchProtocol,
+            OrganizationResearchProtocol.retired_as_of)
+        if research_study_id != "all":
+            query = query.filter(
+                ResearchProtocol.research_study_id == research_study_id)
+        rps_by_org = {}
+        for org_id, rp, retired_as_of in query:
+            rps_by_org.setdefault(org_id, []).append((rp, retired_as_of))
+
+        results = {}
+        for user in users:
+            rps = set()
+            for org in user.organizations:
+                # continue up the org hierarchy till one is found
+                org_id = org.id
+                while org_id and org_id not in rps_by_org:
+                    org_id = parents.get(org_id)
+                rps.update(rps_by_org.get(org_id, ()))
+            results[user.id] = rps
+        return results
@@ -65,4 +65,7 @@ class TablePreference(db.Model):
             if attr in data:
                 setattr(pref, attr, data[attr])
         pref.updated_at = datetime.now()
+
+        from .patient_list import invalidate_viewable_orgs
+        invalidate_viewable_orgs(pref.user_id)
         return pref
@@ -16,7 +16,7 @@ from flask_babel import gettext as _
 from flask_login import current_user as flask_login_current_user
 from flask_user import UserMixin, _call_or_get
 from fuzzywuzzy import fuzz
-from sqlalchemy import and_, func, Enum, or_, UniqueConstraint
+from sqlalchemy import and_, func, Enum, or_, true, UniqueConstraint
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import ColumnProperty, class_mapper, synonym
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
@@ -952,9 +952,11 @@ class User(db.Model, UserMixin):
 
     def add_organization(self, organization_name):
         """Shortcut to add a clinic/organization by name"""
+        from .patient_list import invalidate_viewable_orgs
         org = Organization.query.filter_by(name=organization_name).one()
         if org not in self.organizations:
             self.organizations.append(org)
+            invalidate_viewable_orgs(self.id)
 
     def first_top_organization(self):
         """Return first top level organization for user
@@ -1510,6 +1512,9 @@ class User(db.Model, UserMixin):
                 allow_org_change(org, user=self, acting_user=acting_user)
             self.organizations.remove(org)
 
+        from .patient_list import invalidate_viewable_orgs
+        invalidate_viewable_orgs(self.id)
+
     def add_roles(self, role_list, acting_user):
         """Add one or more roles to user's existing roles
 
@@ -2013,6 +2018,107 @@ class User(db.Model, UserMixin):
 
         abort(401, "Inadequate role for {} of {}".format(permission, other_id))
 
+    def permission_filter(
+            self, permission, allow_on_url_authenticated_encounters=False):
+        """Bulk form of ``check_role()``, as a SQL filter on ``User.id``
+
+        Rather than query the other user and walk the org tree for every
+        individual check, generate a single expression applying the same
+        rules as ``check_role()``, for composition into any query on
+        ``User``.  NB - unlike ``check_role()``, users not found or lacking
+        permission are simply filtered out.
+
+        :param permission: 'view' or 'edit'
+        :param allow_on_url_authenticated_encounters: see ``check_role()``
+        :returns: SQLAlchemy expression, true for users on which self has
+          the requested permission
+        :raises: 401 Unauthorized on inadequate auth_method, as done
+          by ``check_role()``
+
+        """
+        from .user_consent import (  # avoid cycle
+            STAFF_EDITABLE_MASK,
+            UserConsent,
+        )
+
+        assert (permission in ('view', 'edit'))  # limit vocab for now
+        if (
+                not allow_on_url_authenticated_encounters and
+                current_app.config.get('ENABLE_URL_AUTHENTICATED') and
+                self.current_encounter().auth_method == 'url_authenticated'):
+            abort(401, "inadequate auth_method: {}".format(
+                self.current_encounter().auth_method))
+
+        if self.has_role(ROLE.ADMIN.value, ROLE.SERVICE.value):
+            return true()
+
+        def with_role(*role_names):
+            return User.roles.any(Role.name.in_(role_names))
+
+        # Sets of org ids at or below, and at or above, any of self's orgs
+        orgtree = OrgTree()
+        org_ids = {org.id for org in self.organizations}
+        below, above = set(org_ids), set(org_ids)
+        for org_id in org_ids:
+            below.update(orgtree.here_and_below_id(org_id))
+            if org_id:
+                above.update(orgtree.at_and_above_ids(org_id))
+
+        def org_at_or_below():
+            return User.id.in_(UserOrganization.query.filter(
+                UserOrganization.organization_id.in_(below)).with_entities(
+                UserOrganization.user_id))
+
+        clauses = [User.id == self.id]
+        if self.has_role(
+                ROLE.STAFF.value, ROLE.STAFF_ADMIN.value,
+                ROLE.CLINICIAN.value):
+            # See ``check_role()`` - a valid consent at or below the
+            # staff's orgs, or above the staff's orgs when the patient's
+            # org is at or below
+            consents = UserConsent.query.filter(
+                UserConsent.deleted_id.is_(None))
+            if permission == 'edit':
+                consents = consents.filter(
+                    UserConsent.options.op('&')(STAFF_EDITABLE_MASK) != 0)
+
+            def consented_to(org_set):
+                return User.id.in_(consents.filter(
+                    UserConsent.organization_id.in_(org_set)).with_entities(
+                    UserConsent.user_id))
+
+            clauses.append(and_(with_role(ROLE.PATIENT.value), or_(
+                consented_to(below),
+                and_(consented_to(above), org_at_or_below()))))
+
+        staff_roles = [ROLE.STAFF.value, ROLE.CLINICIAN.value]
+        if self.has_role(ROLE.STAFF_ADMIN.value):
+            staff_roles.append(ROLE.STAFF_ADMIN.value)
+        clauses.append(and_(with_role(*staff_roles), org_at_or_below()))
+
+        if self.has_role(ROLE.INTERVENTION_STAFF.value):
+            clauses.append(and_(
+                with_role(ROLE.PATIENT.value),
+                User.id.in_(UserIntervention.query.filter(
+                    UserIntervention.intervention_id.in_(
+                        [i.id for i in self.interventions])).with_entities(
+                    UserIntervention.user_id))))
+
+        return or_(*clauses)
+
+    def permitted_user_ids(self, permission, user_ids):
+        """Bulk form of ``check_role()`` for a number of users
+
+        :param permission: 'view' or 'edit'
+        :param user_ids: iterable of user ids, or a query returning them
+        :returns: set of the given user ids on which self has the requested
+          permission
+
+        """
+        query = User.query.filter(User.id.in_(user_ids)).filter(
+            self.permission_filter(permission)).with_entities(User.id)
+        return {uid for uid, in query}
+
     def has_role(self, *roles):
         """Given one or more roles by name, true if user has at least one"""
         users_roles = set((r.name for r in self.roles))
@@ -1,12 +1,15 @@
 """User Consent module"""
 from datetime import datetime, timedelta
 
-from sqlalchemy import Enum
+from sqlalchemy import Enum, event
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import object_session
 from validators import ValidationFailure, url as url_validation
 
 from ..database import db
 from ..date_tools import FHIR_datetime, utcnow_sans_micro
+from ..patient_generation import bump_on_commit
+from ..scoped_cache import invalidate_scoped, scoped_memoize
 from .audit import Audit
 from .organization import Organization
 from .user import User
@@ -152,6 +155,15 @@ class UserConsent(db.Model):
         return obj
 
 
+@event.listens_for(UserConsent, 'after_insert')
+@event.listens_for(UserConsent, 'after_update')
+@event.listens_for(UserConsent, 'after_delete')
+def purge_scoped_consent_data(mapper, connection, target):
+    """Consent changes alter the user's trigger date and timeline"""
+    invalidate_scoped(target.user_id, research_study_id='all')
+    bump_on_commit(object_session(target), target.user_id)
+
+
 def latest_consent(user, research_study_id):
     """Lookup latest valid consent for user
 
@@ -175,6 +187,7 @@ def latest_consent(user, research_study_id):
     return None
 
 
+@scoped_memoize('consent_withdrawal_dates')
 def consent_withdrawal_dates(user, research_study_id):
     """Lookup user's most recent consent and withdrawal dates
 
@@ -0,0 +1,67 @@
+"""Module for per patient cache generations
+
+Values cached across requests and processes, such as
+``qb_status_visit_name()``, include the patient's generation in the cache
+key.  Any change affecting the patient's timeline bumps the generation,
+orphaning every prior entry at once, in place of deleting each by its
+exact arguments.  Orphaned entries simply expire.
+
+Changes to QuestionnaireResponses and consents are flushed within a
+transaction; the generation is bumped only once that transaction commits,
+so a concurrent reader can't cache uncommitted state under the new
+generation.
+
+"""
+from flask import current_app
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+from .factories.redis import create_redis
+
+GENERATION_KEY = "patient_cache_generation:{user_id}"
+# Outlive any entry cached under a generation, so an expired counter
+# never restarts at a value still in use
+GENERATION_EXPIRATION = 7 * 24 * 60 * 60  # one week, in seconds
+PENDING_KEY = 'patient_generation_pending'
+
+
+def generation(user_id):
+    """Returns current cache generation for the patient"""
+    rs = create_redis(current_app.config['REDIS_URL'])
+    value = rs.get(GENERATION_KEY.format(user_id=user_id))
+    return int(value) if value else 0
+
+
+def bump_generation(user_id):
+    """Orphan all values cached under the patient's current generation
+
+    :returns: the new generation
+    """
+    rs = create_redis(current_app.config['REDIS_URL'])
+    key = GENERATION_KEY.format(user_id=user_id)
+    pipe = rs.pipeline()
+    pipe.incr(key)
+    pipe.expire(key, GENERATION_EXPIRATION)
+    return pipe.execute()[0]
+
+
+def bump_on_commit(session, user_id):
+    """Bump the patient's generation once the session commits
+
+    Pending bumps survive a rollback, only to be applied on a later commit,
+    as a spurious bump costs no more than a cache miss.
+
+    """
+    session.info.setdefault(PENDING_KEY, set()).add(user_id)
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def bump_pending(session):
+    """Apply bumps recorded with ``bump_on_commit()``
+
+    Registered on the session class, so the bumps apply to every session,
+    including those celery tasks open via ``db.create_scoped_session()``.
+
+    """
+    for user_id in session.info.pop(PENDING_KEY, ()):
+        bump_generation(user_id)
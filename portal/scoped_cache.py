@@ -0,0 +1,140 @@
+"""Module for request and task scoped memoization of patient state
+
+A single request or celery task often builds ``QB_Status``,
+``QNR_results``, ``trigger_date`` and ``consent_withdrawal_dates`` for the
+same user and research study several times over, each build re-querying
+the timeline and response tables.  Within an open scope, results are held
+in ``flask.g`` by user, keyed by (kind, research_study_id, as_of_date),
+and reused on repeat.
+
+Only the `MAX_SCOPED_USERS` most recently used users are held, so a task
+looping over many patients doesn't grow the scope with each.
+
+A scope is opened at the start of every request and celery task, and
+discarded at its end.  Outside a scope, such as CLI commands or direct
+model use in tests, every call builds as before.
+
+Entries for a user are purged on ``invalidate_users_QBT()`` and whenever a
+change to the user's QuestionnaireResponses or consents is flushed.
+
+"""
+from collections import Counter, OrderedDict
+from functools import wraps
+
+from flask import g, has_app_context
+
+MAX_SCOPED_USERS = 2
+
+
+def open_scope():
+    """Begin a fresh scope, discarding any prior state"""
+    g.scoped_cache = OrderedDict()
+    g.scoped_cache_avoided = Counter()
+
+
+def close_scope():
+    """Discard the active scope
+
+    :returns: Counter of rebuilds avoided by kind, during the scope
+
+    """
+    if not has_app_context():
+        return Counter()
+    g.pop('scoped_cache', None)
+    return g.pop('scoped_cache_avoided', Counter())
+
+
+def _store():
+    """Returns the active scope's store, or None if no scope is open"""
+    if not has_app_context():
+        return None
+    return g.get('scoped_cache')
+
+
+def _user_store(store, user_id):
+    """Returns the user's entries, marked most recently used
+
+    Entries for the least recently used user are discarded once more than
+    `MAX_SCOPED_USERS` are held.
+
+    """
+    if user_id in store:
+        store.move_to_end(user_id)
+        return store[user_id]
+    store[user_id] = {}
+    while len(store) > MAX_SCOPED_USERS:
+        store.popitem(last=False)
+    return store[user_id]
+
+
+def scoped_get(kind, user_id, research_study_id, as_of_date=None):
+    """Returns value held in the active scope, or None if not found"""
+    store = _store()
+    if store is None or user_id not in store:
+        return None
+    value = _user_store(store, user_id).get(
+        (kind, research_study_id, as_of_date))
+    if value is not None:
+        g.scoped_cache_avoided[kind] += 1
+    return value
+
+
+def scoped_set(kind, user_id, research_study_id, as_of_date, value):
+    """Hold value in the active scope, if one is open"""
+    store = _store()
+    if store is not None:
+        _user_store(store, user_id)[
+            (kind, research_study_id, as_of_date)] = value
+
+
+def scoped_memoize(kind):
+    """Decorator for functions of (user, research_study_id)
+
+    Results are memoized within the active scope.  Calls including any
+    further arguments, such as ``trigger_date(..., qb=qb)``, always run.
+
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(user, research_study_id, *args, **kwargs):
+            if args or any(v is not None for v in kwargs.values()):
+                return fn(user, research_study_id, *args, **kwargs)
+
+            store = _store()
+            if store is None:
+                return fn(user, research_study_id)
+            key = (kind, research_study_id, None)
+            if key in _user_store(store, user.id):
+                g.scoped_cache_avoided[kind] += 1
+                return store[user.id][key]
+            value = fn(user, research_study_id)
+            _user_store(store, user.id)[key] = value
+            return value
+        return wrapper
+    return decorator
+
+
+def invalidate_scoped(user_id, research_study_id='all'):
+    """Purge the user's entries from the active scope
+
+    :param user_id: user whose entries to purge
+    :param research_study_id: limit purge to research study, or
+      'all' for every research study
+
+    """
+    store = _store()
+    if not store or user_id not in store:
+        return
+    if research_study_id == 'all':
+        del store[user_id]
+        return
+    user_store = store[user_id]
+    for key in [k for k in user_store if k[1] == research_study_id]:
+        del user_store[key]
+
+
+def avoided_rebuilds():
+    """Returns Counter of rebuilds avoided by kind, in the active scope"""
+    if not has_app_context():
+        return Counter()
+    return Counter(g.get('scoped_cache_avoided', {}))
@@ -7,8 +7,9 @@ NB: a celery worker must be started for these to ever return.  See
 `celery_worker.py`
 
 """
+from collections import defaultdict
 from datetime import datetime
-from functools import wraps
+from functools import partial, wraps
 import json
 from traceback import format_exc
 
@@ -23,18 +24,34 @@ from .factories.app import create_app
 from .factories.redis import create_redis
 from .factories.celery import create_celery
 from .models.communication import Communication
+from .models.communication_dispatch import (
+    PooledMailer,
+    dispatch_communications,
+    queue_dispatch,
+)
 from .models.communication_request import queue_outstanding_messages
 from .models.message import Newsletter
 from .models.qb_status import QB_Status
-from .models.qb_timeline import invalidate_users_QBT, update_users_QBT
+from .models.qb_timeline import (
+    invalidate_users_QBT,
+    update_users_QBT_batch,
+)
+from .models.report_artifact import purge_report_artifacts
 from .models.reporting import (
+    adherence_chunks_failed,
+    adherence_data_chunk,
     adherence_report,
     cache_adherence_data,
     generate_and_send_summaries,
     research_report,
     single_patient_adherence_data,
+    summarize_adherence_chunks,
+)
+from .models.research_data import (
+    backfill_research_data,
+    cache_research_data,
+    summarize_research_data_backfill,
 )
-from .models.research_data import cache_research_data
 from .models.research_study import ResearchStudy
 from .models.role import ROLE, Role
 from .models.scheduled_job import check_active, update_job_status
@@ -58,7 +75,19 @@ celery = create_celery(create_app())
 LOW_PRIORITY = 'low_priority'
 
 
-def scheduled_task(func):
+def scheduled_task(func=None, record_status=True):
+    """Decorator for tasks run as scheduled jobs
+
+    Skips inactive jobs, and records the outcome in the job status.
+
+    :param record_status: set False for tasks that only dispatch work,
+      whose completion records the final status.  Failures to dispatch
+      are still recorded.
+
+    """
+    if func is None:
+        return partial(scheduled_task, record_status=record_status)
+
     @wraps(func)
     def call_and_update(*args, **kwargs):
         job_id = kwargs.get('job_id')
@@ -78,13 +107,15 @@ def scheduled_task(func):
             if output:
                 message += " {}".format(output)
             current_app.logger.debug(message)
+            failed = False
         except Exception as exc:
             message = ("Unexpected exception in `{}` "
                        "on {} : {}".format(func.__name__, job_id, exc))
             current_app.logger.error(message)
             current_app.logger.error(format_exc())
+            failed = True
 
-        if job_id:
+        if job_id and (record_status or failed):
             update_job_status(job_id, status=message)
 
         return message
@@ -113,12 +144,34 @@ def info():
 
 @celery.task(
     queue=LOW_PRIORITY)
-@scheduled_task
+@scheduled_task(record_status=False)
 def cache_adherence_data_task(**kwargs):
-    """Queues up all patients needing a cache refresh"""
+    """Queues up chunks of all patients needing a cache refresh
+
+    Job status is left to the chunks and chord callback, lest the dispatch
+    overwrite their progress.
+    """
     return cache_adherence_data(**kwargs)
 
 
+@celery.task(queue=LOW_PRIORITY)
+def cache_adherence_data_chunk_task(**kwargs):
+    """Populates adherence data for a chunk of patients"""
+    return adherence_data_chunk(**kwargs)
+
+
+@celery.task(queue=LOW_PRIORITY)
+def cache_adherence_data_summary_task(chunk_results, **kwargs):
+    """Chord callback, records outcome of all adherence data chunks"""
+    return summarize_adherence_chunks(chunk_results, **kwargs)
+
+
+@celery.task(queue=LOW_PRIORITY)
+def cache_adherence_data_failed_task(request, exc, traceback, **kwargs):
+    """Chord errback, records failure of any adherence data chunk"""
+    return adherence_chunks_failed(exc, **kwargs)
+
+
 @celery.task(queue=LOW_PRIORITY, ignore_results=True)
 def cache_single_patient_adherence_data(**kwargs):
     """Populates adherence data for a single patient"""
@@ -133,12 +186,28 @@ def adherence_report_task(self, **kwargs):
 
 
 @celery.task(queue=LOW_PRIORITY)
-@scheduled_task
+@scheduled_task(record_status=False)
 def cache_research_data_task(**kwargs):
-    """Queues up all patients needing a cache refresh"""
+    """Queues up all patients needing a cache refresh
+
+    Job status is left to the partitions and chord callback, lest the
+    dispatch overwrite their progress.
+    """
     return cache_research_data(**kwargs)
 
 
+@celery.task(queue=LOW_PRIORITY)
+def backfill_research_data_task(**kwargs):
+    """Adds a partition of missing rows to the research data cache"""
+    return backfill_research_data(**kwargs)
+
+
+@celery.task(queue=LOW_PRIORITY)
+def summarize_research_data_backfill_task(partition_results, **kwargs):
+    """Chord callback, records outcome of all research data partitions"""
+    return summarize_research_data_backfill(partition_results, **kwargs)
+
+
 @celery.task(bind=True, track_started=True, queue=LOW_PRIORITY)
 def research_report_task(self, **kwargs):
     current_app.logger.debug("launch research report task: %s", self.request.id)
@@ -147,6 +216,14 @@ def research_report_task(self, **kwargs):
     return research_report(**kwargs)
 
 
+@celery.task(queue=LOW_PRIORITY)
+@scheduled_task
+def purge_report_artifacts_task(**kwargs):
+    """Remove report artifacts older than `REPORT_ARTIFACT_TTL`"""
+    removed = purge_report_artifacts(ttl=kwargs.get('ttl'))
+    return f"Purged {removed} report artifacts"
+
+
 @celery.task(name="tasks.post_request", bind=True)
 def post_request(self, url, data, timeout=10, retries=3):
     """Wrap requests.post for asynchronous posts - includes timeout & retry"""
@@ -272,22 +349,30 @@ def update_patients_task(patient_list, update_cache, queue_messages):
 
 def update_patients(patient_list, update_cache, queue_messages):
     now = datetime.utcnow()
+    if update_cache:
+        # build timelines in bulk, a batch per research study
+        batches = defaultdict(list)
+        for user in User.query.filter(User.id.in_(patient_list)):
+            for research_study_id in ResearchStudy.assigned_to(user):
+                batches[research_study_id].append(user.id)
+        for research_study_id, user_ids in batches.items():
+            update_users_QBT_batch(user_ids, research_study_id)
+    if not queue_messages:
+        return
+
     for user_id in patient_list:
         user = User.query.get(user_id)
         for research_study_id in ResearchStudy.assigned_to(user):
-            if update_cache:
-                update_users_QBT(user_id, research_study_id)
-            if queue_messages:
-                qbstatus = QB_Status(user, research_study_id, now)
-                if qbstatus.withdrawn_by(now):
-                    # NEVER notify withdrawn patients
-                    continue
-                qbd = qbstatus.current_qbd()
-                if qbd:
-                    queue_outstanding_messages(
-                        user=user,
-                        questionnaire_bank=qbd.questionnaire_bank,
-                        iteration_count=qbd.iteration)
+            qbstatus = QB_Status(user, research_study_id, now)
+            if qbstatus.withdrawn_by(now):
+                # NEVER notify withdrawn patients
+                continue
+            qbd = qbstatus.current_qbd()
+            if qbd:
+                queue_outstanding_messages(
+                    user=user,
+                    questionnaire_bank=qbd.questionnaire_bank,
+                    iteration_count=qbd.iteration)
 
             db.session.commit()
 
@@ -318,17 +403,27 @@ def send_queued_communications(**kwargs):
 def send_messages(as_task=False):
     """Function to send all queued messages
 
-    Typically called as a scheduled_job - also directly from tests
+    Typically called as a scheduled_job - also directly from tests.  As a
+    task, batches are queued for concurrent dispatch by available workers.
+
+    :returns: Counter of resulting communication status when run inline,
+      or number of batches queued
+
     """
-    ready = Communication.query.filter(
-        Communication.status == 'preparation').with_entities(Communication.id)
+    ready = [cid for cid, in Communication.query.filter(
+        Communication.status == 'preparation').with_entities(
+        Communication.id).order_by(Communication.id)]
 
-    for communication_id in ready:
-        if as_task:
-            send_communication_task.apply_async(
-                priority=9, kwargs={'communication_id': communication_id})
-        else:
-            send_communication(communication_id)
+    if as_task:
+        return queue_dispatch(ready)
+    return dispatch_communications(ready)
+
+
+@celery.task(name="tasks.send_communications_task", queue=LOW_PRIORITY)
+def send_communications_task(**kwargs):
+    """Send a batch of communications, see `dispatch_communications()`"""
+    counts = dispatch_communications(**kwargs)
+    return dict(counts)
 
 
 @celery.task(name="tasks.send_communication_task", queue=LOW_PRIORITY)
@@ -379,10 +474,11 @@ def send_user_messages(user, force_update=False):
     count = 0
     ready = Communication.query.join(User).filter(
         Communication.status == 'preparation').filter(User.id == user.id)
-    for communication in ready:
-        communication.generate_and_send()
-        db.session.commit()
-        count += 1
+    with PooledMailer() as mailer:
+        for communication in ready:
+            communication.generate_and_send(mailer=mailer)
+            db.session.commit()
+            count += 1
     message = "Sent {} messages to {}".format(count, user.email)
     if force_update:
         message += " after forced update"
@@ -459,6 +555,13 @@ def celery_beat_health_check_low_priority_queue(**kwargs):
     )
 
 
+@celery.task(name="tasks.post_submit_stage_task")
+def post_submit_stage_task(context, stage):
+    """Run a single QNR post submit stage, returning context for the next"""
+    from portal.models.post_submit import run_stage
+    return run_stage(context, stage)
+
+
 @celery.task(name="tasks.extract_observations_task", queue=LOW_PRIORITY)
 def extract_observations_task(questionnaire_response_id):
     """Task wrapper for extract_observations"""
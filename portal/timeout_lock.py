@@ -50,7 +50,8 @@ class TimeoutLock(object):
                 return
 
             timeout -= 1
-            time.sleep(1)
+            if timeout >= 0:
+                time.sleep(1)
 
         current_app.logger.debug("Timeout on lock '{}'".format(self.key))
         raise LockTimeout("Timeout whilst waiting for lock {}".format(
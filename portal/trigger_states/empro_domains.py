@@ -1,7 +1,14 @@
 """Module to handle complexity of domain scoring and triggers"""
 from collections import defaultdict
 
+from sqlalchemy import and_
+from sqlalchemy.orm import aliased
+
+from .sdc import DOMAIN_SYSTEM
+from ..database import db
 from ..date_tools import FHIR_datetime
+from ..models.codeable_concept import CodeableConceptCoding
+from ..models.coding import Coding
 from ..models.observation import Observation
 from ..models.questionnaire_response import first_last_like_qnr
 
@@ -102,6 +109,57 @@ class DomainTriggers(object):
         self._triggers[sequential_hard_trigger_count_key] = sequential_hard_trigger_count
 
 
+def domain_scores(qnr_ids):
+    """Project observations derived from QNRs into compact score tuples
+
+    All observations for the given QNRs are loaded in a single query, along
+    with their domain, answer and severity codings.
+
+    :param qnr_ids: QuestionnaireResponse ids, as strings
+    :returns: list of (derived_from, domain, link_id, score, severity)
+      tuples; severity is only present on penultimate and ultimate answers
+
+    """
+    qnr_ids = set(qnr_ids)
+    if not qnr_ids:
+        return []
+
+    domain_coding = aliased(Coding)
+    answer_coding = aliased(Coding)
+    severity_coding = aliased(Coding)
+    rows = db.session.query(
+        Observation.id,
+        Observation.derived_from,
+        domain_coding.code,
+        answer_coding.code,
+        severity_coding.code).join(
+        answer_coding, answer_coding.id == Observation.value_coding_id).join(
+        CodeableConceptCoding,
+        CodeableConceptCoding.codeable_concept_id ==
+        Observation.codeable_concept_id).outerjoin(
+        domain_coding, and_(
+            domain_coding.id == CodeableConceptCoding.coding_id,
+            domain_coding.system == DOMAIN_SYSTEM)).outerjoin(
+        severity_coding,
+        severity_coding.id == answer_coding.extension_id).filter(
+        Observation.derived_from.in_(qnr_ids))
+
+    # one row per coding in each observation's codeable concept
+    observations = dict()
+    for ob_id, derived_from, domain, answer, severity in rows:
+        if ob_id not in observations or domain:
+            observations[ob_id] = (derived_from, domain, answer, severity)
+
+    results = []
+    for ob_id, (derived_from, domain, answer, severity) in (
+            observations.items()):
+        if not domain:
+            raise ValueError(f"'domain' not found in observation {ob_id}")
+        link_id, score = answer.rsplit('.', 1)
+        results.append((derived_from, domain, link_id, int(score), severity))
+    return results
+
+
 class DomainManifold(object):
     """Bring together available responses and domains for trigger eval"""
 
@@ -114,6 +172,7 @@ class DomainManifold(object):
         self.cur_qnr = qnr
         self.initial_qnr, self.prev_qnr = first_last_like_qnr(qnr)
 
+        qnr_ids = dict()
         for timepoint in 'cur', 'initial', 'prev':
             process_qnr = getattr(self, f"{timepoint}_qnr")
             if process_qnr:
@@ -122,32 +181,21 @@ class DomainManifold(object):
                     getattr(process_qnr, 'id', None))
                 if not qnr_id:
                     raise ValueError(f"Unable to determine qnr_id from {process_qnr}")
-
-                obs = Observation.query.filter(
-                    Observation.derived_from == str(qnr_id)
-                )
-                # Extract useful bits for trigger calc from observations
-                # format as dictionary, keyed by `domain`.  Each domain
-                # will contain a dictionary keyed by `link_id`, with a value
-                # tuple (score, severity)
-                results = dict()
-                for ob in obs:
-                    # acquire the domain
-                    for code in ob.codeable_concept.codings:
-                        if code.system == 'http://us.truenth.org/observation':
-                            domain = code.code
-                    if not domain:
-                        raise ValueError(
-                            f"'domain' not found in observation {ob.id}")
-                    link_id, score = ob.value_coding.code.rsplit('.', 1)
-                    # severity is only present on penultimate, ultimate
-                    severity = None
-                    if ob.value_coding.extension_id:
-                        severity = ob.value_coding.extension.code
-                    if domain not in results:
-                        results[domain] = defaultdict(dict)
-                    results[domain][link_id] = (int(score), severity)
-                setattr(self, f"{timepoint}_obs", results)
+                qnr_ids[timepoint] = str(qnr_id)
+
+        # Extract useful bits for trigger calc from observations
+        # format as dictionary, keyed by `domain`.  Each domain
+        # will contain a dictionary keyed by `link_id`, with a value
+        # tuple (score, severity)
+        results = {qnr_id: dict() for qnr_id in qnr_ids.values()}
+        for derived_from, domain, link_id, score, severity in (
+                domain_scores(qnr_ids.values())):
+            if domain not in results[derived_from]:
+                results[derived_from][domain] = defaultdict(dict)
+            results[derived_from][domain][link_id] = (score, severity)
+
+        for timepoint, qnr_id in qnr_ids.items():
+            setattr(self, f"{timepoint}_obs", results[qnr_id])
 
     def eval_triggers(self, previous_triggers):
         triggers = dict()
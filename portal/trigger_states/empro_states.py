@@ -6,7 +6,6 @@ See also:
 import copy
 from datetime import datetime, timedelta
 from flask import current_app
-from requests import post
 from smtplib import SMTPRecipientsRefused
 from statemachine import StateMachine, State
 from statemachine.exceptions import TransitionNotAllowed
@@ -14,6 +13,7 @@ from statemachine.exceptions import TransitionNotAllowed
 from .empro_domains import DomainManifold
 from .empro_messages import invite_email, patient_email, staff_emails
 from .models import TriggerState, opt_out_this_visit_key
+from .sdc import extract
 from ..database import db
 from ..date_tools import FHIR_datetime
 from ..models.qb_status import QB_Status
@@ -549,7 +549,7 @@ def empro_staff_qbd_accessor(qnr):
 
 
 def extract_observations(questionnaire_response_id, override_state=False):
-    """Submit QNR to SDC service; store returned Observations
+    """Extract Observations from QNR via configured SDC backend; store
 
     :param questionnaire_response_id:  QNR to process
     :param override_state: set to override transition exceptions.  This
@@ -585,14 +585,8 @@ def extract_observations(questionnaire_response_id, override_state=False):
             raise ValueError(
                 f"invalid state; can't score: {qnr.subject_id}:{qnr.id}")
 
-        qnr_json = qnr.as_sdc_fhir()
-
-        SDC_BASE_URL = current_app.config['SDC_BASE_URL']
-        response = post(f"{SDC_BASE_URL}/$extract", json=qnr_json)
-        response.raise_for_status()
-
         # Add SDC generated observations to db
-        Observation.parse_obs_bundle(response.json())
+        Observation.parse_obs_bundle(extract(qnr.as_sdc_fhir()))
         db.session.commit()
 
         # With completed scoring, evaluate for triggers
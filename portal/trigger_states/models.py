@@ -1,12 +1,13 @@
 from copy import deepcopy
 from datetime import datetime, timedelta
 from flask import current_app
-from sqlalchemy import Enum, UniqueConstraint
+from sqlalchemy import Enum, UniqueConstraint, event, func
 from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.orm import make_transient
+from sqlalchemy.orm import make_transient, object_session
 
 from ..database import db
 from ..date_tools import FHIR_datetime, weekday_delta
+from ..patient_generation import bump_on_commit
 from ..models.audit import Audit
 
 opt_out_this_visit_key = '_opt_out_this_visit'
@@ -284,16 +285,166 @@ class TriggerState(db.Model):
                 db.session.commit()
 
 
+@event.listens_for(TriggerState, 'after_insert')
+@event.listens_for(TriggerState, 'after_update')
+@event.listens_for(TriggerState, 'after_delete')
+def bump_trigger_state_generation(mapper, connection, target):
+    """Cached visit details include the patient's EMPRO action state"""
+    bump_on_commit(object_session(target), target.user_id)
+
+
 class TriggerStatesReporting:
-    """Manage reporting details for a given patient"""
+    """Manage reporting details for a given patient
+
+    Use ``for_patients()`` to load details for a batch of patients with a
+    few queries, rather than several per visit of each patient.
+
+    """
     MAX_VISIT = 12
+    HOLIDAY_LINK_ID = "ironman_ss_post_tx.2.1"
+
+    def __init__(
+            self, patient_id, latest_by_visit=None, holiday_delays=None,
+            access_hits=None):
+        """Reporting details for patient
+
+        :param patient_id: the patient
+        :param latest_by_visit: preloaded latest trigger state (or None)
+          by visit month, see ``latest_states()``
+        :param holiday_delays: preloaded holiday delay answer by resolution
+          QNR id, see ``holiday_delays()``; looked up per visit if None
+        :param access_hits: preloaded, time ordered (timestamp, comment)
+          content access audits, see ``access_hits()``; looked up per
+          visit if None
 
-    def __init__(self, patient_id):
+        """
         self.patient_id = patient_id
-        self.latest_by_visit = dict()
-        for v in range(self.MAX_VISIT):
-            self.latest_by_visit[v] = TriggerState.latest_for_visit(
-                patient_id, v)
+        self.latest_by_visit = (
+            latest_by_visit if latest_by_visit is not None
+            else self.latest_states([patient_id])[patient_id])
+        self._holiday_delays = holiday_delays
+        self._access_hits = access_hits
+
+    @classmethod
+    def for_patients(cls, patient_ids, visit_details=True):
+        """Returns reporting instances for a batch of patients
+
+        :param patient_ids: patients to load
+        :param visit_details: set to also preload the resolution QNRs and
+          content access audits, used by ``resolution_delayed_by_holiday()``
+          and ``domains_accessed()``
+        :returns: dictionary of ``TriggerStatesReporting`` keyed by patient id
+
+        """
+        latest = cls.latest_states(patient_ids)
+        if not visit_details:
+            return {
+                patient_id: cls(patient_id, latest_by_visit=latest[patient_id])
+                for patient_id in patient_ids}
+
+        delays = cls.holiday_delays(latest.values())
+        hits = cls.access_hits(latest)
+        return {
+            patient_id: cls(
+                patient_id,
+                latest_by_visit=latest[patient_id],
+                holiday_delays=delays,
+                access_hits=hits[patient_id])
+            for patient_id in patient_ids}
+
+    @classmethod
+    def latest_states(cls, patient_ids):
+        """Latest trigger state for each (patient, visit month)
+
+        Equivalent to ``TriggerState.latest_for_visit()`` for every visit
+        month of every patient, in a single query.
+
+        :returns: dictionary keyed by patient id of dictionaries keyed by
+          visit month, holding the latest ``TriggerState`` or None
+
+        """
+        results = {
+            patient_id: {v: None for v in range(cls.MAX_VISIT)}
+            for patient_id in patient_ids}
+        if not results:
+            return results
+
+        ranked = db.session.query(
+            TriggerState.id.label('id'),
+            func.row_number().over(
+                partition_by=(TriggerState.user_id, TriggerState.visit_month),
+                order_by=TriggerState.id.desc()).label('rank')).filter(
+            TriggerState.user_id.in_(list(results))).filter(
+            TriggerState.visit_month < cls.MAX_VISIT).subquery()
+        latest = TriggerState.query.join(
+            ranked, TriggerState.id == ranked.c.id).filter(ranked.c.rank == 1)
+        for ts in latest:
+            results[ts.user_id][ts.visit_month] = ts
+        return results
+
+    @classmethod
+    def holiday_delay(cls, document):
+        """Returns answer to the holiday delay question in QNR document"""
+        for question_details in document.get("group", {}).get("question", []):
+            if question_details.get("linkId") == cls.HOLIDAY_LINK_ID:
+                for answer in question_details.get("answer", []):
+                    if "valueBoolean" in answer:
+                        return answer["valueBoolean"]
+
+    @classmethod
+    def holiday_delays(cls, latest_states):
+        """Holiday delay answers of all resolution QNRs, in a single query
+
+        :param latest_states: iterable of latest trigger states by visit
+          month, as found in ``latest_states()`` values
+        :returns: dictionary of holiday delay answer (or None) keyed by QNR id
+
+        """
+        from ..models.questionnaire_response import QuestionnaireResponse
+
+        qnr_ids = set()
+        for by_visit in latest_states:
+            for ts in by_visit.values():
+                qnr_id = (getattr(ts, 'triggers', None) or {}).get(
+                    "resolution", {}).get("qnr_id")
+                if qnr_id:
+                    qnr_ids.add(qnr_id)
+        if not qnr_ids:
+            return {}
+
+        qnrs = QuestionnaireResponse.query.filter(
+            QuestionnaireResponse.id.in_(qnr_ids)).with_entities(
+            QuestionnaireResponse.id, QuestionnaireResponse.document)
+        return {qnr_id: cls.holiday_delay(doc) for qnr_id, doc in qnrs}
+
+    @classmethod
+    def access_hits(cls, latest):
+        """Content access audits for patients, in a single query
+
+        :param latest: result of ``latest_states()`` for the patients
+        :returns: dictionary keyed by patient id of time ordered
+          (timestamp, comment) tuples, from the patient's first EMPRO
+          submission on
+
+        """
+        results = {patient_id: [] for patient_id in latest}
+        starts = [
+            cls(patient_id, latest_by_visit=by_visit).authored_from_visit(v)
+            for patient_id, by_visit in latest.items()
+            for v in range(cls.MAX_VISIT)]
+        starts = [start for start in starts if start]
+        if not starts:
+            return results
+
+        hits = Audit.query.filter(
+            Audit.subject_id.in_(list(results))).filter(
+            Audit._context == 'access').filter(
+            Audit.timestamp >= min(starts)).with_entities(
+            Audit.subject_id, Audit.timestamp, Audit.comment).order_by(
+            Audit.timestamp)
+        for subject_id, timestamp, comment in hits:
+            results[subject_id].append((timestamp, comment))
+        return results
 
     def authored_from_visit(self, visit_month):
         """Extract authored datetime from given visit month"""
@@ -336,14 +487,12 @@ class TriggerStatesReporting:
         if not qnr_id:
             return None
 
+        if self._holiday_delays is not None:
+            return self._holiday_delays.get(qnr_id)
+
         # Pull the clinician's Questionnaire Response, return question answer, if found
         qnr = QuestionnaireResponse.query.get(qnr_id)
-        for question_details in qnr.document.get("group", {}).get("question", []):
-            # holiday question is: "linkId": "ironman_ss_post_tx.2.1"
-            if question_details.get("linkId") == "ironman_ss_post_tx.2.1":
-                for answer in question_details.get("answer", []):
-                    if "valueBoolean" in answer:
-                        return answer["valueBoolean"]
+        return self.holiday_delay(qnr.document)
 
     def domains_accessed(self, visit_month):
         """Return list of domains accessed for visit_month
@@ -371,6 +520,15 @@ class TriggerStatesReporting:
         if not end_date:
             end_date = datetime.utcnow()
 
+        if self._access_hits is not None:
+            viewed = []
+            for timestamp, comment in self._access_hits:
+                if timestamp > end_date:
+                    break
+                if timestamp >= start_date and comment not in viewed:
+                    viewed.append(comment)
+            return [path.split('/')[-1] for path in viewed] or None
+
         # Access records are kept in audit table with context 'access'
         hits = Audit.query.filter(
             Audit.subject_id == self.patient_id).filter(
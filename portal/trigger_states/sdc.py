@@ -0,0 +1,115 @@
+"""SDC Observation extraction for EMPRO scoring
+
+A completed EMPRO QuestionnaireResponse is scored by extracting one
+Observation per answered question carrying a domain code.  Each
+Observation holds the domain (from the Questionnaire item ``code``) and the
+chosen option's ``valueCoding``, including any severity extension.
+
+Two interchangeable backends are available, named by the
+`SDC_EXTRACT_BACKEND` configuration value:
+
+``http``
+  POST to the external SDC service at `SDC_BASE_URL`/$extract
+``local``
+  derive the same Observations in process, from the scoring metadata of
+  the Questionnaire contained in the submission
+
+Both accept the document generated by
+``QuestionnaireResponse.as_sdc_fhir()`` and return a FHIR Bundle suitable
+for ``Observation.parse_obs_bundle()``.
+
+"""
+from flask import current_app
+from requests import post
+
+DOMAIN_SYSTEM = 'http://us.truenth.org/observation'
+
+
+def http_extract(sdc_qnr):
+    """Extract Observations via the external SDC service"""
+    SDC_BASE_URL = current_app.config['SDC_BASE_URL']
+    response = post(f"{SDC_BASE_URL}/$extract", json=sdc_qnr)
+    response.raise_for_status()
+    return response.json()
+
+
+def scoring_items(questionnaire):
+    """Returns Questionnaire items with a domain code, keyed by linkId"""
+    results = {}
+
+    def visit(items):
+        for item in items:
+            if any(c.get('system') == DOMAIN_SYSTEM
+                   for c in item.get('code', ())):
+                results[item['linkId']] = item
+            visit(item.get('item', ()))
+
+    visit(questionnaire.get('item', ()))
+    return results
+
+
+def local_extract(sdc_qnr):
+    """Extract Observations in process, as the SDC service would"""
+    contained = [
+        resource for resource in sdc_qnr.get('contained', ())
+        if resource.get('resourceType') == 'Questionnaire']
+    if not contained:
+        raise ValueError("SDC extraction requires a contained Questionnaire")
+    items = scoring_items(contained[0])
+
+    identifier = sdc_qnr['identifier']
+    derived_from = [{
+        'reference': (
+            f"{identifier['system']}/QuestionnaireResponse/"
+            f"{identifier['value']}")}]
+
+    entries = []
+    for question in sdc_qnr.get('group', {}).get('question', ()):
+        item = items.get(question.get('linkId'))
+        if not item:
+            continue
+        options = {
+            option['valueCoding']['code']: option['valueCoding']
+            for option in item.get('option', ()) if 'valueCoding' in option}
+        for answer in question.get('answer', ()):
+            coding = answer.get('valueCoding')
+            if not coding or coding.get('code') not in options:
+                continue
+            value_coding = dict(options[coding['code']])
+            if coding.get('system'):
+                value_coding['system'] = coding['system']
+            entries.append({
+                'resourceType': 'Observation',
+                'code': {'coding': item['code']},
+                'valueCoding': value_coding,
+                'issued': sdc_qnr.get('authored'),
+                'derivedFrom': derived_from,
+            })
+
+    return {
+        'resourceType': 'Bundle',
+        'type': 'collection',
+        'total': len(entries),
+        'entry': entries,
+    }
+
+
+SDC_EXTRACT_BACKENDS = {
+    'http': http_extract,
+    'local': local_extract,
+}
+
+
+def extract(sdc_qnr, backend=None):
+    """Returns Bundle of Observations extracted from the QNR document
+
+    :param sdc_qnr: QuestionnaireResponse document, as generated by
+      ``QuestionnaireResponse.as_sdc_fhir()``
+    :param backend: name of backend to use, defaults to configured
+      `SDC_EXTRACT_BACKEND`
+
+    """
+    backend = backend or current_app.config['SDC_EXTRACT_BACKEND']
+    if backend not in SDC_EXTRACT_BACKENDS:
+        raise ValueError(f"unsupported SDC_EXTRACT_BACKEND {backend}")
+    return SDC_EXTRACT_BACKENDS[backend](sdc_qnr)
@@ -602,15 +602,12 @@ def assessment(patient_id, instrument_id):
         patient_id, 'view', allow_on_url_authenticated_encounters=True)
     questionnaire_responses = QuestionnaireResponse.query.filter_by(
         subject_id=patient.id).order_by(
-        QuestionnaireResponse.document['authored'].desc())
+        QuestionnaireResponse.authored.desc())
 
     instrument_id = request.args.get('instrument_id', instrument_id)
     if instrument_id is not None:
         questionnaire_responses = questionnaire_responses.filter(
-            QuestionnaireResponse.document[
-                ("questionnaire", "reference")
-            ].astext.endswith(instrument_id)
-        )
+            QuestionnaireResponse.instrument_id == instrument_id)
 
     documents = []
     for qnr in questionnaire_responses:
@@ -987,7 +984,9 @@ def assessment_update(patient_id):
 
     # TN-3184, report any in-process QNRs attempting to change authored dates
     date_change_snippet = ""
-    if FHIR_datetime.parse(existing_qnr.document["authored"]) != FHIR_datetime.parse(updated_qnr["authored"]):
+    previous_authored = FHIR_datetime.parse(existing_qnr.document["authored"])
+    authored = FHIR_datetime.parse(updated_qnr["authored"])
+    if previous_authored != authored:
         date_change_snippet = f" UNEXPECTED authored change; was previously {existing_qnr.document['authored']}"
         current_app.logger.warning(date_change_snippet)
 
@@ -1013,7 +1012,9 @@ def assessment_update(patient_id):
     )
     response.update({'message': 'questionnaire response updated successfully'})
     if research_study_id is not None:
-        invalidate_users_QBT(patient.id, research_study_id=research_study_id)
+        invalidate_users_QBT(
+            patient.id, research_study_id=research_study_id,
+            since=min(previous_authored, authored))
     add_questionnaire_response(existing_qnr, research_study_id=research_study_id)
     return jsonify(response)
 
@@ -1034,6 +1035,10 @@ def assessment_add(patient_id):
     result in a ``409: conflict`` response, and refusal to retain the
     submission.
 
+    With ``ASYNC_QNR_SUBMIT`` configured, the response is returned once the
+    submission is persisted; questionnaire bank assignment, timeline and
+    research data updates follow asynchronously.
+
     ---
     operationId: addQuestionnaireResponse
     tags:
@@ -1631,7 +1636,7 @@ def assessment_add(patient_id):
       - ServiceToken: []
 
     """
-    from ..models.research_data import add_questionnaire_response
+    from ..models.post_submit import queue_post_submit, run_post_submit
 
     if not hasattr(request, 'json') or not request.json:
         return jsonify(message='Invalid request - requires JSON'), 400
@@ -1641,8 +1646,7 @@ def assessment_add(patient_id):
             message='Requires resourceType of "QuestionnaireResponse"'), 400
 
     # Verify the current user has permission to edit given patient
-    patient = get_user(
-        patient_id, 'edit', allow_on_url_authenticated_encounters=True)
+    get_user(patient_id, 'edit', allow_on_url_authenticated_encounters=True)
 
     response = {
         'ok': False,
@@ -1714,26 +1718,29 @@ def assessment_add(patient_id):
 
     db.session.add(questionnaire_response)
     db.session.commit()
-    research_study_id = questionnaire_response.assign_qb_relationship(
-        acting_user_id=current_user().id)
-
 
     # TODO: only extract QuestionnaireResponses where the corresponding Questionnaire has the SDC extension
     qn_name = questionnaire_response.document.get("questionnaire").get("reference", '').split('/')[-1]
-    if qn_name == 'ironman_ss' and questionnaire_response.status == 'completed':
-        from ..tasks import extract_observations_task
-        extract_observations_task.apply_async(
-            kwargs={'questionnaire_response_id': questionnaire_response.id}
-        )
+    extract = (
+        qn_name == 'ironman_ss' and questionnaire_response.status == 'completed')
+    if current_app.config.get('ASYNC_QNR_SUBMIT'):
+        # return without waiting, remaining stages follow in an ordered chain
+        queue_post_submit(
+            questionnaire_response, acting_user_id=current_user().id,
+            extract_observations=extract)
+    else:
+        run_post_submit(
+            questionnaire_response, acting_user_id=current_user().id)
+        if extract:
+            from ..tasks import extract_observations_task
+            extract_observations_task.apply_async(
+                kwargs={'questionnaire_response_id': questionnaire_response.id}
+            )
 
     auditable_event("added {}".format(questionnaire_response),
                     user_id=current_user().id, subject_id=patient_id,
                     context='assessment')
     response.update({'message': 'questionnaire response saved successfully'})
-
-    if research_study_id is not None:
-        invalidate_users_QBT(patient.id, research_study_id=research_study_id)
-    add_questionnaire_response(questionnaire_response, research_study_id)
     return jsonify(response)
 
 
@@ -1761,11 +1768,15 @@ def present_needed():
     work.  Call again after completion to pick up the next study.
 
     """
+    from ..models.post_submit import complete_pending_recompute
     from ..models.qb_status import QB_Status  # avoid cycle
 
     subject_id = request.args.get('subject_id') or current_user().id
     subject = get_user(
         subject_id, 'edit', allow_on_url_authenticated_encounters=True)
+
+    # bring state current should any asynchronous submissions be pending
+    complete_pending_recompute(subject.id, acting_user_id=current_user().id)
     as_of_date = FHIR_datetime.parse(
         request.args.get('authored'), none_safe=True)
     if not as_of_date:
@@ -19,6 +19,7 @@ from ..extensions import oauth
 from ..models.coding import Coding
 from ..models.identifier import Identifier
 from ..models.organization import Organization, OrganizationIdentifier, OrgTree
+from ..models.patient_list import invalidate_viewable_orgs
 from ..models.reference import MissingReference, Reference
 from ..models.role import ROLE
 from ..models.user import current_user, get_user
@@ -610,6 +611,7 @@ def add_user_organizations(user_id):
             message='Added {}'.format(org), user_id=current_user().id,
             subject_id=user.id, context='organization')
     db.session.commit()
+    invalidate_viewable_orgs(user.id)
 
     # Return current organizations
 
@@ -10,7 +10,6 @@ import json
 
 from flask import Blueprint, Response, abort, current_app, jsonify, request
 from sqlalchemy import and_
-from werkzeug.exceptions import Unauthorized
 
 from ..audit import auditable_event
 from ..cache import cache
@@ -144,13 +143,14 @@ def patient_search():
 
     # Validate permissions to see every requested user - omitting those w/o
     patients = []
+    permitted = current_user().permitted_user_ids(
+        'view', query.with_entities(User.id))
     for user in query:
-        try:
-            current_user().check_role(permission='view', other_id=user.id)
+        if user.id in permitted:
             if user.has_role(ROLE.PATIENT.value):
                 patients.append(
                     {'resource': Reference.patient(user.id).as_fhir()})
-        except Unauthorized:
+        else:
             # Mask unauthorized as a not-found.  Don't want unauthed users
             # farming information - i.e. don't add to results
             auditable_event("looking up users with inadequate permission",
@@ -405,7 +405,7 @@ def patient_timeline(patient_id):
 
     qnrs = QuestionnaireResponse.query.filter(
         QuestionnaireResponse.subject_id == patient_id).order_by(
-        QuestionnaireResponse.document['authored'])
+        QuestionnaireResponse.authored)
 
     def get_recur_id(qnr):
         if qnr.questionnaire_bank and len(qnr.questionnaire_bank.recurs):
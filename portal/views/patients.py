@@ -1,5 +1,7 @@
 """Patient view functions (i.e. not part of the API or auth)"""
+from hashlib import sha1
 import json
+
 from flask import (
     Blueprint,
     abort,
@@ -10,13 +12,18 @@ from flask import (
 )
 from flask_babel import gettext as _
 from flask_user import roles_required
-from sqlalchemy import asc, desc
+from sqlalchemy import and_, asc, desc, or_
 
+from ..cache import ONE_MIN, cache
 from ..extensions import oauth
 from ..models.coding import Coding
 from ..models.intervention import Intervention
-from ..models.organization import Organization, OrgTree
-from ..models.patient_list import PatientList
+from ..models.organization import Organization
+from ..models.patient_list import (
+    PatientList,
+    filter_viewable_orgs,
+    patient_list_options,
+)
 from ..models.questionnaire_bank import translate_visit_name
 from ..models.qb_status import patient_research_study_status
 from ..models.role import ROLE
@@ -41,17 +48,6 @@ def users_table_pref_from_research_study_id(user, research_study_id):
         table_name=table_name, user_id=user.id).first()
 
 
-def org_preference_filter(user, research_study_id):
-    """Obtain user's preference for filtering organizations
-
-    :returns: list of org IDs to use as filter, or None
-    """
-    pref = users_table_pref_from_research_study_id(
-        user=user, research_study_id=research_study_id)
-    if pref and pref.filters:
-        return pref.filters.get('orgs_filter_control')
-
-
 def preference_filter(user, research_study_id, arg_filter):
     """Obtain user's preference for filtering
 
@@ -127,17 +123,65 @@ def filter_query(query, filter_field, filter_value):
 
 
 def sort_query(query, sort_column, direction):
-    """Extend patient list query with requested sorting criteria"""
+    """Extend patient list query with requested sorting criteria
+
+    Ties are broken by userid, in the same direction, for the stable order
+    required by keyset pagination.
+    """
     sort_method = asc if direction == 'asc' else desc
 
-    if not hasattr(PatientList, sort_column):
-        # these should never get passed, but it has happened in test.
-        # ignore requests to sort by unknown column
-        return query
-    query = query.order_by(sort_method(getattr(PatientList, sort_column)))
+    # unknown columns should never get passed, but it has happened in test.
+    # ignore requests to sort by unknown column
+    if hasattr(PatientList, sort_column) and sort_column != 'userid':
+        query = query.order_by(sort_method(getattr(PatientList, sort_column)))
+    query = query.order_by(sort_method(PatientList.userid))
     return query
 
 
+def seek_query(query, sort_column, direction, boundary):
+    """Extend sorted patient list query to start just past boundary row
+
+    Keyset (seek) alternative to OFFSET, so deep pages needn't scan and
+    discard all preceding rows.  Mirrors the ordering of `sort_query()`,
+    including postgres' default placement of NULLs, last when ascending
+    and first when descending.
+
+    :param boundary: (sort column value, userid) of the last row on the
+      previous page
+    """
+    value, userid = boundary
+    if not hasattr(PatientList, sort_column) or sort_column == 'userid':
+        if direction == 'asc':
+            return query.filter(PatientList.userid > userid)
+        return query.filter(PatientList.userid < userid)
+
+    column = getattr(PatientList, sort_column)
+    if direction == 'asc':
+        if value is None:
+            return query.filter(and_(
+                column.is_(None), PatientList.userid > userid))
+        return query.filter(or_(
+            column > value,
+            and_(column == value, PatientList.userid > userid),
+            column.is_(None)))
+
+    if value is None:
+        return query.filter(or_(
+            and_(column.is_(None), PatientList.userid < userid),
+            column.isnot(None)))
+    return query.filter(or_(
+        column < value,
+        and_(column == value, PatientList.userid < userid)))
+
+
+def page_cache_key(research_study_id, viewable_orgs, include_test_role, filters):
+    """Generate key unique to the set of patients matching the request"""
+    signature = json.dumps(
+        [research_study_id, sorted(viewable_orgs), include_test_role, filters],
+        sort_keys=True)
+    return f"patient_list_page:{sha1(signature.encode('utf-8')).hexdigest()}"
+
+
 @patients.route("/page", methods=["GET"])
 @roles_required([
     ROLE.CLINICIAN.value,
@@ -152,64 +196,33 @@ def page_of_patients():
     :param search: search string,
     :param sort: column to sort by,
     :param order: direction to apply to sorted column,
-    :param offset: offset from first page of the given search params
+    :param offset: offset from first page of the given search params.
+      when following on from a recently served page, the query seeks past
+      that page's last row rather than applying an OFFSET
     :param limit: count in a page
     :param research_study_id: default 0, set to 1 for EMPRO
 
     """
-    def requested_orgs(user, research_study_id):
-        """Return set of requested orgs limited to those the user is allowed to view"""
-        # start with set of org ids the user has permission to view
-        viewable_orgs = set()
-        for org in user.organizations:
-            ids = OrgTree().here_and_below_id(org.id)
-            viewable_orgs.update(ids)
-
-        # Reduce viewable orgs by filter preferences
-        filtered_orgs = org_preference_filter(user=user, research_study_id=research_study_id)
-        if filtered_orgs:
-            viewable_orgs = viewable_orgs.intersection(filtered_orgs)
-        return viewable_orgs
-
     user = current_user()
     research_study_id = int(request.args.get("research_study_id", 0))
     # due to potentially translated content, need to capture all potential values to sort
     # (not just the current page) for the front-end options list
     options = []
-    if research_study_id == EMPRO_RS_ID:
-        distinct_status = PatientList.query.distinct(PatientList.empro_status).with_entities(
-            PatientList.empro_status)
-        options.append({"empro_status": [(status[0], _(status[0])) for status in distinct_status]})
-        distinct_action = PatientList.query.distinct(PatientList.action_state).with_entities(
-            PatientList.action_state)
-        options.append({"action_state": [(state[0], _(state[0])) for state in distinct_action]})
-        distinct_visits = PatientList.query.distinct(PatientList.empro_visit).with_entities(
-            PatientList.empro_visit)
-        sorted_visits = sorted(
-            [v[0] for v in distinct_visits if v[0]],
-            key=lambda x: (0 if not x.split()[-1].isdigit() else int(x.split()[-1]))
-        )
-        options.append({"empro_visit": [(visit, translate_visit_name(visit)) for visit in sorted_visits]})
-    else:
-        distinct_status = PatientList.query.distinct(
-            PatientList.questionnaire_status).with_entities(PatientList.questionnaire_status)
-        options.append(
-            {"questionnaire_status": [(status[0], _(status[0])) for status in distinct_status]})
-        distinct_visits = PatientList.query.distinct(PatientList.visit).with_entities(
-            PatientList.visit)
-        sorted_visits = sorted(
-            [v[0] for v in distinct_visits if v[0]],
-            key=lambda x: (0 if not x.split()[-1].isdigit() else int(x.split()[-1]))
-        )
-        options.append({"visit": [(visit, translate_visit_name(visit)) for visit in sorted_visits]})
-
-    viewable_orgs = requested_orgs(user, research_study_id)
-    query = PatientList.query.filter(PatientList.org_id.in_(viewable_orgs))
+    for column, values in patient_list_options(research_study_id).items():
+        if column.endswith('visit'):
+            options.append({column: [(v, translate_visit_name(v)) for v in values]})
+        else:
+            options.append({column: [(v, _(v)) for v in values]})
+
+    # limit to orgs the user may view, usually via the materialized set
+    query, viewable_orgs = filter_viewable_orgs(
+        PatientList.query, user, research_study_id)
     query = query.filter(PatientList.deleted==False)
     if research_study_id == EMPRO_RS_ID:
         # only include those in the study.  use empro_consentdate as a quick check
         query = query.filter(PatientList.empro_consentdate.isnot(None))
-    if not request.args.get('include_test_role', "false").lower() == "true":
+    include_test_role = request.args.get('include_test_role', "false").lower() == "true"
+    if not include_test_role:
         query = query.filter(PatientList.test_role.is_(False))
 
     filters = preference_filter(
@@ -218,14 +231,28 @@ def page_of_patients():
         for key, value in filters.items():
             query = filter_query(query, key, value)
 
+    # totals for the same set of patients are reused briefly while paging
+    key = page_cache_key(research_study_id, viewable_orgs, include_test_role, filters)
+    total = cache.get(key)
+    if total is None:
+        total = query.count()
+        cache.set(key, total, timeout=ONE_MIN)
+
     sort_column, sort_order = preference_sort(
         user=user, research_study_id=research_study_id, arg_sort=request.args.get("sort"),
         arg_order=request.args.get("order"))
     query = sort_query(query, sort_column, sort_order)
 
-    total = query.count()
-    query = query.offset(request.args.get('offset', 0))
-    query = query.limit(request.args.get('limit', 10))
+    # seek past the last row of the previous page when known, rather than OFFSET
+    offset = int(request.args.get('offset', 0))
+    limit = int(request.args.get('limit', 10))
+    boundary_key = f"{key}:{sort_column}:{sort_order}:" + "{}"
+    boundary = cache.get(boundary_key.format(offset)) if offset else None
+    if boundary:
+        query = seek_query(query, sort_column, sort_order, boundary)
+    else:
+        query = query.offset(offset)
+    query = query.limit(limit)
 
     # Returns structured JSON with totals and rows
     data = {"total": total, "totalNotFiltered": total, "rows": [], "options": options}
@@ -250,6 +277,9 @@ def page_of_patients():
             "deleted": row.deleted,
             "test_role": row.test_role,
         })
+    if data['rows']:
+        boundary = (getattr(row, sort_column, None), row.userid)
+        cache.set(boundary_key.format(offset + len(data['rows'])), boundary, timeout=ONE_MIN)
     return jsonify(data)
 
 
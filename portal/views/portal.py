@@ -1,6 +1,7 @@
 """Portal view functions (i.e. not part of the API or auth)"""
 
 from datetime import datetime
+import os
 from pprint import pformat
 from time import strftime, time
 import sys
@@ -72,11 +73,13 @@ from ..models.organization import (
     UserOrganization,
 )
 from ..models.overall_status import OverallStatus
+from ..models.report_artifact import send_report_artifact
 from ..models.research_study import EMPRO_RS_ID, ResearchStudy
 from ..models.role import ALL_BUT_WRITE_ONLY, ROLE
 from ..models.table_preference import TablePreference
 from ..models.url_token import BadSignature, SignatureExpired, verify_token
 from ..models.user import User, current_user, get_user, unchecked_get_user
+from ..scoped_cache import close_scope, open_scope
 from ..system_uri import SHORTCUT_ALIAS
 from ..timeout_lock import TimeoutLock
 from ..trace import dump_trace, establish_trace, trace
@@ -111,6 +114,21 @@ def assert_locale_selector():
         g.locale_code = locale_code
 
 
+@portal.before_app_request
+def open_scoped_cache():
+    """Memoize patient state for the duration of the request"""
+    open_scope()
+
+
+@portal.teardown_app_request
+def close_scoped_cache(exc):
+    avoided = close_scope()
+    if avoided:
+        current_app.logger.debug(
+            "{} avoided rebuilds: {}".format(
+                request.path, dict(avoided)))
+
+
 @portal.before_app_request
 def debug_request_dump():
     if current_app.config.get("DEBUG_DUMP_HEADERS"):
@@ -1127,6 +1145,8 @@ def format_task_output(result):
         one of the given role names can view the result
       :response_format: with values such as ``csv`` or ``json``
       :data: actual data to be included
+      :filepath: alternative to ``data``, path to file holding results
+        already in the requested ``response_format``
 
     :return: HTTP Response appropriate for given job result.
 
@@ -1167,6 +1187,20 @@ def format_task_output(result):
         required_user_id=result.get('required_user_id'),
         required_roles=result.get('required_roles', []))
 
+    filepath = result.get('filepath')
+    if filepath and response_format in ('csv', 'json'):
+        # Task wrote results directly to a file, rather than the result
+        kwargs = {'mimetype': 'application/json'}
+        if response_format == 'csv':
+            kwargs = {
+                'mimetype': 'text/csv',
+                'as_attachment': True,
+                'download_name': '{}-{}.csv'.format(
+                    result.get('filename_prefix', 'report'),
+                    strftime('%Y_%m_%d-%H_%M'))}
+        return send_report_artifact(
+            os.path.dirname(filepath), os.path.basename(filepath), **kwargs)
+
     if response_format == 'csv':
         def gen(items):
             yield ','.join(column_headers) + '\n'  # header row
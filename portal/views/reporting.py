@@ -10,7 +10,6 @@ from flask import (
     make_response,
     render_template,
     request,
-    send_from_directory,
     url_for,
 )
 from flask_user import roles_required
@@ -19,6 +18,7 @@ from ..date_tools import report_format
 from ..extensions import oauth
 from ..models.organization import Organization, OrgTree
 from ..models.qb_status import QB_Status
+from ..models.report_artifact import send_report_artifact
 from ..models.research_study import BASE_RS_ID
 from ..models.role import ROLE
 from ..models.user import current_user, patients_query
@@ -341,4 +341,4 @@ def questionnaire_status():
 def expose_report_download(filename):
     """Direct access to files generated via research_report_task"""
     report_dir = current_app.config.get('TMP_REPORT_DIR')
-    return send_from_directory(report_dir, filename, as_attachment=True)
+    return send_report_artifact(report_dir, filename, as_attachment=True)
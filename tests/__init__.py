@@ -37,6 +37,7 @@ from portal.models.organization import (
     add_static_organization,
 )
 from portal.models.practitioner import Practitioner
+from portal.models.protocol_schedule import ProtocolSchedule
 from portal.models.procedure import Procedure
 from portal.models.qb_timeline import invalidate_users_QBT
 from portal.models.questionnaire_bank import add_static_questionnaire_bank
@@ -581,6 +582,7 @@ class TestCase(Base):
             if attr.startswith('_lazy'):
                 delattr(INTERVENTION, attr)
         OrgTree.invalidate_cache()
+        ProtocolSchedule.invalidate_cache()
 
         # Removed potentially cached data from other tests
         cache.clear()
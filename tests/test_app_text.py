@@ -1,15 +1,20 @@
 """Unit test module for app_text"""
 
 
+import json
 import sys
 from urllib.parse import parse_qsl, unquote_plus, urlparse
 
 from flask import render_template_string
 from flask_webtest import SessionScope
+from mock import Mock, patch
 import pytest
+from requests.exceptions import ConnectionError
 
+from portal.cache import cache
 from portal.extensions import db
 from portal.models.app_text import (
+    CONTENT_CACHE_KEY,
     AppText,
     MailResource,
     UnversionedResource,
@@ -150,3 +155,49 @@ def test_mail_resource():
     # test footer optionality
     tmr._footer = None
     assert len(tmr.body.splitlines()) == 1
+
+
+def test_mail_resource_cache(app):
+    url = "https://cms.example.com/mail?version=latest&uuid=cached"
+    localized = url + "&languageId=en_AU"
+    cache.delete(CONTENT_CACHE_KEY.format(localized))
+    template = {
+        "subject": "Hi {name}", "body": "Visit {link}", "version": 3}
+    fetched = Mock(
+        status_code=200, reason="OK", text=json.dumps(template),
+        headers={'ETag': '"v3"'})
+
+    with patch('portal.models.app_text.requests.get') as mock_get:
+        mock_get.return_value = fetched
+        first = MailResource(url, 'en_AU', variables={
+            'name': 'A', 'link': 'x'})
+        second = MailResource(url, 'en_AU', variables={
+            'name': 'B', 'link': 'y'})
+        assert mock_get.call_count == 1
+        assert (first.subject, second.subject) == ("Hi A", "Hi B")
+        assert Url(second.url) == Url(
+            "https://cms.example.com/mail?version=3&uuid=cached"
+            "&languageId=en_AU")
+
+        # once stale, revalidate with the stored ETag
+        entry = cache.get(CONTENT_CACHE_KEY.format(localized))
+        entry['validated'] -= app.config['CONTENT_CACHE_TTL']
+        cache.set(CONTENT_CACHE_KEY.format(localized), entry)
+        mock_get.return_value = Mock(status_code=304, headers={})
+        third = MailResource(url, 'en_AU', variables={
+            'name': 'C', 'link': 'z'})
+        assert mock_get.call_count == 2
+        assert mock_get.call_args[1]['headers'] == {'If-None-Match': '"v3"'}
+        assert third.body == "Visit z"
+
+        # unreachable server falls back to the stale entry
+        mock_get.side_effect = ConnectionError
+        mock_get.reset_mock()
+        entry = cache.get(CONTENT_CACHE_KEY.format(localized))
+        entry['validated'] -= app.config['CONTENT_CACHE_TTL']
+        cache.set(CONTENT_CACHE_KEY.format(localized), entry)
+        fourth = MailResource(url, 'en_AU', variables={
+            'name': 'D', 'link': 'w'})
+        assert mock_get.call_count == 1
+        assert fourth.subject == "Hi D"
+        assert not fourth.error_msg
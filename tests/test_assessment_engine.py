@@ -7,6 +7,7 @@ from dateutil.relativedelta import relativedelta
 from flask_swagger import swagger
 from flask_webtest import SessionScope
 import jsonschema
+from mock import patch
 import pytest
 
 from portal.date_tools import FHIR_datetime
@@ -14,6 +15,12 @@ from portal.extensions import db
 from portal.models.audit import Audit
 from portal.models.identifier import Identifier
 from portal.models.organization import Organization
+from portal.models.post_submit import (
+    POST_SUBMIT_STAGES,
+    complete_pending_recompute,
+    pending_qnr_ids,
+    queue_post_submit,
+)
 from portal.models.questionnaire_bank import (
     QuestionnaireBank,
     QuestionnaireBankQuestionnaire,
@@ -47,6 +54,22 @@ class TestAssessmentEngine(TestCase):
         with pytest.raises(jsonschema.ValidationError):
             QuestionnaireResponse.validate_document(data)
 
+    def test_qnr_batch_validation(self):
+        swagger_spec = swagger(self.app)
+        good = swagger_spec['definitions']['QuestionnaireResponse']['example']
+        with open(os.path.join(os.path.dirname(
+                __file__), 'bad_qnr.json'), 'r') as fhir_data:
+            bad = json.load(fhir_data)
+
+        failures = QuestionnaireResponse.validate_documents((good, bad, good))
+        assert [i for i, _ in failures] == [1]
+        assert isinstance(failures[0][1], jsonschema.ValidationError)
+
+        # compiled once, reused across calls
+        assert (
+            QuestionnaireResponse.validator() is
+            QuestionnaireResponse.validator())
+
     def test_submit_assessment(self):
         swagger_spec = swagger(self.app)
         data = swagger_spec['definitions']['QuestionnaireResponse']['example']
@@ -65,6 +88,79 @@ class TestAssessmentEngine(TestCase):
             self.test_user.questionnaire_responses[0].encounter.auth_method
             == 'password_authenticated')
 
+    def test_qnr_document_columns(self):
+        swagger_spec = swagger(self.app)
+        data = swagger_spec['definitions']['QuestionnaireResponse']['example']
+
+        self.promote_user(role_name=ROLE.PATIENT.value)
+        self.login()
+        response = self.client.post(
+            '/api/patient/{}/assessment'.format(TEST_USER_ID), json=data)
+        assert response.status_code == 200
+
+        qnr = QuestionnaireResponse.query.filter_by(
+            subject_id=TEST_USER_ID).one()
+        assert qnr.authored == FHIR_datetime.parse(data['authored'])
+        assert qnr.instrument_id == 'epic26'
+        assert qnr.identifier_system == data['identifier']['system']
+        assert qnr.identifier_value == data['identifier']['value']
+        identifier = Identifier.from_fhir(data['identifier'])
+        assert QuestionnaireResponse.by_identifier(identifier).one() == qnr
+
+        # reassignment of document maintains columns, converted to UTC
+        document = dict(qnr.document)
+        document['authored'] = '2016-03-11T16:47:28-07:00'
+        qnr.document = document
+        db.session.commit()
+        qnr = QuestionnaireResponse.query.get(qnr.id)
+        assert qnr.authored == datetime(2016, 3, 11, 23, 47, 28)
+
+    def test_submit_assessment_async(self):
+        swagger_spec = swagger(self.app)
+        data = swagger_spec['definitions']['QuestionnaireResponse']['example']
+
+        self.app.config['ASYNC_QNR_SUBMIT'] = True
+        self.add_questionnaire(name='epic26')
+        self.promote_user(role_name=ROLE.PATIENT.value)
+        self.login()
+        response = self.client.post(
+            '/api/patient/{}/assessment'.format(TEST_USER_ID), json=data)
+        assert response.status_code == 200
+        assert response.json['ok']
+
+        # whether or not the queued chain ran, an inline recompute
+        # leaves the QNR assigned and nothing pending
+        complete_pending_recompute(TEST_USER_ID, acting_user_id=TEST_USER_ID)
+        qnr = QuestionnaireResponse.query.filter_by(
+            subject_id=TEST_USER_ID).one()
+        assert qnr.questionnaire_bank_id == 0  # no matching QB
+        assert pending_qnr_ids(TEST_USER_ID) == []
+
+    def test_queue_post_submit_extracts_last(self):
+        swagger_spec = swagger(self.app)
+        data = swagger_spec['definitions']['QuestionnaireResponse']['example']
+        qnr = QuestionnaireResponse(
+            subject_id=TEST_USER_ID, status='completed', document=data,
+            encounter=self.test_user.current_encounter())
+        with SessionScope(db):
+            db.session.add(qnr)
+            db.session.commit()
+        qnr = db.session.merge(qnr)
+
+        with patch('celery.chain') as mock_chain:
+            queue_post_submit(
+                qnr, acting_user_id=TEST_USER_ID, extract_observations=True)
+        links = mock_chain.call_args[0]
+        assert len(links) == len(POST_SUBMIT_STAGES) + 1
+        assert links[-1].task == 'tasks.extract_observations_task'
+        assert links[-1].immutable
+        assert links[-1].kwargs == {'questionnaire_response_id': qnr.id}
+        mock_chain.return_value.apply_async.assert_called_once_with()
+
+        with patch('celery.chain') as mock_chain:
+            queue_post_submit(qnr, acting_user_id=TEST_USER_ID)
+        assert len(mock_chain.call_args[0]) == len(POST_SUBMIT_STAGES)
+
     def test_submit_invalid_assessment(self):
         data = {'no_questionnaire_field': True}
 
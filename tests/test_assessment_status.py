@@ -6,8 +6,10 @@ from pytz import timezone, utc
 from random import choice
 from string import ascii_letters
 
+from billiard import Pool
 from dateutil.relativedelta import relativedelta
 from flask_webtest import SessionScope
+from mock import patch
 import pytest
 from sqlalchemy.orm.exc import NoResultFound
 
@@ -24,6 +26,7 @@ from portal.models.questionnaire import Questionnaire
 from portal.models.questionnaire_bank import (
     QuestionnaireBank,
     QuestionnaireBankQuestionnaire,
+    trigger_date,
 )
 from portal.models.questionnaire_response import (
     QNR_results,
@@ -33,14 +36,26 @@ from portal.models.questionnaire_response import (
 )
 from portal.models.recur import Recur
 from portal.models.research_data import (
+    ResearchData,
     add_questionnaire_response,
+    backfill_research_data,
     invalidate_patient_research_data,
+    partition_subjects,
     update_single_patient_research_data,
 )
 from portal.models.research_protocol import ResearchProtocol
 from portal.models.role import ROLE
 from portal.models.user import User
+from portal.scoped_cache import (
+    MAX_SCOPED_USERS,
+    avoided_rebuilds,
+    close_scope,
+    open_scope,
+    scoped_get,
+    scoped_set,
+)
 from portal.system_uri import ICHOM
+from portal.tasks import research_report_task
 from tests import TEST_USER_ID, TestCase, associative_backdate
 
 now = utcnow_sans_micro()
@@ -347,6 +362,125 @@ class TestAggregateResponses(TestQuestionnaireSetup):
         found = [i['timepoint'] for i in bundle['entry']]
         assert set(found) == expected
 
+    def test_aggregate_response_workers(self):
+        # serialization across worker processes matches a single process
+        nineback, nowish = associative_backdate(
+            now=now, backdate=relativedelta(months=9, hours=1))
+        self.bless_with_basics(
+            setdate=nineback, local_metastatic='metastatic')
+        for months_back in (0, 3, 6, 9):
+            backdate, _ = associative_backdate(
+                now=now, backdate=relativedelta(months=months_back))
+            mock_qr(instrument_id='eortc', timestamp=backdate)
+        invalidate_patient_research_data(TEST_USER_ID, research_study_id=0)
+        update_single_patient_research_data(TEST_USER_ID)
+
+        staff = self.add_user(username='staff')
+        staff.organizations.append(Organization.query.filter(
+                Organization.name == 'metastatic').one())
+        self.promote_user(staff, role_name=ROLE.STAFF.value)
+        staff = db.session.merge(staff)
+
+        def aggregate(workers, bundle_format):
+            self.app.config['AGGREGATE_FETCH_SIZE'] = 1
+            filename = aggregate_responses(
+                instrument_ids=['eortc'],
+                current_user=staff,
+                bundle_format=bundle_format,
+                workers=workers)
+            with open(filename, 'r', newline='') as f:
+                return f.read()
+
+        # skip first line, as bundle header includes generation time
+        with patch(
+                'portal.models.questionnaire_response.Pool',
+                side_effect=AssertionError("pool used by single worker")):
+            serial = aggregate(workers=1, bundle_format=True)
+        pooled = aggregate(workers=2, bundle_format=True)
+        assert serial.split('\n', 1)[1] == pooled.split('\n', 1)[1]
+        assert len(json.loads(pooled)['entry']) == 4
+
+    def test_research_report_task_pool(self):
+        # the task serializes with a pool of AGGREGATE_WORKERS processes
+        nineback, nowish = associative_backdate(
+            now=now, backdate=relativedelta(months=9, hours=1))
+        self.bless_with_basics(
+            setdate=nineback, local_metastatic='metastatic')
+        for months_back in (0, 3):
+            backdate, _ = associative_backdate(
+                now=now, backdate=relativedelta(months=months_back))
+            mock_qr(instrument_id='eortc', timestamp=backdate)
+        invalidate_patient_research_data(TEST_USER_ID, research_study_id=0)
+        update_single_patient_research_data(TEST_USER_ID)
+
+        staff = self.add_user(username='staff')
+        staff.organizations.append(Organization.query.filter(
+                Organization.name == 'metastatic').one())
+        self.promote_user(staff, role_name=ROLE.STAFF.value)
+        staff_id = db.session.merge(staff).id
+
+        self.app.config['AGGREGATE_WORKERS'] = 2
+        self.app.config['AGGREGATE_FETCH_SIZE'] = 1
+        with patch(
+                'portal.models.questionnaire_response.Pool',
+                side_effect=Pool) as pool:
+            results = research_report_task.run(
+                instrument_ids=['eortc'],
+                acting_user_id=staff_id,
+                request_url='http://localhost/api/report',
+                response_format='json',
+                lock_key='research_report_task_lock',
+                celery_task=None)
+        pool.assert_called_once_with(2)
+        with open(results['filepath'], 'r') as f:
+            assert len(json.load(f)['entry']) == 2
+
+    def test_research_data_backfill(self):
+        # bulk backfill generates rows matching those added per QNR
+        nineback, nowish = associative_backdate(
+            now=now, backdate=relativedelta(months=9, hours=1))
+        self.bless_with_basics(
+            setdate=nineback, local_metastatic='metastatic')
+        for months_back in (0, 3, 6, 9):
+            backdate, _ = associative_backdate(
+                now=now, backdate=relativedelta(months=months_back))
+            mock_qr(instrument_id='eortc', timestamp=backdate)
+
+        invalidate_patient_research_data(TEST_USER_ID, research_study_id=0)
+        update_single_patient_research_data(TEST_USER_ID)
+        expected = {
+            rd.questionnaire_response_id: rd.data
+            for rd in ResearchData.query.filter(
+                ResearchData.subject_id == TEST_USER_ID)}
+        assert len(expected) == 4
+
+        invalidate_patient_research_data(TEST_USER_ID, research_study_id=0)
+        result = backfill_research_data({TEST_USER_ID: list(expected)})
+        assert result == {'subjects': 1, 'added': 4, 'errors': 0}
+        found = {
+            rd.questionnaire_response_id: rd.data
+            for rd in ResearchData.query.filter(
+                ResearchData.subject_id == TEST_USER_ID)}
+        assert found == expected
+
+        # repeat skips rows already cached
+        result = backfill_research_data({TEST_USER_ID: list(expected)})
+        assert result['added'] == 0
+
+        # a failed insert is counted, not raised
+        invalidate_patient_research_data(TEST_USER_ID, research_study_id=0)
+        with patch(
+                'portal.models.research_data.insert_research_rows',
+                side_effect=RuntimeError("insert failed")):
+            result = backfill_research_data({TEST_USER_ID: list(expected)})
+        assert result == {'subjects': 1, 'added': 0, 'errors': 1}
+
+    def test_partition_subjects(self):
+        missing = {1: [1] * 5, 2: [1] * 3, 3: [1] * 2, 4: [1]}
+        partitions = partition_subjects(missing, workers=2)
+        assert sorted(map(sorted, partitions)) == [[1, 4], [2, 3]]
+        assert partition_subjects({1: [1]}, workers=4) == [[1]]
+
     def test_site_ids(self):
         self.add_system_user()
         # bless org w/ expected identifier type
@@ -519,6 +653,64 @@ class TestQB_Status(TestQuestionnaireSetup):
                 {'eproms_add'})
         assert not a_s.instruments_in_progress()
 
+    def test_scoped_status(self):
+        # Repeat builds within a scope are avoided, until invalidated
+        self.bless_with_basics(local_metastatic='localized', setdate=now)
+        mock_qr(instrument_id='eproms_add', timestamp=now)
+        self.test_user = db.session.merge(self.test_user)
+
+        with self.app.test_request_context():
+            open_scope()
+            first = QB_Status(
+                user=self.test_user, research_study_id=0, as_of_date=now)
+            second = QB_Status(
+                user=self.test_user, research_study_id=0, as_of_date=now)
+            assert second.overall_status == first.overall_status
+            assert second.current_qbd() == first.current_qbd()
+            assert avoided_rebuilds()['QB_Status'] == 1
+
+            # persisting a QNR purges the subject's entries
+            mock_qr(instrument_id='epic26', timestamp=now)
+            mock_qr(instrument_id='comorb', timestamp=now)
+            invalidate_users_QBT(TEST_USER_ID, research_study_id=0)
+            self.test_user = db.session.merge(self.test_user)
+            avoided = avoided_rebuilds()['QB_Status']
+            third = QB_Status(
+                user=self.test_user, research_study_id=0, as_of_date=now)
+            assert third.overall_status == OverallStatus.completed
+            assert avoided_rebuilds()['QB_Status'] == avoided
+            assert close_scope()['QB_Status'] == avoided
+        assert not avoided_rebuilds()
+
+    def test_scoped_trigger_date(self):
+        # the scope is consulted before the shared cache
+        self.bless_with_basics(local_metastatic='localized', setdate=now)
+        self.test_user = db.session.merge(self.test_user)
+
+        with self.app.test_request_context():
+            open_scope()
+            first = trigger_date(self.test_user, research_study_id=0)
+            assert trigger_date(self.test_user, research_study_id=0) == first
+            assert close_scope()['trigger_date'] == 1
+
+    def test_scope_bounded_by_user(self):
+        # only the most recently used users are held
+        user_ids = range(1, MAX_SCOPED_USERS + 2)
+        with self.app.test_request_context():
+            open_scope()
+            for user_id in user_ids:
+                scoped_set('kind', user_id, 0, None, user_id)
+            assert scoped_get('kind', user_ids[0], 0) is None
+            for user_id in user_ids[1:]:
+                assert scoped_get('kind', user_id, 0) == user_id
+
+            # reading marks a user recently used
+            scoped_get('kind', user_ids[1], 0)
+            scoped_set('kind', 0, 0, None, 0)
+            assert scoped_get('kind', user_ids[1], 0) == user_ids[1]
+            assert scoped_get('kind', user_ids[2], 0) is None
+            close_scope()
+
     def test_metastatic_on_time(self):
         # User finished both on time
 
@@ -3,12 +3,16 @@
 
 from datetime import datetime
 import re
+from smtplib import SMTPServerDisconnected
 
 from dateutil.relativedelta import relativedelta
+from flask_mail import Message
 from flask_webtest import SessionScope
+from mock import patch
 import pytest
 
 from portal.database import db
+from portal.extensions import mail
 from portal.models.audit import Audit
 from portal.models.clinical_constants import CC
 from portal.models.communication import (
@@ -16,6 +20,10 @@ from portal.models.communication import (
     DynamicDictLookup,
     load_template_args,
 )
+from portal.models.communication_dispatch import (
+    PooledMailer,
+    dispatch_communications,
+)
 from portal.models.communication_request import CommunicationRequest
 from portal.models.identifier import Identifier
 from portal.models.intervention import Intervention
@@ -311,6 +319,44 @@ class TestCommunication(TestQuestionnaireSetup):
         assert preview.subject
         assert preview.recipients == TEST_USERNAME
 
+    def test_pooled_mailer(self):
+        message = Message(
+            subject='subj', recipients=[TEST_USERNAME], body='body')
+        with patch.object(mail, 'connect', wraps=mail.connect) as connect:
+            with PooledMailer(rate_limit=0) as mailer:
+                mailer.send(message)
+                mailer.send(message)
+            assert connect.call_count == 1
+            assert mailer.sent == 2
+
+    def test_dispatch_isolates_failures(self):
+        crs = [
+            mock_communication_request('localized', f'{{"days": {days}}}')
+            for days in (7, 14, 21)]
+        with SessionScope(db):
+            for cr in crs:
+                db.session.add(Communication(
+                    user_id=TEST_USER_ID, communication_request=cr,
+                    status='preparation'))
+            db.session.commit()
+        ids = [c.id for c in Communication.query.order_by(Communication.id)]
+
+        def fake_send(communication, mailer):
+            if communication.id == ids[0]:
+                raise SMTPServerDisconnected("dropped")
+            communication.status = 'completed'
+
+        with patch.object(
+                Communication, 'generate_and_send', autospec=True,
+                side_effect=fake_send):
+            counts = dispatch_communications(ids)
+            # repeat finds only the failure outstanding
+            repeat = dispatch_communications(ids)
+
+        assert counts == {'error': 1, 'completed': 2}
+        assert repeat == {'error': 1, 'skipped': 2}
+        assert Communication.query.get(ids[0]).status == 'preparation'
+
     def test_practitioner(self):
         self.bless_with_basics()
         dr = self.add_practitioner(first_name='Bob', last_name='Jones')
@@ -2,11 +2,14 @@ from collections import defaultdict
 from flask_webtest import SessionScope
 import json
 import os
+from mock import Mock, patch
 from pytest import fixture
+from sqlalchemy import event
 
 from portal.database import db
 from portal.models.observation import Observation
 from portal.trigger_states.empro_domains import DomainManifold
+from portal.trigger_states.sdc import extract
 
 
 def json_from_file(request, filename):
@@ -78,6 +81,29 @@ def test_obtain_observations(obs_w_extension, initialized_with_ss_qnr):
     assert dm.cur_obs['joint_pain']['ironman_ss.4'] == (4, 'penultimate')
 
 
+def test_obtain_observations_single_query(
+        obs_bundle, initialized_with_ss_qnr):
+    Observation.parse_obs_bundle(obs_bundle)
+    db.session.commit()
+    qnr = db.session.merge(initialized_with_ss_qnr)
+
+    statements = []
+
+    def track(conn, cursor, statement, parameters, context, executemany):
+        if 'FROM observations' in statement:
+            statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', track)
+    try:
+        dm = DomainManifold(qnr)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', track)
+    assert len(statements) == 1
+    assert dm.cur_obs['general_pain']['ironman_ss.3'] == (5, 'ultimate')
+    assert dm.cur_obs['joint_pain']['ironman_ss.4'] == (3, None)
+    assert len(dm.cur_obs) == 8
+
+
 def test_parse_bundle(obs_bundle_sans_extension, initialized_with_ss_qnr):
     Observation.parse_obs_bundle(obs_bundle_sans_extension)
     expect = {
@@ -104,3 +130,78 @@ def test_parse_bundle_extensions(obs_bundle, initialized_with_ss_qnr):
 
     assert found_extensions['ultimate'] == 8
     assert found_extensions['penultimate'] == 11
+
+
+@fixture
+def sdc_submission(obs_bundle):
+    """SDC submission for the QNR from which `obs_bundle` was extracted"""
+    config = os.path.join(
+        os.path.dirname(__file__), '..', 'portal', 'config', 'eproms',
+        'Questionnaire.json')
+    with open(config, 'r') as json_file:
+        ironman_ss = [
+            q for q in json.load(json_file)['entry']
+            if q['identifier'][0]['value'] == 'ironman_ss'][0]
+
+    questions = []
+    for ob in obs_bundle['entry']:
+        code = ob['valueCoding']['code']
+        questions.append({
+            'linkId': code.rsplit('.', 1)[0],
+            'answer': [{'valueCoding': {
+                'code': code, 'system': ob['valueCoding']['system']}}]})
+    # unscored answers are ignored
+    questions.append({
+        'linkId': 'ironman_ss.21', 'answer': [{'valueString': 'n/a'}]})
+    return {
+        'resourceType': 'QuestionnaireResponse',
+        'authored': '2020-11-23T18:31:41Z',
+        'identifier': {
+            'system': 'https://stg-ae.us.truenth.org/eproms-demo',
+            'value': '538.0'},
+        'group': {'question': questions},
+        'contained': [ironman_ss],
+    }
+
+
+def conformance_view(bundle):
+    """Reduce bundle to the details used in trigger evaluation"""
+    def severity(coding):
+        for extension in coding.get('extension', ()):
+            return extension['valueCoding']['code']
+
+    return sorted(
+        (ob['code']['coding'][0]['code'],
+         ob['valueCoding']['code'],
+         ob['valueCoding']['system'],
+         severity(ob['valueCoding']),
+         ob['derivedFrom'][0]['reference'],
+         ob['issued'])
+        for ob in bundle['entry'])
+
+
+def test_local_extract_conformance(app, sdc_submission, obs_bundle):
+    results = extract(sdc_submission, backend='local')
+    assert results['total'] == len(results['entry'])
+    assert conformance_view(results) == conformance_view(obs_bundle)
+
+
+def test_extract_backends_agree(app, sdc_submission, obs_bundle):
+    with patch('portal.trigger_states.sdc.post') as mock_post:
+        mock_post.return_value = Mock(json=Mock(return_value=obs_bundle))
+        remote = extract(sdc_submission, backend='http')
+    mock_post.assert_called_once_with(
+        f"{app.config['SDC_BASE_URL']}/$extract", json=sdc_submission)
+
+    local = extract(sdc_submission, backend='local')
+    assert conformance_view(local) == conformance_view(remote)
+
+
+def test_local_extract_manifold(sdc_submission, initialized_with_ss_qnr):
+    Observation.parse_obs_bundle(extract(sdc_submission, backend='local'))
+    db.session.commit()
+
+    qnr = db.session.merge(initialized_with_ss_qnr)
+    dm = DomainManifold(qnr)
+    assert dm.cur_obs['joint_pain']['ironman_ss.4'] == (3, None)
+    assert dm.cur_obs['social_isolation']['ironman_ss.20'] == (4, 'ultimate')
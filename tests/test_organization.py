@@ -9,11 +9,13 @@ from urllib.parse import quote_plus
 from flask_webtest import SessionScope
 import pytest
 
+from portal.cache import cache
 from portal.extensions import db
 from portal.models.coding import Coding
 from portal.models.identifier import Identifier
 from portal.models.locale import LocaleConstants
 from portal.models.organization import (
+    ORG_TREE_VERSION_KEY,
     LocaleExtension,
     Organization,
     OrganizationIdentifier,
@@ -680,6 +682,25 @@ def test_here_and_below_id(deepen_org_tree):
         assert i in nodes
 
 
+def test_at_or_below_ids(deepen_org_tree):
+    ot = OrgTree()
+    assert ot.at_or_below_ids(102, [1001, 10031])
+    assert not ot.at_or_below_ids(101, [102, 10031])
+    assert not ot.at_or_below_ids(10031, [1002])
+
+
+def test_org_tree_version(deepen_org_tree):
+    assert OrgTree().here_and_below_id(1002)
+    with SessionScope(db):
+        db.session.add(Organization(id=10033, name='l3_3', partOf_id=1002))
+        db.session.commit()
+
+    # another process invalidating bumps the shared version stamp
+    cache.set(ORG_TREE_VERSION_KEY, 'edited elsewhere', timeout=0)
+    assert 10033 in OrgTree().here_and_below_id(102)
+    assert OrgTree().at_and_above_ids(10033) == [10033, 1002, 102]
+
+
 def test_visible_orgs_on_none(test_user, promote_user):
     # Add none of the above to users orgs
     test_user.organizations.append(Organization.query.get(0))
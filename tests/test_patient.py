@@ -9,6 +9,8 @@ from portal.date_tools import FHIR_datetime
 from portal.extensions import db
 from portal.models.audit import Audit
 from portal.models.identifier import Identifier, UserIdentifier
+from portal.models.organization import Organization
+from portal.models.patient_list import PatientList
 from portal.models.reference import Reference
 from portal.models.role import ROLE
 from portal.models.user import User
@@ -293,3 +295,41 @@ class TestPatient(TestCase):
             content_type='application/json',
             data=json.dumps(data))
         assert response.status_code == 400
+
+    def test_page_of_patients_seek(self):
+        org = Organization(name='list org')
+        with SessionScope(db):
+            db.session.add(org)
+            db.session.commit()
+        org = db.session.merge(org)
+        org_id = org.id
+        self.test_user = db.session.merge(self.test_user)
+        self.test_user.organizations.append(org)
+        self.promote_user(role_name=ROLE.STAFF.value)
+
+        # duplicate and missing sort values exercise the userid tiebreak
+        lastnames = ('Baker', None, 'Adams', 'Baker', None, 'Carter', 'Baker')
+        with SessionScope(db):
+            for i, lastname in enumerate(lastnames):
+                user = self.add_user(f'patient{i}')
+                db.session.add(PatientList(
+                    userid=user.id, lastname=lastname, org_id=org_id,
+                    test_role=False, deleted=False))
+            db.session.commit()
+
+        self.login()
+        for order in ('asc', 'desc'):
+            args = {'sort': 'lastname', 'order': order, 'limit': 10}
+            response = self.client.get('/patients/page', query_string=args)
+            assert response.status_code == 200
+            assert response.json['total'] == len(lastnames)
+            expected = [row['userid'] for row in response.json['rows']]
+
+            # following pages seek past prior page, matching single page order
+            paged = []
+            for offset in range(0, len(lastnames), 3):
+                args.update({'offset': offset, 'limit': 3})
+                response = self.client.get(
+                    '/patients/page', query_string=args)
+                paged.extend(row['userid'] for row in response.json['rows'])
+            assert paged == expected
@@ -1,20 +1,30 @@
 from datetime import datetime
+import re
 
 from dateutil.relativedelta import relativedelta
+from mock import patch
 import pytest
 
 from portal.cache import cache
 from portal.database import db
 from portal.date_tools import FHIR_datetime, utcnow_sans_micro
 from portal.models.overall_status import OverallStatus
+from portal.models.protocol_schedule import ProtocolSchedule, QBRegistry
 from portal.models.qb_status import QB_Status
 from portal.models.qb_timeline import (
     QBT,
     AtOrderedList,
+    QBT_ResumePoint,
     QB_StatusCacheKey,
+    TimelineSnapshot,
+    generate_QBT_rows,
+    invalidate_users_QBT,
     ordered_qbs,
+    qb_status_visit_name,
+    qbt_bloat_report,
     second_null_safe_datetime,
     update_users_QBT,
+    update_users_QBT_batch,
 )
 from portal.models.questionnaire_bank import (
     QuestionnaireBank,
@@ -22,6 +32,8 @@ from portal.models.questionnaire_bank import (
     visit_name,
 )
 from portal.models.questionnaire_response import QuestionnaireResponse
+from portal.models.research_protocol import ResearchProtocol
+from portal.patient_generation import generation
 from portal.views.user import withdraw_consent
 from tests import TEST_USER_ID, TestCase, associative_backdate
 from tests.test_assessment_status import mock_qr
@@ -590,6 +602,277 @@ class TestQbTimeline(TestQuestionnaireBankFixture):
         assert a_s.enrolled_in_classification('indefinite') is None
 
 
+    def timeline_rows(self):
+        """Comparable form of test user's timeline"""
+        return [
+            (qbt.at, str(qbt.status), qbt.qb_id, qbt.qb_iteration,
+             qbt.qb_recur_id) for qbt in QBT.query.filter(
+                QBT.user_id == TEST_USER_ID).order_by(QBT.at, QBT.id)]
+
+    def test_incremental_matches_full_rebuild(self):
+        crv = self.setup_org_qbs()
+        back10, nowish = associative_backdate(
+            now=now, backdate=relativedelta(months=10))
+        self.bless_with_basics(setdate=back10)
+        self.test_user = db.session.merge(self.test_user)
+        self.test_user.organizations.append(crv)
+        self.add_system_user()
+
+        baseline = QuestionnaireBank.query.filter(
+            QuestionnaireBank.name == "CRV Baseline v2").one()
+        baseline_id = baseline.id
+        for q in baseline.questionnaires:
+            q = db.session.merge(q)
+            mock_qr(q.name, qb=baseline, timestamp=back10)
+
+        # partial 9 month submission, full rebuild as reference
+        authored = nowish - relativedelta(weeks=2)
+        nineMo = QuestionnaireBank.query.filter(
+            QuestionnaireBank.name == "CRV_recurring_3mo_period v2").one()
+        mock_qr('epic26_v2', qb=nineMo, iteration=1, timestamp=authored)
+        update_users_QBT(TEST_USER_ID, research_study_id=0)
+        full_rebuild = self.timeline_rows()
+        baseline_ids = {qbt.id for qbt in QBT.query.filter(
+            QBT.qb_id == baseline_id)}
+
+        # the resume point commits with the truncation, or not at all
+        with patch.object(
+                db.session, 'commit', side_effect=RuntimeError("lost")):
+            with pytest.raises(RuntimeError):
+                invalidate_users_QBT(
+                    TEST_USER_ID, research_study_id=0, since=authored)
+        db.session.rollback()
+        assert QBT_ResumePoint(TEST_USER_ID, 0).value() is None
+        assert self.timeline_rows() == full_rebuild
+
+        invalidate_users_QBT(
+            TEST_USER_ID, research_study_id=0, since=authored)
+        db.session.expire_all()
+        assert QBT_ResumePoint(TEST_USER_ID, 0).value()
+        assert QBT.query.count() < len(full_rebuild)
+        update_users_QBT(TEST_USER_ID, research_study_id=0)
+
+        assert self.timeline_rows() == full_rebuild
+        assert QBT_ResumePoint(TEST_USER_ID, 0).value() is None
+        # rows prior to the change were retained, not regenerated
+        assert baseline_ids == {qbt.id for qbt in QBT.query.filter(
+            QBT.qb_id == baseline_id)}
+
+    def test_incremental_before_timeline(self):
+        crv = self.setup_org_qbs()
+        self.bless_with_basics()
+        self.test_user = db.session.merge(self.test_user)
+        self.test_user.organizations.append(crv)
+        self.add_system_user()
+        update_users_QBT(TEST_USER_ID, research_study_id=0)
+        full_rebuild = self.timeline_rows()
+
+        # change predating the timeline falls back to full invalidation
+        invalidate_users_QBT(
+            TEST_USER_ID, research_study_id=0,
+            since=now - relativedelta(years=1))
+        assert QBT.query.count() == 0
+        assert QBT_ResumePoint(TEST_USER_ID, 0).value() is None
+        update_users_QBT(TEST_USER_ID, research_study_id=0)
+        assert self.timeline_rows() == full_rebuild
+
+
+    def test_batch_matches_single(self):
+        crv = self.setup_org_qbs()
+        back10, nowish = associative_backdate(
+            now=now, backdate=relativedelta(months=10))
+        self.bless_with_basics(setdate=back10)
+        self.test_user = db.session.merge(self.test_user)
+        self.test_user.organizations.append(crv)
+        self.add_system_user()
+
+        threeMo = QuestionnaireBank.query.filter(
+            QuestionnaireBank.name == "CRV_recurring_3mo_period v2").one()
+        mock_qr(
+            'epic26_v2', qb=threeMo, iteration=0,
+            timestamp=back10 + relativedelta(months=3, days=2))
+        update_users_QBT(TEST_USER_ID, research_study_id=0)
+        single = self.timeline_rows()
+
+        invalidate_users_QBT(TEST_USER_ID, research_study_id='all')
+        assert update_users_QBT_batch(
+            [TEST_USER_ID], research_study_id=0) == [TEST_USER_ID]
+        assert self.timeline_rows() == single
+
+        # current timelines are skipped
+        assert update_users_QBT_batch(
+            [TEST_USER_ID], research_study_id=0) == []
+        assert self.timeline_rows() == single
+
+        # a timeline stored elsewhere while the batch generates isn't repeated
+        invalidate_users_QBT(TEST_USER_ID, research_study_id='all')
+        raced = []
+
+        def generate_elsewhere(*args, **kwargs):
+            if not raced:
+                raced.append(True)
+                update_users_QBT(TEST_USER_ID, research_study_id=0)
+            return generate_QBT_rows(*args, **kwargs)
+
+        with patch(
+                'portal.models.qb_timeline.generate_QBT_rows',
+                side_effect=generate_elsewhere):
+            assert update_users_QBT_batch(
+                [TEST_USER_ID], research_study_id=0) == []
+        assert self.timeline_rows() == single
+
+    def test_bulk_write_paths(self):
+        # INSERT and COPY write identical rows, in order
+        crv = self.setup_org_qbs()
+        back10, nowish = associative_backdate(
+            now=now, backdate=relativedelta(months=10))
+        self.bless_with_basics(setdate=back10)
+        self.test_user = db.session.merge(self.test_user)
+        self.test_user.organizations.append(crv)
+        self.add_system_user()
+        threeMo = QuestionnaireBank.query.filter(
+            QuestionnaireBank.name == "CRV_recurring_3mo_period v2").one()
+        mock_qr(
+            'epic26_v2', qb=threeMo, iteration=0,
+            timestamp=back10 + relativedelta(months=3, days=2))
+        update_users_QBT(TEST_USER_ID, research_study_id=0)
+        inserted = self.timeline_rows()
+        assert len(inserted) > 1
+
+        self.app.config['QBT_COPY_THRESHOLD'] = 0
+        invalidate_users_QBT(TEST_USER_ID, research_study_id='all')
+        update_users_QBT(TEST_USER_ID, research_study_id=0)
+        assert self.timeline_rows() == inserted
+
+        report = qbt_bloat_report()
+        assert 'dead_percent' in report['table']
+        assert 'ix_qb_timeline_user_rs_status_at' in {
+            index['name'] for index in report['indexes']}
+
+    def test_patient_generation(self):
+        # cached visit names are orphaned by commits affecting the timeline
+        crv = self.setup_org_qbs()
+        self.bless_with_basics(setdate=now)
+        self.test_user = db.session.merge(self.test_user)
+        self.test_user.organizations.append(crv)
+        self.add_system_user()
+        db.session.commit()
+        as_of = QB_StatusCacheKey().update(datetime.utcnow())
+        assert qb_status_visit_name(TEST_USER_ID, 0, as_of)['status'] == (
+            OverallStatus.due)
+
+        # flushed changes bump only on commit
+        before = generation(TEST_USER_ID)
+        consent = db.session.merge(self.test_user).valid_consents[0]
+        consent.send_reminders = not consent.send_reminders
+        db.session.flush()
+        assert generation(TEST_USER_ID) == before
+        db.session.commit()
+        assert generation(TEST_USER_ID) == before + 1
+
+        # completion is reflected without deleting the memoized value
+        baseline = QuestionnaireBank.query.filter(
+            QuestionnaireBank.name == "CRV Baseline v2").one()
+        for q in baseline.questionnaires:
+            q = db.session.merge(q)
+            mock_qr(q.name, qb=baseline, timestamp=as_of)
+        assert generation(TEST_USER_ID) > before + 1
+        assert qb_status_visit_name(TEST_USER_ID, 0, as_of)['status'] == (
+            OverallStatus.completed)
+
+    def test_task_session_bumps_generation(self):
+        # celery tasks commit through a session of their own
+        from portal.trigger_states.models import TriggerState
+
+        before = generation(TEST_USER_ID)
+        task_session = db.create_scoped_session()
+        try:
+            task_session.add(TriggerState(
+                user_id=TEST_USER_ID, state='due', visit_month=0))
+            task_session.commit()
+        finally:
+            task_session.remove()
+        assert generation(TEST_USER_ID) == before + 1
+
+    def test_protocol_schedule(self):
+        self.setup_org_qbs(include_indef=True)
+        rp_id = ResearchProtocol.query.filter_by(name='v2').one().id
+        recurring = ProtocolSchedule.lookup(rp_id, 'recurring')
+        assert ProtocolSchedule.lookup(rp_id, 'recurring') is recurring
+
+        # shifted schedule must match QB date math, including month ends
+        for td in (datetime(2019, 1, 31), datetime(2020, 2, 29, 12)):
+            expected = [
+                (qbd.questionnaire_bank.id, qbd.iteration,
+                 qbd.recur_id, qbd.relative_start)
+                for qb in QuestionnaireBank.query.filter_by(
+                    research_protocol_id=rp_id,
+                    classification='recurring').order_by(
+                    QuestionnaireBank.id)
+                for qbd in qb.recurring_starts(td)]
+            assert sorted(expected) == sorted([
+                (qbd.questionnaire_bank.id, qbd.iteration,
+                 qbd.recur_id, qbd.relative_start)
+                for qbd in recurring.qbds(td)])
+
+            indef = ProtocolSchedule.lookup(rp_id, 'indefinite').qbds(td)
+            assert len(indef) == 1
+            assert indef[0].relative_start == (
+                indef[0].questionnaire_bank.calculated_start(
+                    td).relative_start)
+
+        ProtocolSchedule.invalidate_cache()
+        assert ProtocolSchedule.lookup(rp_id, 'recurring') is not recurring
+
+    def test_timeline_snapshot(self):
+        from sqlalchemy import event
+        crv = self.setup_org_qbs()
+        back10, nowish = associative_backdate(
+            now=now, backdate=relativedelta(months=10))
+        self.bless_with_basics(setdate=back10)
+        self.test_user = db.session.merge(self.test_user)
+        self.test_user.organizations.append(crv)
+        self.add_system_user()
+        threeMo = QuestionnaireBank.query.filter(
+            QuestionnaireBank.name == "CRV_recurring_3mo_period v2").one()
+        mock_qr(
+            'epic26_v2', qb=threeMo, iteration=0,
+            timestamp=back10 + relativedelta(months=3, days=2))
+        update_users_QBT(TEST_USER_ID, research_study_id=0)
+
+        snapshot = TimelineSnapshot(TEST_USER_ID, research_study_id=0)
+        assert [
+            (r.at, str(r.status), r.qb_id, r.iteration, r.recur_id)
+            for r in snapshot.rows] == self.timeline_rows()
+        assert not snapshot.at_least_one_completed
+        assert snapshot.withdrawal_date is None
+        qbds = snapshot.ordered_qbds()
+        assert [(q.relative_start, q.qb_id, q.iteration) for q in qbds] == [
+            (qbt.at, qbt.qb_id, qbt.qb_iteration) for qbt in QBT.query.filter(
+                QBT.status == OverallStatus.due).order_by(QBT.at, QBT.id)]
+        assert qbds[0].questionnaire_bank in db.session
+        assert qbds[1].recur.id == qbds[1].recur_id
+        assert QBRegistry.questionnaire_bank(
+            qbds[0].qb_id) is qbds[0].questionnaire_bank
+
+        # a status build reads the timeline just once beyond its check
+        statements = []
+
+        def track(conn, cursor, statement, *args):
+            if re.search(r'FROM qb_timeline\b', statement):
+                statements.append(statement)
+
+        self.test_user = db.session.merge(self.test_user)
+        event.listen(db.engine, 'before_cursor_execute', track)
+        try:
+            qb_status = QB_Status(
+                user=self.test_user, research_study_id=0, as_of_date=nowish)
+            list(qb_status.older_qbds(qb_status.current_qbd()))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', track)
+        assert len(statements) == 2
+
+
 class Test_QB_StatusCacheKey(TestCase):
 
     def test_current(self):
@@ -3,7 +3,9 @@
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from flask_webtest import SessionScope
+from mock import patch
 from time import sleep
+from uuid import uuid4
 
 from portal.cache import cache
 from portal.extensions import db
@@ -17,10 +19,27 @@ from portal.models.questionnaire_bank import (
     QuestionnaireBankQuestionnaire,
     trigger_date
 )
-from portal.models.reporting import cache_adherence_data
+from portal.models.report_artifact import (
+    ReportArtifact,
+    purge_report_artifacts,
+    send_report_artifact,
+)
+from portal.models.reporting import (
+    ADHERENCE_CACHE_RUN_KEY,
+    adherence_data_chunk,
+    adherence_report,
+    cache_adherence_data,
+    summarize_adherence_chunks,
+)
 from portal.models.research_protocol import ResearchProtocol
 from portal.models.role import ROLE
+from portal.models.scheduled_job import ScheduledJob
 from portal.system_uri import TRUENTH_EXTERNAL_STUDY_SYSTEM
+from portal.tasks import (
+    cache_adherence_data_failed_task,
+    cache_adherence_data_task,
+    cache_single_patient_adherence_data,
+)
 from portal.timeout_lock import ADHERENCE_DATA_KEY, CacheModeration
 from tests import TEST_USER_ID, TestCase, associative_backdate
 from tests.test_assessment_status import mock_qr
@@ -210,6 +229,47 @@ class TestQBStats(TestQuestionnaireBankFixture):
         assert results[4]["visit"] == "Month 12"
         assert results[4]["status"] == "Completed"
 
+    def test_unknown_visit_sort_key(self):
+        from portal.models.adherence_data import (
+            UNKNOWN_VISIT_SORT_KEY,
+            visit_sort_key,
+        )
+        assert visit_sort_key("Screening") == UNKNOWN_VISIT_SORT_KEY
+        assert visit_sort_key("Indefinite post-withdrawn") < (
+            UNKNOWN_VISIT_SORT_KEY)
+
+    def test_bulk_sorted_adherence_data(self):
+        from portal.models.adherence_data import (
+            AdherenceData,
+            bulk_sorted_adherence_data,
+            sorted_adherence_data,
+        )
+        user2_id = self.add_user('user2').id
+        visits = (
+            "Month 12 post-withdrawn", "Indefinite", "Month 3",
+            "Baseline post-withdrawn", "Month 12", "Baseline")
+        for patient_id in (TEST_USER_ID, user2_id):
+            for visit in visits:
+                AdherenceData.persist(
+                    patient_id=patient_id,
+                    rs_id_visit=AdherenceData.rs_visit_string(0, visit),
+                    valid_for_days=1,
+                    data={'visit': visit})
+        # other research studies are excluded
+        AdherenceData.persist(
+            patient_id=user2_id,
+            rs_id_visit=AdherenceData.rs_visit_string(10, "Baseline"),
+            valid_for_days=1,
+            data={'visit': "Baseline"})
+
+        expected = [{'visit': v} for v in (
+            "Baseline", "Baseline post-withdrawn", "Month 3", "Month 12",
+            "Month 12 post-withdrawn", "Indefinite")]
+        results = bulk_sorted_adherence_data((TEST_USER_ID, user2_id), 0)
+        assert results[TEST_USER_ID] == expected
+        assert results[user2_id] == expected
+        assert sorted_adherence_data(user2_id, 0) == expected
+
     def populate_adherence_cache(self, test_users):
         """helper method to bring current test user state into adherence cache"""
         self.add_system_user()
@@ -220,6 +280,105 @@ class TestQBStats(TestQuestionnaireBankFixture):
             cache_moderation.reset()
             cache_adherence_data(patient_id=u.id)
 
+    def test_adherence_data_chunk(self):
+        """Chunks tally progress in job status, summary totals all chunks"""
+        from portal.models.adherence_data import AdherenceData
+        org = self.setup_org_qbs()
+        org_name = org.name
+        user2 = self.add_user('user2')
+        now = datetime.utcnow()
+        back45, nowish = associative_backdate(now, relativedelta(days=45))
+        self.bless_with_basics(
+            user=user2, setdate=back45, local_metastatic=org_name)
+        user2 = db.session.merge(user2)
+        user2_id = user2.id
+
+        # keep the timeline build from queuing its own adherence refresh,
+        # so the chunk does the work
+        with patch.object(cache_single_patient_adherence_data, 'apply_async'):
+            QB_Status(user=user2, research_study_id=0, as_of_date=now)
+        CacheModeration(key=ADHERENCE_DATA_KEY.format(
+            patient_id=user2_id, research_study_id=0)).reset()
+        sj = ScheduledJob(
+            name='adherence', task='cache_adherence_data_task',
+            schedule='0 0 * * *')
+        with SessionScope(db):
+            db.session.add(sj)
+            db.session.commit()
+        job_id = db.session.merge(sj).id
+
+        run_key = ADHERENCE_CACHE_RUN_KEY.format(uuid4().hex)
+        kwargs = {
+            'research_study_id': 0, 'run_key': run_key, 'chunk_count': 2,
+            'job_id': job_id}
+        first = adherence_data_chunk(
+            patient_ids=[user2_id, TEST_USER_ID], **kwargs)
+        assert first['patients'] == 2
+        assert first['added'] > 0
+        assert first['errors'] == 0
+        assert ScheduledJob.query.get(job_id).last_status == (
+            "cache_adherence_data in progress: 1 of 2 chunks, 2 patients, "
+            f"{first['added']} rows added")
+        assert AdherenceData.query.filter(
+            AdherenceData.patient_id == user2_id).count()
+
+        # recently cached patient adds no further rows
+        second = adherence_data_chunk(patient_ids=[user2_id], **kwargs)
+        assert second == {'patients': 1, 'added': 0, 'errors': 0}
+
+        message = summarize_adherence_chunks(
+            [first, second], started=now.isoformat(), run_key=run_key,
+            job_id=job_id)
+        assert message.startswith(
+            "cache_adherence_data completed 3 patients in 2 chunks, "
+            f"{first['added']} rows added, 0 errors")
+        assert ScheduledJob.query.get(job_id).last_status == message
+
+    def test_cache_adherence_data_status(self):
+        """Final job status is that of the chord callback, not the dispatch"""
+        org = self.setup_org_qbs()
+        org_name = org.name
+        self.add_system_user()
+        user2 = self.add_user('user2')
+        now = datetime.utcnow()
+        back45, nowish = associative_backdate(now, relativedelta(days=45))
+        self.bless_with_basics(
+            user=user2, setdate=back45, local_metastatic=org_name)
+        user2_id = db.session.merge(user2).id
+        sj = ScheduledJob(
+            name='adherence', task='cache_adherence_data_task',
+            schedule='0 0 * * *')
+        with SessionScope(db):
+            db.session.add(sj)
+            db.session.commit()
+        job_id = db.session.merge(sj).id
+
+        bodies = []
+
+        def inline_chord(header):
+            """Run chord tasks in process, in place of the worker"""
+            results = [s.type.run(*s.args, **s.kwargs) for s in header]
+
+            def callback(body):
+                bodies.append(body)
+                return body.type.run(results, *body.args, **body.kwargs)
+            return callback
+
+        with patch('celery.chord', inline_chord), patch.object(
+                cache_single_patient_adherence_data, 'apply_async'):
+            cache_adherence_data_task.run(
+                patient_id=user2_id, job_id=job_id, manual_run=True)
+        assert ScheduledJob.query.get(job_id).last_status.startswith(
+            "cache_adherence_data completed 1 patients in 1 chunks")
+
+        # should a chunk fail, the errback records the final status
+        errback = bodies[0].options['link_error'][0]
+        assert errback['task'] == cache_adherence_data_failed_task.name
+        cache_adherence_data_failed_task.run(
+            None, RuntimeError('chunk failed'), None, **errback['kwargs'])
+        assert ScheduledJob.query.get(job_id).last_status == (
+            "cache_adherence_data failed: chunk failed")
+
     def test_permissions(self):
         """Shouldn't get results from orgs outside view permissions"""
 
@@ -345,3 +504,87 @@ class TestQBStats(TestQuestionnaireBankFixture):
                 assert item['entry_method'] == 'interview_assisted'
             else:
                 assert 'entry_method' not in item
+
+        # csv format streams same rows from the report file
+        response = self.results_from_async_call(
+            "/api/report/questionnaire_status", timeout=10,
+            query_string={'format': 'csv'})
+        assert response.mimetype == 'text/csv'
+        rows = response.get_data(as_text=True).splitlines()
+        assert rows[0].startswith('user_id,study_id,status,visit')
+        assert len(rows) == 5
+
+    def test_adherence_report_regenerated_on_update(self):
+        """Updating adherence data in place changes the report artifact"""
+        from portal.models.adherence_data import AdherenceData
+        self.promote_user(role_name=ROLE.ADMIN.value)
+
+        def persist():
+            AdherenceData.persist(
+                patient_id=TEST_USER_ID,
+                rs_id_visit=AdherenceData.rs_visit_string(0, "Baseline"),
+                valid_for_days=1,
+                data={'visit': "Baseline"})
+
+        def report():
+            return adherence_report(
+                requested_as_of_date=None, acting_user_id=TEST_USER_ID,
+                include_test_role=False, org_id=None, research_study_id=0,
+                response_format='json', lock_key=None, celery_task=None,
+                limit=None)
+
+        persist()
+        first = report()['filename']
+        assert report()['filename'] == first
+
+        # same row, same count, yet the mark must change
+        persist()
+        assert AdherenceData.query.count() == 1
+        assert report()['filename'] != first
+
+    def test_report_artifact(self):
+        """Compressed artifacts are reused until parameters or data change"""
+        import gzip
+        self.app.config['REPORT_COMPRESSION'] = 'gzip'
+        params = {'acting_user_id': TEST_USER_ID, 'high_water_mark': [7, 3]}
+        artifact = ReportArtifact('test', suffix='.csv', **params)
+        assert artifact.filename.endswith('.csv.gz')
+        assert artifact.fresh() is None
+
+        tf = artifact.open()
+        tf.write('a,b\n1,2\n')
+        tf.close()
+        artifact.commit(row_count=1)
+        with gzip.open(artifact.filepath, 'rt') as f:
+            assert f.read() == 'a,b\n1,2\n'
+
+        # same parameters reuse, new data or user does not
+        again = ReportArtifact('test', suffix='.csv', **params)
+        assert again.filepath == artifact.filepath
+        assert again.fresh()['row_count'] == 1
+        assert ReportArtifact(
+            'test', suffix='.csv', acting_user_id=TEST_USER_ID,
+            high_water_mark=[8, 4]).fresh() is None
+        assert ReportArtifact(
+            'test', suffix='.csv', acting_user_id=TEST_USER_ID + 1,
+            high_water_mark=[7, 3]).fresh() is None
+
+        # served encoded to clients accepting gzip, else decompressed
+        report_dir = self.app.config['TMP_REPORT_DIR']
+        with self.app.test_request_context(
+                headers={'Accept-Encoding': 'gzip'}):
+            response = send_report_artifact(
+                report_dir, artifact.filename, as_attachment=True)
+            assert response.headers['Content-Encoding'] == 'gzip'
+            assert artifact.filename[:-3] in (
+                response.headers['Content-Disposition'])
+            response.close()
+        with self.app.test_request_context():
+            response = send_report_artifact(report_dir, artifact.filename)
+            response.direct_passthrough = False
+            assert 'Content-Encoding' not in response.headers
+            assert response.get_data(as_text=True) == 'a,b\n1,2\n'
+            response.close()
+
+        assert purge_report_artifacts(ttl=-1) >= 1
+        assert again.fresh() is None
@@ -3,9 +3,20 @@
 import json
 
 from flask_webtest import SessionScope
+from mock import patch
 
+from portal.cache import cache
 from portal.extensions import db
+from portal.models.organization import Organization
+from portal.models.patient_list import (
+    VIEWABLE_ORGS_KEY,
+    PatientList,
+    StaffOrgVisibility,
+    filter_viewable_orgs,
+    viewable_org_ids,
+)
 from portal.models.table_preference import TablePreference
+from portal.timeout_lock import LockTimeout
 from tests import TEST_USER_ID, TestCase
 
 
@@ -81,3 +92,90 @@ class TestTablePreference(TestCase):
 
         assert resp.status_code == 200
         assert resp.json == {}
+
+    def test_org_filter_invalidates_viewable_orgs(self):
+        parent = Organization(name='parent')
+        with SessionScope(db):
+            db.session.add(parent)
+            db.session.commit()
+        parent = db.session.merge(parent)
+        child = Organization(name='child', partOf_id=parent.id)
+        with SessionScope(db):
+            db.session.add(child)
+            db.session.commit()
+        parent, child = map(db.session.merge, (parent, child))
+        parent_id, child_id = parent.id, child.id
+        self.test_user = db.session.merge(self.test_user)
+        self.test_user.organizations.append(parent)
+        with SessionScope(db):
+            db.session.commit()
+        self.login()
+
+        user = db.session.merge(self.test_user)
+        assert viewable_org_ids(user, 0) == {parent_id, child_id}
+        assert {v.org_id for v in StaffOrgVisibility.query.filter_by(
+            user_id=TEST_USER_ID, research_study_id=0)} == {
+            parent_id, child_id}
+
+        data = {"filters": {"orgs_filter_control": [child_id]}}
+        resp = self.client.post(
+            '/api/user/{}/table_preferences/patientList'.format(TEST_USER_ID),
+            content_type='application/json',
+            data=json.dumps(data))
+        assert resp.status_code == 200
+
+        user = db.session.merge(self.test_user)
+        assert viewable_org_ids(user, 0) == {child_id}
+        assert {v.org_id for v in StaffOrgVisibility.query.filter_by(
+            user_id=TEST_USER_ID, research_study_id=0)} == {child_id}
+
+    def test_viewable_orgs_failed_rebuild_not_cached(self):
+        org, lost = Organization(name='org'), Organization(name='lost')
+        with SessionScope(db):
+            db.session.add(org)
+            db.session.add(lost)
+            db.session.commit()
+        org, lost = map(db.session.merge, (org, lost))
+        org_id, lost_id = org.id, lost.id
+        self.test_user = db.session.merge(self.test_user)
+        self.test_user.organizations.append(org)
+        patient_ids = {
+            org_id: self.add_user('org_patient').id,
+            lost_id: self.add_user('lost_patient').id}
+        with SessionScope(db):
+            # stale visibility, from when the user belonged to `lost`
+            db.session.add(StaffOrgVisibility(
+                user_id=TEST_USER_ID, research_study_id=0, org_id=lost_id))
+            for patient_org_id, patient_id in patient_ids.items():
+                db.session.add(PatientList(
+                    userid=patient_id, org_id=patient_org_id, deleted=False,
+                    test_role=False))
+            db.session.commit()
+        key = VIEWABLE_ORGS_KEY.format(
+            user_id=TEST_USER_ID, research_study_id=0)
+        cache.delete(key)
+
+        def visible_patients():
+            user = db.session.merge(self.test_user)
+            query, orgs = filter_viewable_orgs(PatientList.query, user, 0)
+            assert orgs == {org_id}
+            return {p.userid for p in query}
+
+        # failed rebuild filters on the fresh org set, not the stale rows
+        with patch.object(
+                db.session, 'bulk_insert_mappings',
+                side_effect=RuntimeError("rebuild failed")):
+            assert visible_patients() == {patient_ids[org_id]}
+        assert cache.get(key) is None
+
+        # as does a rebuild in progress elsewhere, without waiting on it
+        with patch(
+                'portal.timeout_lock.TimeoutLock.__enter__',
+                side_effect=LockTimeout("locked")):
+            assert visible_patients() == {patient_ids[org_id]}
+        assert cache.get(key) is None
+
+        assert visible_patients() == {patient_ids[org_id]}
+        assert cache.get(key)['orgs'] == {org_id}
+        assert {v.org_id for v in StaffOrgVisibility.query.filter_by(
+            user_id=TEST_USER_ID, research_study_id=0)} == {org_id}
@@ -66,6 +66,47 @@ def test_qnr_holiday_delay(test_user, clinician_response_holiday_delay):
         assert tsr.resolution_delayed_by_holiday(0) is True
 
 
+def test_bulk_reporting(test_user, add_user):
+    second = add_user('second@example.com')
+    user_ids = (db.session.merge(test_user).id, db.session.merge(second).id)
+    with SessionScope(db):
+        for authored, state, visit in (
+                ('2020-09-30T00:00:00Z', 'processed', 0),
+                ('2020-10-01T00:00:00Z', 'resolved', 0),
+                ('2020-10-30T00:00:00Z', 'processed', 1)):
+            db.session.add(TriggerState(
+                user_id=user_ids[0], state=state, visit_month=visit,
+                triggers={'source': {'authored': authored}}))
+        db.session.add(TriggerState(
+            user_id=user_ids[1], state='due', visit_month=0))
+        for when, path in (
+                (datetime(2020, 10, 2), 'content/pain'),
+                (datetime(2020, 10, 3), 'content/pain'),
+                (datetime(2020, 11, 1), 'content/sleep'),
+                (datetime(2020, 9, 1), 'content/early')):
+            db.session.add(Audit(
+                user_id=user_ids[0], subject_id=user_ids[0],
+                context='access', comment=path, timestamp=when))
+        db.session.commit()
+
+    bulk = TriggerStatesReporting.for_patients(user_ids)
+    assert set(bulk) == set(user_ids)
+    for user_id in user_ids:
+        single = TriggerStatesReporting(patient_id=user_id)
+        for v in range(TriggerStatesReporting.MAX_VISIT):
+            assert (bulk[user_id].latest_action_state(v) ==
+                    single.latest_action_state(v))
+            assert (bulk[user_id].authored_from_visit(v) ==
+                    single.authored_from_visit(v))
+            assert (bulk[user_id].domains_accessed(v) ==
+                    single.domains_accessed(v))
+
+    assert bulk[user_ids[0]].authored_from_visit(0) == datetime(2020, 10, 1)
+    assert bulk[user_ids[0]].domains_accessed(0) == ['pain']
+    assert bulk[user_ids[0]].domains_accessed(1) == ['sleep']
+    assert bulk[user_ids[1]].latest_by_visit[0].state == 'due'
+
+
 def test_initiate_trigger(test_user):
     results = initiate_trigger(test_user.id)
     assert results.state == 'due'
@@ -63,6 +63,19 @@ def test_empty_id():
         get_user('', 'view')
 
 
+def assert_bulk_matches_check_role(user, other_ids):
+    """permitted_user_ids() must agree with check_role() on every id"""
+    for perm in ('view', 'edit'):
+        expected = set()
+        for other_id in other_ids:
+            try:
+                user.check_role(perm, other_id=other_id)
+                expected.add(other_id)
+            except Unauthorized:
+                pass
+        assert user.permitted_user_ids(perm, other_ids) == expected
+
+
 class TestUser(TestCase):
     """User model and view tests"""
 
@@ -826,6 +839,9 @@ class TestUser(TestCase):
         kwargs = {'permission': 'view', 'other_id': member_of.id}
         assert user.check_role(**kwargs)
 
+        assert user.permitted_user_ids(
+            'view', (user.id, u2.id, member_of.id)) == {user.id, member_of.id}
+
     def test_deep_tree_check_role(self):
         self.deepen_org_tree()
 
@@ -970,6 +986,10 @@ class TestUser(TestCase):
             with pytest.raises(Unauthorized):
                 staff_leaf.check_role('edit', patient)
 
+        for staff in (staff_top, staff_mid, staff_leaf):
+            assert_bulk_matches_check_role(staff, (
+                patient_w_id, patient_x_id, patient_y_id, patient_z_id))
+
     def test_deep_tree_staff_check_role(self):
         """Can staff-admin edit correct staff members"""
         self.deepen_org_tree()
@@ -1045,6 +1065,11 @@ class TestUser(TestCase):
                     staff_admin_leaf.check_role(perm, staff)
             assert staff_admin_leaf.check_role(perm, other_id=staff_z_id)
 
+        for staff_admin in (
+                staff_admin_top, staff_admin_mid, staff_admin_leaf):
+            assert_bulk_matches_check_role(staff_admin, (
+                staff_x_id, staff_y_id, staff_z_id, staff_admin_top.id))
+
     def test_all_relationships(self):
         # obtain list of all relationships
         response = self.client.get('/api/relationships')